@@ -0,0 +1,184 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2015, Johannes Köster, Liu lab"
+__email__ = "koester@jimmy.harvard.edu"
+__license__ = "MIT"
+
+"""
+Generators for synthetic benchmark data: sgRNA libraries, annotation tables,
+count tables and workflow configurations. All data is generated from a seed,
+so files can be reused between runs.
+"""
+
+import os
+import bz2
+import gzip
+import argparse
+
+import numpy as np
+import yaml
+
+
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+CHROMOSOMES = ["chr{}".format(c) for c in list(range(1, 23)) + ["X", "Y"]]
+# rows written per chunk when generating annotation tables
+CHUNK_ROWS = 1000000
+
+
+def random_sequences(rng, n, lengths=(19, 20)):
+    """
+    Return n random sequences with lengths drawn from the given ones.
+    """
+    seqs = BASES[rng.integers(0, 4, size=(n, max(lengths)))]
+    seq_lengths = rng.choice(lengths, size=n)
+    return [row[:length].tobytes().decode()
+            for row, length in zip(seqs, seq_lengths)]
+
+
+def generate_library(path, guides, seed=0):
+    """
+    Write a library of the given number of guides (mixed 19/20bp, four
+    guides per gene) in the csv format of annotate-library.
+    """
+    rng = np.random.default_rng(seed)
+    seqs = random_sequences(rng, guides)
+    with open(path, "w") as out:
+        for i, seq in enumerate(seqs):
+            out.write("sg{0},{1},GENE{2}\n".format(i, seq, i // 4))
+    return path
+
+
+def read_library(path):
+    with open(path) as f:
+        return [line.rstrip("\n").split(",") for line in f]
+
+
+def open_output(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "wt")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "wt")
+    return open(path, "w")
+
+
+def generate_annotation_table(path, library, rows, seed=0):
+    """
+    Write an annotation table with the given number of rows (compressed
+    according to the suffix of path). About 95% of the library guides occur
+    in the table (some of them several times, some with a different gene),
+    the remaining rows hold random sequences.
+    """
+    rng = np.random.default_rng(seed + 1)
+    guides = read_library(library)
+    present = [g for g in guides if rng.random() < 0.95]
+    matches = [g for g in present for _ in range(1 + (rng.random() < 0.2))]
+    matches = [matches[i] for i in rng.permutation(len(matches))][:rows]
+    # rows of the table at which the library guides are placed
+    match_rows = np.sort(rng.choice(rows, size=len(matches), replace=False))
+
+    with open_output(path) as out:
+        m = 0
+        for chunk_start in range(0, rows, CHUNK_ROWS):
+            n = min(CHUNK_ROWS, rows - chunk_start)
+            seqs = random_sequences(rng, n)
+            genes = ["GENE{}".format(g) for g in rng.integers(0, 100000, size=n)]
+            while m < len(matches) and match_rows[m] < chunk_start + n:
+                i = match_rows[m] - chunk_start
+                _, seqs[i], genes[i] = matches[m]
+                if rng.random() < 0.1:
+                    genes[i] = "OTHER"
+                m += 1
+            chroms = rng.choice(CHROMOSOMES, size=n)
+            starts = rng.integers(0, 200000000, size=n)
+            scores = rng.random(size=n)
+            strands = rng.choice(["+", "-"], size=n)
+            out.write("".join(
+                "{}\t{}\t{}\t{}\t{:.3f}\t{}\t{}\n".format(
+                    chrom, start, start + len(seq), gene, score, strand, seq)
+                for chrom, start, seq, gene, score, strand in zip(
+                    chroms, starts, seqs, genes, scores, strands)))
+    return path
+
+
+def generate_count_table(path, library, samples, seed=0):
+    """
+    Write a MAGeCK count table with the given number of samples.
+    """
+    rng = np.random.default_rng(seed + 2)
+    guides = read_library(library)
+    counts = rng.poisson(300, size=(len(guides), samples))
+    with open(path, "w") as out:
+        out.write("\t".join(["sgRNA", "Gene"] + sample_names(samples)) + "\n")
+        for (sgrna, _, gene), row in zip(guides, counts):
+            out.write("\t".join([sgrna, gene] + [str(c) for c in row]) + "\n")
+    return path
+
+
+def sample_names(samples):
+    return ["S{}".format(i) for i in range(samples)]
+
+
+def generate_config(workdir, library, samples, mode="samples", counts=None):
+    """
+    Write a workflow configuration with the given number of samples to
+    workdir/config.yaml. In samples mode, an empty FASTQ file is created
+    per sample; in counts mode, the given count table is used.
+    """
+    os.makedirs(os.path.join(workdir, "reads"), exist_ok=True)
+    names = sample_names(samples)
+    config = {
+        "library": os.path.abspath(library),
+        "species": "homo_sapiens",
+        "assembly": "hg38",
+        "targets": {"genes": True},
+        "sgrnas": {"update-efficiency": False, "trim-5": "AUTO", "len": "AUTO",
+                   "annotate-sgrna": False, "annotate-sgrna-efficiency": False},
+        "day0label": names[0],
+        "threads": 4,
+        "correct_cnv": False,
+        "cnv_norm": "/dev/null",
+        "experiments": {"mle": {"designmatrix": "/dev/null"}},
+    }
+    if mode == "samples":
+        config["samples"] = {}
+        for name in names:
+            fastq = os.path.abspath(os.path.join(workdir, "reads", name + ".fastq"))
+            open(fastq, "a").close()
+            config["samples"][name] = fastq
+    else:
+        config["counts"] = os.path.abspath(counts)
+    path = os.path.join(workdir, "config.yaml")
+    with open(path, "w") as out:
+        yaml.dump(config, out, default_flow_style=False)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic benchmark data.")
+    parser.add_argument("outdir")
+    parser.add_argument("--guides", type=int, default=10000)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--samples", type=int, default=10)
+    parser.add_argument("--format", choices=["plain", "gz", "bz2"],
+                        default="plain")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.outdir, exist_ok=True)
+    library = generate_library(
+        os.path.join(args.outdir, "library.csv"), args.guides, args.seed)
+    suffix = "" if args.format == "plain" else "." + args.format
+    generate_annotation_table(
+        os.path.join(args.outdir, "annotation.txt" + suffix), library,
+        args.rows, args.seed)
+    counts = generate_count_table(
+        os.path.join(args.outdir, "counts.txt"), library, args.samples,
+        args.seed)
+    generate_config(os.path.join(args.outdir, "samples"), library,
+                    args.samples)
+    generate_config(os.path.join(args.outdir, "counts"), library,
+                    args.samples, mode="counts", counts=counts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2015, Johannes Köster, Liu lab"
+__email__ = "koester@jimmy.harvard.edu"
+__license__ = "MIT"
+
+"""
+Benchmarks of sgRNA annotation and workflow construction on synthetic data.
+
+Each benchmark runs in a fresh process, such that its peak memory usage can
+be measured. Results can be stored as a baseline and later runs compared
+against it, e.g.
+
+    python benchmarks/run.py --size small --save-baseline benchmarks/baseline.json
+    # ... change something ...
+    python benchmarks/run.py --size small --baseline benchmarks/baseline.json
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import logging
+import tempfile
+import argparse
+import resource
+import subprocess
+import multiprocessing
+from argparse import Namespace
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import generate
+
+
+PRESETS = {
+    "small": dict(guides=10000, rows=1000000, samples=10),
+    "medium": dict(guides=50000, rows=5000000, samples=200),
+    "large": dict(guides=200000, rows=20000000, samples=2000),
+}
+FORMATS = ["plain", "gz", "bz2"]
+CONFIG_REPEAT = 20
+SNAKEFILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         "mageck_vispr", "Snakefile")
+
+
+def peak_rss_mb():
+    # unlike ru_maxrss, the high water mark is not inherited from the parent
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+
+
+def children_peak_rss_mb():
+    # ru_maxrss is given in KB on Linux
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+class Timer():
+    def __init__(self, results, name, items=None, unit=None, repeat=1):
+        self.results = results
+        self.name = name
+        self.items = items
+        self.unit = unit
+        self.repeat = repeat
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        seconds = (time.perf_counter() - self.start) / self.repeat
+        result = {"seconds": seconds, "peak_rss_mb": peak_rss_mb()}
+        if self.items:
+            result["throughput"] = self.items / seconds
+            result["unit"] = self.unit
+        self.results[self.name] = result
+
+
+def bench_annotation(data, table, guides, rows):
+    from mageck_vispr import annotation
+
+    results = {}
+    fmt = FORMATS[0] if table.endswith(".txt") else table.rsplit(".", 1)[1]
+    a = annotation.Annotator(os.path.join(data, "library.csv"))
+    with Timer(results, "sequence_table_import", guides, "guides/s"):
+        a.sequence_table_import()
+    args = Namespace(annotation_table=table, assembly=None, sgrna_len="AUTO",
+                     annotation_table_folder=None, no_cache=True, threads=1,
+                     parser="vectorized")
+    with Timer(results, "custom_bed_get[{}]".format(fmt), rows, "rows/s"):
+        a.custom_bed_get(args)
+    a.outputs = [annotation.open_output(os.devnull)]
+    a.reports = [annotation.open_output(os.devnull)]
+    with Timer(results, "write_output", guides, "guides/s"):
+        a.write_output()
+    for f in a.outputs + a.reports:
+        f.close()
+    if fmt != FORMATS[0]:
+        # the library import is only reported once
+        del results["sequence_table_import"], results["write_output"]
+    return results
+
+
+def bench_config(data, samples):
+    from mageck_vispr import postprocess_config
+    from mageck_vispr.check_config import check_config
+
+    results = {}
+    cwd = os.getcwd()
+    try:
+        for mode in ("samples", "counts"):
+            # like Snakemake, run in the workdir (paths are relative to it)
+            os.chdir(os.path.join(data, mode))
+            with open("config.yaml") as f:
+                config = yaml.safe_load(f)
+            # both are fast, so take the mean of several runs
+            configs = [copy.deepcopy(config) for _ in range(CONFIG_REPEAT)]
+            with Timer(results, "check_config[{}]".format(mode), samples,
+                       "samples/s", CONFIG_REPEAT):
+                for c in configs:
+                    check_config(c, cache=None)
+            # with the path cache of the workflow, kept out of the data
+            with tempfile.TemporaryDirectory() as tmp:
+                cache = os.path.join(tmp, "validated_paths.json")
+                configs = [copy.deepcopy(config) for _ in range(CONFIG_REPEAT)]
+                with Timer(results, "check_config_cached[{}]".format(mode),
+                           samples, "samples/s", CONFIG_REPEAT):
+                    for c in configs:
+                        check_config(c, cache=cache)
+            configs = [copy.deepcopy(config) for _ in range(CONFIG_REPEAT)]
+            with Timer(results, "postprocess_config[{}]".format(mode), samples,
+                       "samples/s", CONFIG_REPEAT):
+                for c in configs:
+                    postprocess_config(c, path_cache=None)
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def bench_dag(data, samples):
+    results = {}
+    if shutil.which("snakemake") is None:
+        logging.warning("snakemake not found, skipping DAG benchmarks.")
+        return results
+    for mode in ("samples", "counts"):
+        workdir = os.path.join(data, mode)
+        start = time.perf_counter()
+        subprocess.run(["snakemake", "-n", "--quiet", "--snakefile", SNAKEFILE,
+                        "--directory", workdir, "--configfile",
+                        os.path.join(workdir, "config.yaml")],
+                       check=True, stdout=subprocess.DEVNULL)
+        seconds = time.perf_counter() - start
+        results["dag[{}]".format(mode)] = {
+            "seconds": seconds,
+            "peak_rss_mb": children_peak_rss_mb(),
+            "throughput": samples / seconds, "unit": "samples/s"}
+    return results
+
+
+def _run(func, args):
+    logging.disable(logging.WARNING)
+    return func(*args)
+
+
+def run_isolated(func, *args):
+    """
+    Run a benchmark function in a fresh process and return its results.
+    """
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(_run, (func, args))
+
+
+def prepare(data, guides, rows, samples, formats):
+    """
+    Generate the benchmark data, unless it already exists.
+    """
+    os.makedirs(data, exist_ok=True)
+    library = os.path.join(data, "library.csv")
+    if not os.path.exists(library):
+        logging.info("Generating library with {} guides.".format(guides))
+        generate.generate_library(library, guides)
+    tables = []
+    for fmt in formats:
+        table = os.path.join(data, "annotation.txt" + ("" if fmt == "plain" else "." + fmt))
+        if not os.path.exists(table):
+            logging.info("Generating annotation table {} with {} rows.".format(
+                table, rows))
+            # keep the suffix, it determines the compression
+            tmp = os.path.join(data, "tmp." + os.path.basename(table))
+            generate.generate_annotation_table(tmp, library, rows)
+            os.replace(tmp, table)
+        tables.append(table)
+    counts = os.path.join(data, "counts.txt")
+    if not os.path.exists(counts):
+        logging.info("Generating count table with {} samples.".format(samples))
+        generate.generate_count_table(counts, library, samples)
+        generate.generate_config(os.path.join(data, "samples"), library, samples)
+        generate.generate_config(os.path.join(data, "counts"), library, samples,
+                                 mode="counts", counts=counts)
+    return tables
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    """
+    Print the changes compared to the baseline and return the names of the
+    benchmarks that got slower or use more memory than tolerated. Timings
+    below min_seconds are too noisy to count as regressions.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        time_change = result["seconds"] / base["seconds"] - 1
+        rss_change = result["peak_rss_mb"] / base["peak_rss_mb"] - 1
+        regressed = rss_change > tolerance or (
+            time_change > tolerance and result["seconds"] >= min_seconds)
+        if regressed:
+            regressions.append(name)
+        print("{:<32} time {:+7.1%}  peak RSS {:+7.1%}{}".format(
+            name, time_change, rss_change, "  REGRESSION" if regressed else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark sgRNA annotation and workflow construction on "
+        "synthetic data.")
+    parser.add_argument("--size", choices=sorted(PRESETS), default="small")
+    parser.add_argument("--guides", type=int, help="Override the library size.")
+    parser.add_argument("--rows", type=int, help="Override the annotation table size.")
+    parser.add_argument("--samples", type=int, help="Override the number of samples.")
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=FORMATS,
+                        help="Annotation table compressions to benchmark.")
+    parser.add_argument("--data-dir", default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "data"),
+        help="Directory for the generated data (reused between runs).")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare the results with this JSON file.")
+    parser.add_argument("--save-baseline", help="Store the results as baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Tolerated relative slowdown or memory increase "
+                        "(default: %(default)s).")
+    parser.add_argument("--min-seconds", type=float, default=0.05,
+                        help="Slowdowns of benchmarks faster than this are "
+                        "not reported as regressions (default: %(default)s).")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+
+    size = dict(PRESETS[args.size])
+    for key in size:
+        if getattr(args, key) is not None:
+            size[key] = getattr(args, key)
+    data = os.path.join(args.data_dir, "{guides}-{rows}-{samples}".format(**size))
+    tables = prepare(data, size["guides"], size["rows"], size["samples"],
+                     args.formats)
+
+    results = {}
+    for table in tables:
+        results.update(run_isolated(bench_annotation, data, table,
+                                    size["guides"], size["rows"]))
+    results.update(run_isolated(bench_config, data, size["samples"]))
+    results.update(run_isolated(bench_dag, data, size["samples"]))
+
+    for name, result in results.items():
+        print("{:<32} {:10.4f}s {:9.1f} MB {}".format(
+            name, result["seconds"], result["peak_rss_mb"],
+            "{:12.0f} {}".format(result["throughput"], result["unit"])
+            if "throughput" in result else ""))
+
+    report = {"size": size, "results": results}
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as out:
+                json.dump(report, out, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["size"] != size:
+            logging.warning("Baseline was measured with different data sizes: "
+                            "{}".format(baseline["size"]))
+        if compare(results, baseline["results"], args.tolerance,
+                   args.min_seconds):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,14 +7,94 @@ import os
 import glob
 import shutil
 import re    #[cuiyb]++
-from collections import defaultdict
+from types import MappingProxyType
+from collections import defaultdict, namedtuple
 
 import yaml
 
 from mageck_vispr.check_config import check_config, ConfigError
 
 
+# batch effects are removed with mageck-vispr remove-batch, the R script is
+# kept for Snakefiles installed by earlier versions
 COMBAT_SCRIPT_PATH = os.path.join(os.path.dirname(__file__), "combat.R")
+# socket of the annotation server (mageck-vispr annotation-server)
+ANNOTATION_SOCKET = os.path.join(".snakemake", "mageck-vispr", "annotation.sock")
+
+
+# Default resources of the workflow rules. Threads are either a fixed number
+# or None (use config["threads"]); memory (MB) and runtime (minutes) are given
+# as a base value plus an increment per GB of input files.
+RESOURCE_MODEL = {
+    "preview_reads": dict(threads=1, mem_mb=(256, 0), runtime=(5, 0)),
+    "fastqc": dict(threads=1, mem_mb=(512, 0), runtime=(10, 10)),
+    "cutadapt": dict(threads=None, mem_mb=(1024, 0), runtime=(10, 15)),
+    "mageck_count": dict(threads=1, mem_mb=(2048, 256), runtime=(30, 30)),
+    "mageck_qc": dict(threads=1, mem_mb=(1024, 2048), runtime=(10, 60)),
+    "annotate_sgrnas": dict(threads=None, mem_mb=(2048, 0), runtime=(30, 0)),
+    "index_sgrnas_bed": dict(threads=1, mem_mb=(512, 4096), runtime=(5, 10)),
+    "annotate_sgrna_after_rra": dict(threads=1, mem_mb=(512, 1024), runtime=(5, 10)),
+    "remove_batch": dict(threads=1, mem_mb=(2048, 4096), runtime=(10, 60)),
+    "mageck_rra": dict(threads=1, mem_mb=(1024, 2048), runtime=(30, 120)),
+    "mageck_mle": dict(threads=None, mem_mb=(2048, 4096), runtime=(60, 600)),
+    "vispr": dict(threads=1, mem_mb=(256, 0), runtime=(5, 0)),
+    "vispr_bundle": dict(threads=1, mem_mb=(1024, 4096), runtime=(5, 10)),
+    "count_cache": dict(threads=1, mem_mb=(512, 0), runtime=(5, 10)),
+    "experiment_counts": dict(threads=1, mem_mb=(256, 0), runtime=(5, 5)),
+    "run_metrics": dict(threads=1, mem_mb=(256, 0), runtime=(5, 0)),
+}
+
+
+def _resource_overrides(rule, config):
+    return config.get("resources", {}).get(rule, {})
+
+
+def input_size_gb(input):
+    """
+    Return the total size of the given (existing) input files in GB.
+    """
+    size = 0
+    for f in input:
+        if os.path.isfile(f):
+            size += os.path.getsize(f)
+    return size / 1024 ** 3
+
+
+def get_threads(rule, config):
+    """
+    Return the number of threads of the given rule. Can be overridden with
+    config["resources"][rule]["threads"].
+    """
+    overrides = _resource_overrides(rule, config)
+    if "threads" in overrides:
+        return overrides["threads"]
+    threads = RESOURCE_MODEL[rule]["threads"]
+    threads = config.get("threads", 1) if threads is None else threads
+    if rule == "cutadapt" and trim_piped(config):
+        # the piped cutadapt jobs of all replicates run at once, in a group
+        # with mageck count, so they share the remaining threads
+        available = config.get("threads", 1) - get_threads("mageck_count", config)
+        threads = max(1, min(threads, available // len(config["replicates"])))
+    return threads
+
+
+def get_resources(rule, config):
+    """
+    Return the resources (mem_mb, runtime) of the given rule, scaled with
+    the size of its input files and the attempt (when jobs are restarted).
+    Can be overridden with config["resources"][rule].
+    """
+    overrides = _resource_overrides(rule, config)
+    resources = {}
+    for name in ("mem_mb", "runtime"):
+        if name in overrides:
+            resources[name] = overrides[name]
+        else:
+            base, per_gb = RESOURCE_MODEL[rule][name]
+            resources[name] = (
+                lambda wildcards, input, attempt, base=base, per_gb=per_gb:
+                int((base + per_gb * input_size_gb(input)) * attempt))
+    return resources
 
 
 def get_norm_method(config):
@@ -26,12 +106,28 @@ def get_norm_method(config):
         return "median"
 
 
+def preview(config):
+    """
+    Returns true if the workflow runs on the first config["preview_reads"]
+    reads of each replicate.
+    """
+    return "samples" in config and bool(config.get("preview_reads"))
+
+
+def results_dir(config):
+    """
+    Return the directory the results are written to.
+    """
+    return "results_preview" if preview(config) else "results"
+
+
 def get_counts(config, normalized=False):
     if "batchmatrix" in config:
-        return "results/count/all.count.batchcorrected.txt"
+        return "{}/count/all.count.batchcorrected.txt".format(results_dir(config))
     else:
         suffix = "_normalized" if normalized else ""
-        return config.get("counts", "results/count/all.count{}.txt".format(suffix))
+        return config.get("counts", "{}/count/all.count{}.txt".format(
+            results_dir(config), suffix))
 
 def get_sample_name(config):
     """
@@ -47,9 +143,8 @@ def get_sample_name(config):
     else:
         # count table provided
         count_table_file=get_counts(config)
-        c_f=open(count_table_file)
-        fields=c_f.readline().strip().split()
-        c_f.close()
+        with open(count_table_file) as c_f:
+            fields=c_f.readline().strip().split()
         return [fx for fx in fields[2:] if fx not in day0samplelist]
 
 
@@ -62,6 +157,26 @@ def annotation_available(config):
     return "library" in config and config["assembly"] in ["mm9", "mm10", "hg19", "hg38"]  
 
 
+def annotation_cache_string(config):
+    """
+    Return the annotate-library options for the download cache of annotation tables.
+    """
+    options = []
+    if "annotation-cache" in config["sgrnas"]:
+        options.append("--cache-dir " + str(config["sgrnas"]["annotation-cache"]))
+    if "annotation-cache-size" in config["sgrnas"]:
+        options.append("--cache-size " + str(config["sgrnas"]["annotation-cache-size"]))
+    return " ".join(options)
+
+
+def annotation_server_string(config):
+    """
+    Return the option of annotate-library and rescore-annotation for using
+    a running annotation server.
+    """
+    return "--server " + str(config["sgrnas"].get("annotation-server", ANNOTATION_SOCKET))
+
+
 def design_available(config):
     """
     Returns true only when it's an MLE experiment and a real design matrix (not /dev/null) is provided
@@ -83,8 +198,8 @@ def efficiency_estimation_available(config, experiment):
     return "designmatrix" in config["experiments"][experiment]
 
 
-def postprocess_config(config):
-    check_config(config)
+def postprocess_config(config, path_cache=None):
+    check_config(config, cache=path_cache)
     config["replicates"] = {}
     if "samples" in config:
         if not "library" in config:
@@ -122,13 +237,99 @@ def postprocess_config(config):
         config['correct_cnv']=False
     if 'cnv_norm' not in config:
         config['cnv_norm']='/dev/null'
+    return build_plan(config)
+
 
 
+def qc_command(config):
+    """
+    Return the command used for read quality control (FastQC, or the
+    built-in mageck-vispr qc with config["qc"] set to native).
+    """
+    if config.get("qc", "fastqc") == "native":
+        return "mageck-vispr qc -o {output} {input} 2> {log}"
+    return "fastqc -t {threads} -f fastq --extract -o {output} {input} 2> {log}"
+
+
+def trim_piped(config):
+    """
+    Returns true if trimmed reads shall be streamed to mageck count through
+    a named pipe instead of a compressed temporary file.
+    """
+    return config["sgrnas"].get("trim-pipe", False)
+
+
+def get_raw_fastq(replicate, config, paired=False):
+    """
+    Return the (untrimmed) reads of a replicate, or of its mate if paired.
+    """
+    if preview(config):
+        return "{}/reads/{}/{}.fastq.gz".format(
+            results_dir(config), "R2" if paired else "R1", replicate)
+    return (config["paired_rep"] if paired else config["replicates"])[replicate]
+
 
 def get_fastq(replicate, config):
     if "adapter" in config["sgrnas"]:
-        return "results/trimmed_reads/{}.fastq".format(replicate)
-    return config["replicates"][replicate]
+        if trim_piped(config):
+            return "{}/trimmed_reads/{}.fastq".format(results_dir(config), replicate)
+        return "{}/trimmed_reads/{}.fastq.gz".format(results_dir(config), replicate)
+    return get_raw_fastq(replicate, config)
+
+def count_sharded(config):
+    """
+    Returns true if each sample shall be counted in its own job.
+    """
+    return "samples" in config and config.get("shard_count", False)
+
+
+def count_stored(config):
+    """
+    Returns true if replicates shall be counted through the content-addressed
+    count store in config["count_cache_dir"].
+    """
+    return "samples" in config and bool(config.get("count_cache_dir"))
+
+
+def merge_count_tables(count_files, output):
+    """
+    Merge per-sample count tables into a single count table. sgRNAs are
+    written in the order they first occur, missing counts are set to 0.
+    """
+    genes = {}
+    labels = []
+    tables = []
+    for count_file in count_files:
+        with open(count_file) as f:
+            header = f.readline().rstrip("\n").split("\t")
+            labels.extend(header[2:])
+            counts = {}
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                genes.setdefault(fields[0], fields[1])
+                counts[fields[0]] = fields[2:]
+            tables.append((counts, ["0"] * (len(header) - 2)))
+    with open(output, "w") as out:
+        out.write("\t".join(["sgRNA", "Gene"] + labels) + "\n")
+        for sgrna, gene in genes.items():
+            row = [sgrna, gene]
+            for counts, missing in tables:
+                row.extend(counts.get(sgrna, missing))
+            out.write("\t".join(row) + "\n")
+
+
+def merge_countsummaries(summary_files, output):
+    """
+    Concatenate per-sample count summaries, keeping the first header.
+    """
+    with open(output, "w") as out:
+        for i, summary_file in enumerate(summary_files):
+            with open(summary_file) as f:
+                header = f.readline()
+                if i == 0:
+                    out.write(header)
+                shutil.copyfileobj(f, out)
+
 
 def need_run_rra_in_mle(wildcards, config):
     # return True
@@ -153,6 +354,61 @@ def rra_control_string(wildcards, config):
         return ""
     return "--control-id "+",".join(config["experiments"][wildcards.experiment]["control"])
 
+def lfc_annotation_targets(config, sample_names=None):
+    """
+    Return pairs of sgRNA summary files and the BED files that are annotated
+    with their log fold changes. The sample names are read from the count
+    table unless given.
+    """
+    results = results_dir(config)
+    # annotation/sgrnas.bed only depends on the library, the LFC annotated
+    # files are kept apart in preview runs
+    annotation = os.path.join(results, "annotation") if preview(config) else "annotation"
+    if "day0label" in config:
+        return [("{}/test/{}.rra.{}_vs_{}.sgrna_summary.txt".format(results, experiment, sample, config["day0label"]),
+                 "{}/{}.rra.{}_vs_{}.sgrnas.bed".format(annotation, experiment, sample, config["day0label"]))
+                for experiment in config["experiments"]
+                for sample in (get_sample_name(config) if sample_names is None
+                               else sample_names)]
+    return [("{}/test/{}.sgrna_summary.txt".format(results, experiment),
+             "{}/{}.sgrnas.bed".format(annotation, experiment))
+            for experiment in config["experiments"]]
+
+
+def benchmarked_targets(config, lfc_targets=None):
+    """
+    Return the files whose creation completes all jobs apart from the
+    creation of the VISPR configs, such that their benchmarks can be
+    aggregated.
+    """
+    results = results_dir(config)
+    targets = []
+    for experiment in config["experiments"]:
+        targets.append("{}/test/{}.gene_summary.txt".format(results, experiment))
+        if "day0label" in config and "designmatrix" in config["experiments"][experiment]:
+            targets.append("{}/test/{}.rra.gene_summary.txt".format(results, experiment))
+        if config.get("vispr_bundle", False):
+            targets.append("{}/bundle/{}".format(results, experiment))
+    if "samples" in config:
+        targets.append(get_counts(config, normalized=True))
+        targets.append("{}/count/all.countsummary.txt".format(results))
+        targets.extend("{}/qc/{}".format(results, rep) for rep in config["replicates"])
+        targets.extend("{}/qc/{}_R2".format(results, rep) for rep in config["paired_rep"])
+        if count_stored(config):
+            targets.extend("{}/count/replicates/{}.count.txt".format(results, rep)
+                           for rep in config["replicates"])
+    else:
+        targets.append("{}/count/all.count_normalized.txt".format(results))
+    if annotation_available(config):
+        targets.append("annotation/sgrnas.bed")
+        targets.append("annotation/sgrnas.bed.gz")
+        if "day0label" in config:
+            if lfc_targets is None:
+                lfc_targets = lfc_annotation_targets(config)
+            targets.extend(bed for summary, bed in lfc_targets)
+    return targets
+
+
 def need_annotate_bed_with_lfc(config):
     if annotation_available(config) and not design_available(config): # only activates when annotation is enabled and (either day0 is provided or an RRA experiment). Note: MLE will not generate individual sgRNA information.
         return True
@@ -160,11 +416,144 @@ def need_annotate_bed_with_lfc(config):
         return False
 
 
+# Everything the Snakefile needs to know about the configuration, computed
+# once by postprocess_config. Per experiment and per replicate values are
+# read-only mappings, such that rules and params functions only do lookups.
+WorkflowPlan = namedtuple("WorkflowPlan", [
+    "results_dir", "preview", "norm_method", "counts", "normalized_counts",
+    "design_available", "annotation_available", "need_annotate_bed_with_lfc",
+    "sample_names", "rra_in_mle", "rra_treatment", "rra_control",
+    "raw_fastqs", "paired_fastqs", "fastqs", "lfc_targets",
+    "benchmarked_targets", "test_counts", "test_norm_method",
+    "experiment_samples", "experiment_counts"])
+_ExperimentWildcards = namedtuple("Wildcards", ["experiment"])
+
+
+def normalize_once(config):
+    """
+    Returns true if all experiments are tested on the normalized count table
+    (created once by mageck count) instead of normalizing in every test.
+    """
+    return config.get("normalize_once", False)
+
+
+def experiment_samples(config, experiment):
+    """
+    Return the samples used by an experiment, or None if it needs all
+    samples (i.e., when testing against a day0 label).
+    """
+    if "day0label" in config:
+        return None
+    entry = config["experiments"][experiment]
+    if "designmatrix" in entry:
+        with open(entry["designmatrix"]) as f:
+            next(f)
+            return [line.split()[0] for line in f if line.strip()]
+    return list(entry["treatment"]) + [
+        sample for sample in entry["control"] if sample not in entry["treatment"]]
+
+
+def build_plan(config):
+    """
+    Return the WorkflowPlan of a postprocessed configuration.
+    """
+    experiments = config["experiments"]
+    sample_names = tuple(get_sample_name(config)) if "day0label" in config else ()
+    annotation = annotation_available(config)
+    design = design_available(config)
+
+    rra_in_mle = frozenset(
+        experiment for experiment in experiments
+        if "day0label" in config and "designmatrix" in experiments[experiment])
+    rra_treatment = {}
+    rra_control = {}
+    for experiment in experiments:
+        wildcards = _ExperimentWildcards(experiment)
+        rra_treatment[experiment] = rra_treatment_string(wildcards, config)
+        rra_control[experiment] = rra_control_string(wildcards, config)
+
+    lfc_targets = tuple(lfc_annotation_targets(config, sample_names))
+
+    results = results_dir(config)
+    test_counts = get_counts(config)
+    test_norm_method = get_norm_method(config)
+    # samples of the experiments that are tested on a subset of the counts
+    subsets = {}
+    if normalize_once(config):
+        if "batchmatrix" not in config:
+            test_counts = "{}/count/all.count_normalized.txt".format(results)
+        test_norm_method = "none"
+        if config.get("subset_samples", False):
+            for experiment in experiments:
+                used = experiment_samples(config, experiment)
+                if used is not None:
+                    subsets[experiment] = tuple(used)
+    return WorkflowPlan(
+        results_dir=results,
+        preview=preview(config),
+        norm_method=get_norm_method(config),
+        counts=get_counts(config),
+        normalized_counts=get_counts(config, normalized=True),
+        design_available=design,
+        annotation_available=annotation,
+        need_annotate_bed_with_lfc=annotation and not design,
+        sample_names=sample_names,
+        rra_in_mle=rra_in_mle,
+        rra_treatment=MappingProxyType(rra_treatment),
+        rra_control=MappingProxyType(rra_control),
+        raw_fastqs=MappingProxyType({
+            rep: get_raw_fastq(rep, config) for rep in config["replicates"]}),
+        paired_fastqs=MappingProxyType({
+            rep: get_raw_fastq(rep, config, paired=True)
+            for rep in config["paired_rep"]}),
+        fastqs=MappingProxyType({
+            rep: get_fastq(rep, config) for rep in config["replicates"]}),
+        lfc_targets=lfc_targets,
+        benchmarked_targets=tuple(benchmarked_targets(config, lfc_targets)),
+        test_counts=test_counts,
+        test_norm_method=test_norm_method,
+        experiment_samples=MappingProxyType(subsets),
+        experiment_counts=MappingProxyType({
+            experiment: "{}/count/experiments/{}.count.txt".format(results, experiment)
+            for experiment in subsets}))
+
+
+def fastqc_reports(fastqc_dirs, config, paired=False):
+    """
+    Return the fastqc_data.txt files of the given QC directories (one per
+    replicate, or per mate if paired) grouped by sample.
+    """
+    samples = {
+        rep: sample
+        for sample, replicates in config["paired" if paired else "samples"].items()
+        for rep in replicates
+    }
+    qc = defaultdict(list)
+    for replicate, fastqc in zip(config["paired_rep" if paired else "replicates"],
+                                 fastqc_dirs):
+        qc[samples[replicate]].extend(
+            os.path.join(data, "fastqc_data.txt")
+            for data in sorted(glob.iglob("{}/*_fastqc".format(fastqc))))
+    return dict(qc)
+
+
+def vispr_bundle(input, output, config):
+    """
+    Write the columnar data bundle of an experiment.
+    """
+    from mageck_vispr.bundle import write_bundle
+    fastqc = {}
+    for name, paired in (("fastqc", False), ("pairedfastqc", True)):
+        if name in input.keys() and len(input[name]) > 0:
+            fastqc[name] = fastqc_reports(input[name], config, paired=paired)
+    annotation = input.annotation if "annotation" in input.keys() else None
+    write_bundle(output[0], input.results, input.sgrna_results, input.counts,
+                 annotation=annotation or None, **fastqc)
 
 
 def vispr_config(input, output, wildcards, config):
-    relpath = lambda path: os.path.relpath(path, "results")
-    copy = lambda path: shutil.copy(path, "results")
+    relpath = lambda path: os.path.relpath(path, results_dir(config))
+    copy = lambda path: shutil.copy(path, results_dir(config))
     vispr_config = {
         "experiment": wildcards.experiment,
         "species": config["species"],
@@ -179,30 +568,19 @@ def vispr_config(input, output, wildcards, config):
     }
     #if "fastqc" in input.keys():
     if "fastqc" in input.keys() and len(input["fastqc"])>0 :
-        samples = {
-            rep: sample
-            for sample, replicates in config["samples"].items()
-            for rep in replicates
-        }
-        qc = defaultdict(list)
-        for replicate, fastqc in zip(config["replicates"], input.fastqc):
-            qc[samples[replicate]].extend(
-                relpath(os.path.join(data, "fastqc_data.txt"))
-                for data in sorted(glob.iglob("{}/*_fastqc".format(fastqc))))
-        vispr_config["fastqc"] = dict(qc)
+        vispr_config["fastqc"] = {
+            sample: [relpath(report) for report in reports]
+            for sample, reports in fastqc_reports(input.fastqc, config).items()}
     #if "pairedfastqc" in input.keys():
     if "pairedfastqc" in input.keys() and len(input["pairedfastqc"])>0 :
-        samples = {
-            rep: sample
-            for sample, replicates in config["paired"].items()
-            for rep in replicates
-        }
-        qc = defaultdict(list)
-        for replicate, fastqc in zip(config["paired_rep"], input.pairedfastqc):
-            qc[samples[replicate]].extend(
-                relpath(os.path.join(data, "fastqc_data.txt"))
-                for data in sorted(glob.iglob("{}/*_fastqc".format(fastqc))))
-        vispr_config["pairedfastqc"] = dict(qc)
+        vispr_config["pairedfastqc"] = {
+            sample: [relpath(report) for report in reports]
+            for sample, reports in fastqc_reports(
+                input.pairedfastqc, config, paired=True).items()}
+    if "bundle" in input.keys() and len(input["bundle"]) > 0:
+        vispr_config["bundle"] = relpath(input.bundle)
+    if "metrics" in input.keys():
+        vispr_config["metrics"] = relpath(input.metrics)
     if "mapstats" in input.keys() and len(input["mapstats"])>0 :
         vispr_config["sgrnas"]["mapstats"] = relpath(input.mapstats)
     if "controls" in config["targets"]:
@@ -212,6 +590,10 @@ def vispr_config(input, output, wildcards, config):
     if annotation_available(config):
         copy("annotation/sgrnas.bed")
         vispr_config["sgrnas"]["annotation"] = "sgrnas.bed"
+        # sorted by position, for region queries with tabix
+        copy("annotation/sgrnas.bed.gz")
+        copy("annotation/sgrnas.bed.gz.tbi")
+        vispr_config["sgrnas"]["annotation_indexed"] = "sgrnas.bed.gz"
     if efficiency_estimation_available(config, wildcards.experiment):
         vispr_config["sgrnas"]["results"] = relpath(input.sgrna_results)
     with open(output[0], "w") as f:
@@ -13,95 +13,806 @@ import bz2
 import gzip
 import io
 import logging
+import threading
+from queue import Queue, Empty, Full
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
 import operator
 
+from mageck_vispr.annotation_index import (AnnotationIndex, find_index,
+                                           parse_line, build_index, index_path,
+                                           INDEX_SUFFIX, CACHED_INDEX)
+from mageck_vispr.bgzf import BgzfWriter
+from mageck_vispr.tabix import SortedBedWriter
+from mageck_vispr.metrics import PhaseMetrics
+from mageck_vispr.download import (DownloadCache, DEFAULT_CACHE_DIR,
+                                   DEFAULT_CACHE_SIZE)
 
-# TODO rewrite this with Pandas
+
+def open_table(candidate_file):
+    """
+    Open a (possibly remote or compressed) annotation table for reading
+    raw lines.
+    """
+    if candidate_file.startswith("http"):
+        file = urlopen(candidate_file)
+    else:
+        file = open(candidate_file, "rb")
+    if candidate_file.endswith(".bz2"):
+        file = io.BufferedReader(bz2.open(file))
+    elif candidate_file.endswith(".gz"):
+        file = io.BufferedReader(gzip.open(file))
+    return file
+
+
+# sgRNA sequences are packed into integers with 2 bits per base; the length
+# is stored in the bits above the bases, so that e.g. A and AA differ.
+# Bases are numbered A=0, C=1, T=2, G=3, which are bits 1-2 of their ASCII
+# codes in both upper and lower case.
+SEQUENCE_LENGTH_SHIFT = 58
+MAX_PACKED_LENGTH = SEQUENCE_LENGTH_SHIFT // 2
+_BASES = "ACTG"
+# digits in the input are mapped to an invalid base-4 digit
+_PACK_TABLE = str.maketrans("ACGTacgt0123", "013201329999")
+_BASE_CODES = np.frombuffer(_BASES.encode(), dtype=np.uint8)
+# the four bases packed into each byte
+_DECODE_BYTE = ["".join(_BASES[(byte >> shift) & 3] for shift in (6, 4, 2, 0))
+                for byte in range(256)]
+
+
+def encode_sequence(seq):
+    """
+    Pack a DNA sequence into an integer. Sequences that contain characters
+    other than ACGT or are too long to be packed are returned as uppercase
+    strings, which never compare equal to a packed sequence.
+    """
+    if len(seq) <= MAX_PACKED_LENGTH and seq.isascii():
+        packed = seq.translate(_PACK_TABLE)
+        if packed.isdigit():
+            try:
+                return int(packed, 4) | (len(seq) << SEQUENCE_LENGTH_SHIFT)
+            except ValueError:
+                pass
+    return seq.upper()
+
+
+def decode_sequence(code):
+    """
+    Unpack a sequence packed with encode_sequence.
+    """
+    if isinstance(code, str):
+        return code
+    length = code >> SEQUENCE_LENGTH_SHIFT
+    bases = code & ((1 << (2 * length)) - 1)
+    seq = "".join(map(_DECODE_BYTE.__getitem__, bases.to_bytes(8, "big")))
+    return seq[len(seq) - length:]
+
+
+def sequence_length(code):
+    """
+    Return the length of a sequence packed with encode_sequence.
+    """
+    if isinstance(code, str):
+        return len(code)
+    return code >> SEQUENCE_LENGTH_SHIFT
+
+
+def sequence_suffix(code, length):
+    """
+    Return the last (3', i.e. PAM-proximal) bases of a sequence packed with
+    encode_sequence, packed again.
+    """
+    if isinstance(code, str):
+        return encode_sequence(code[-length:])
+    if length >= code >> SEQUENCE_LENGTH_SHIFT:
+        return code
+    return (code & ((1 << (2 * length)) - 1)) | (length << SEQUENCE_LENGTH_SHIFT)
+
+
+# number of bases that fill a packed 64 bit integer
+_PACK_WIDTH = 32
+
+
+def pack_sequences(chars, lengths):
+    """
+    Vectorized version of encode_sequence for a matrix of ASCII codes with
+    one sequence per row (codes beyond the length of a sequence are
+    ignored). Characters other than bases are packed like some base, see
+    valid_sequences.
+
+    Groups of four 2-bit bases are combined into bytes, such that each row
+    can be read as a big-endian 64 bit integer, from which the bases beyond
+    the length of the sequence are shifted out.
+    """
+    n, width = chars.shape
+    nbytes = min(-(-width // 4), _PACK_WIDTH // 4)
+    if width != 4 * nbytes:
+        chars = np.pad(chars, ((0, 0), (0, max(4 * nbytes - width, 0))))
+    digits = np.ascontiguousarray((chars[:, :4 * nbytes] >> np.uint8(1)) &
+                                  np.uint8(3))
+    # the bases b0 b1 b2 b3 of each group, read as a little-endian 32 bit
+    # integer, are combined into the byte b0b1b2b3
+    groups = digits.view("<u4")
+    quads = np.zeros((n, _PACK_WIDTH // 4), dtype=np.uint8)
+    quads[:, _PACK_WIDTH // 4 - nbytes:] = (
+        (groups << 6) | (groups >> 4) | (groups >> 14) | (groups >> 24))
+    packed = quads.view(">u8").ravel().astype(np.uint64)
+    packed >>= (2 * (4 * nbytes - np.clip(lengths, 1, 4 * nbytes))).astype(np.uint64)
+    packed |= lengths.astype(np.uint64) << np.uint64(SEQUENCE_LENGTH_SHIFT)
+    return packed
+
+
+def valid_sequences(chars, lengths):
+    """
+    Return a mask of the rows of chars (see pack_sequences) holding a
+    sequence that can be packed, i.e. consists of 1 to MAX_PACKED_LENGTH
+    bases.
+    """
+    width = chars.shape[1]
+    lower = chars | np.uint8(32)
+    base = ((lower == ord("a")) | (lower == ord("c")) | (lower == ord("g")) |
+            (lower == ord("t")))
+    # position of the first character that is not a base
+    first_other = base.argmin(axis=1)
+    first_other[base[np.arange(len(chars)), first_other]] = width
+    return ((first_other >= lengths) & (lengths > 0) &
+            (lengths <= min(width, MAX_PACKED_LENGTH)))
+
+
+# width of the byte windows through which fields of a block are accessed
+_WINDOW = 64
+
+
+def byte_windows(buf):
+    """
+    Return a view of all windows of _WINDOW bytes in the given buffer, such
+    that windows[i] starts at byte i.
+    """
+    return sliding_window_view(
+        np.concatenate((buf, np.zeros(_WINDOW, dtype=np.uint8))), _WINDOW)
+
+
+class SequenceFilter():
+    """
+    Vectorized membership test of annotation table sequences in a set of
+    (packed) library sequences. With a core length, the last core_length
+    bases of the table sequences are tested instead.
+    """
+    # number of low bits of the packed sequences used by the bitmap that
+    # rules out most non-library sequences before the exact search
+    BITMAP_BITS = 24
+
+    def __init__(self, sequence_set, core_length=None):
+        self.sequence_set = sequence_set
+        self.core_length = core_length
+        self.packed = np.array(
+            sorted(seq for seq in sequence_set if not isinstance(seq, str)),
+            dtype=np.uint64)
+        self.strings = {seq for seq in sequence_set if isinstance(seq, str)}
+        self._keys = None
+        self.bitmask = np.uint64((1 << self.BITMAP_BITS) - 1)
+        self.bitmap = np.zeros(1 << self.BITMAP_BITS, dtype=bool)
+        self.bitmap[(self.packed & self.bitmask).astype(np.intp)] = True
+
+    @property
+    def keys(self):
+        """
+        The (core) sequences as uppercase strings, for the line by line
+        parser.
+        """
+        if self._keys is None:
+            self._keys = set(self.strings)
+            lengths = self.packed >> np.uint64(SEQUENCE_LENGTH_SHIFT)
+            for length in np.unique(lengths).tolist():
+                shifts = 2 * np.arange(length - 1, -1, -1, dtype=np.uint64)
+                digits = (self.packed[lengths == length, None] >> shifts) & np.uint64(3)
+                text = _BASE_CODES[digits].tobytes().decode()
+                self._keys.update(text[i:i + length]
+                                  for i in range(0, len(text), length))
+        return self._keys
+
+    def __call__(self, buf, windows, starts, ends):
+        """
+        Return a mask of the sequences buf[starts[i]:ends[i]] that are in
+        the set.
+        """
+        if self.core_length is not None:
+            starts = np.maximum(starts, ends - self.core_length)
+        lengths = ends - starts
+        # a multiple of four bases, see pack_sequences
+        width = min(-(-max(lengths.max(initial=0), 1) // 4) * 4, _PACK_WIDTH)
+        chars = windows[starts, :width]
+        packed = pack_sequences(chars, lengths)
+        mask = self.bitmap[(packed & self.bitmask).astype(np.intp)]
+        # only the few sequences passing the bitmap are validated
+        candidates = np.flatnonzero(mask)
+        if len(candidates):
+            found = np.minimum(np.searchsorted(self.packed, packed[candidates]),
+                               len(self.packed) - 1)
+            mask[candidates] = (self.packed[found] == packed[candidates]) & \
+                valid_sequences(chars[candidates], lengths[candidates])
+        if self.strings:
+            for i in np.flatnonzero(~valid_sequences(chars, lengths)):
+                seq = buf[starts[i]:ends[i]].tobytes().decode().upper()
+                mask[i] = seq in self.strings
+        return mask
+
+
+def _plain_numbers(windows, tabs):
+    """
+    Cheap check for the common forms of the numeric columns, unsigned
+    integers as start and end and decimals like 0.25 as score. Returns a
+    mask of the lines where all three columns are plain.
+    """
+    rows = np.arange(len(tabs))
+    # start and end, with the tab between them
+    first = tabs[:, 0] + 1
+    lengths = tabs[:, 2] - first
+    middle = tabs[:, 1] - first
+    other = (windows[first, :lengths.max() + 1] - np.uint8(ord("0"))) > 9
+    other[rows, middle] = False
+    plain = ((other.argmax(axis=1) == lengths) & (middle > 0) &
+             (lengths > middle + 1))
+    # score: digits with at most one dot
+    first = tabs[:, 3] + 1
+    lengths = tabs[:, 4] - first
+    chars = windows[first, :lengths.max() + 1]
+    other = (chars - np.uint8(ord("0"))) > 9
+    first_other = other.argmax(axis=1)
+    dot = chars[rows, first_other] == ord(".")
+    other[rows, first_other] = False
+    return plain & (((first_other == lengths) & (lengths > 0)) |
+                    (dot & (other.argmax(axis=1) == lengths) & (lengths > 1)))
+
+
+def _valid_numbers(chars, lengths, real=False):
+    """
+    Check fields of the given lengths (starting with the rows of chars) for
+    being plain integers (or, if real, decimal floats like -1.5e-3). Other
+    forms accepted by int and float (e.g. 1_000, inf or surrounding blanks)
+    are reported invalid, too.
+    """
+    pos = np.arange(chars.shape[1])
+    inside = pos < lengths[:, None]
+    digit = ((chars - np.uint8(ord("0"))) <= 9) & inside
+    sign = ((chars == ord("+")) | (chars == ord("-"))) & inside
+    if not real:
+        return (~inside | digit | (sign & (pos == 0))).all(axis=1) & \
+            digit.any(axis=1)
+    dot = (chars == ord(".")) & inside
+    exp = ((chars | np.uint8(32)) == ord("e")) & inside
+    has_exp = exp.any(axis=1)
+    exp_pos = np.where(has_exp, exp.argmax(axis=1), lengths)[:, None]
+    mantissa = pos < exp_pos
+    sign_pos = (pos == 0) | (has_exp[:, None] & (pos == exp_pos + 1))
+    return ((~inside | digit | dot | exp | (sign & sign_pos)).all(axis=1) &
+            (exp.sum(axis=1) <= 1) & (dot.sum(axis=1) <= 1) &
+            ~(dot & ~mantissa).any(axis=1) &
+            (digit & mantissa).any(axis=1) &
+            (~has_exp | (digit & ~mantissa).any(axis=1)))
+
+
+def _scan_lines(block, sequence_filter):
+    # parse_line, inlined for speed: the block is decoded at once and the
+    # (core) sequences are compared as strings instead of being packed
+    try:
+        lines = block[:-1].decode().split("\n")
+    except UnicodeDecodeError:
+        # parse the lines before the first one that cannot be decoded
+        lines = block[:-1].split(b"\n")
+        for i, line in enumerate(lines):
+            try:
+                line.decode()
+            except UnicodeDecodeError:
+                break
+        if i == 0:
+            return 0, [], 0
+        nlines, matches, error = _scan_lines(b"\n".join(lines[:i]) + b"\n",
+                                             sequence_filter)
+        return (nlines, matches, error) if error is not None else (i, matches, i)
+    keys = sequence_filter.keys
+    core_length = sequence_filter.core_length or 0
+    matches = []
+    for i, line in enumerate(lines):
+        try:
+            fields = line.strip().split("\t")
+            chr, chrstart, chrend, gene, score, strand, seq = fields
+            int(chrstart)
+            int(chrend)
+            float(score)
+        except ValueError:
+            return i, matches, i
+        if seq[-core_length:].upper() in keys:
+            matches.append(tuple(fields))
+    return len(lines), matches, None
+
+
+def scan_block(block, sequence_filter, parser="vectorized"):
+    """
+    Parse a block of annotation table lines and select the lines whose
+    sequence is in the library. Returns the number of lines, the matching
+    records and the (block-local) number of an unparsable line, if any.
+
+    The vectorized parser locates fields by the positions of tabs and
+    newlines in the whole block, validates the numeric columns by their
+    characters and packs all sequences at once, such that only matching
+    lines are ever split into Python strings. Blocks with irregular lines
+    are handed to the line by line parser, which reports the exact error.
+    """
+    if not block.endswith(b"\n"):
+        block += b"\n"
+    if parser == "python":
+        return _scan_lines(block, sequence_filter)
+
+    buf = np.frombuffer(block, dtype=np.uint8)
+    # every line needs exactly six tabs followed by a newline (other
+    # control characters are found, too, and leave the block irregular)
+    separators = np.flatnonzero(buf <= 10)
+    nlines = len(separators) // 7
+    if len(separators) != 7 * nlines:
+        return _scan_lines(block, sequence_filter)
+    separators = separators.reshape(nlines, 7)
+    kinds = buf[separators]
+    if not ((kinds[:, :6] == 9).all() and (kinds[:, 6] == 10).all()):
+        return _scan_lines(block, sequence_filter)
+    tabs = separators[:, :6]
+    ends = separators[:, 6]
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    # strip carriage returns
+    ends = ends - (buf[ends - 1] == 13)
+    # lines the line by line parser would decode as UTF-8 or strip further
+    if buf.max() >= 128 or (buf[starts] <= 32).any() or (buf[ends - 1] <= 32).any():
+        return _scan_lines(block, sequence_filter)
+
+    # columns start, end and score have to be plain numbers; fields in any
+    # other form are left to int and float of the line by line parser
+    windows = byte_windows(buf)
+    if (tabs[:, 4] - tabs[:, 0]).max() >= _WINDOW:
+        return _scan_lines(block, sequence_filter)
+    other = np.flatnonzero(~_plain_numbers(windows, tabs))
+    if len(other):
+        for column in (1, 2, 4):
+            first = tabs[other, column - 1] + 1
+            lengths = tabs[other, column] - first
+            if not _valid_numbers(windows[first, :lengths.max() + 1], lengths,
+                                  column == 4).all():
+                return _scan_lines(block, sequence_filter)
+
+    mask = sequence_filter(buf, windows, tabs[:, 5] + 1, ends)
+    hits = np.flatnonzero(mask)
+    # the numbers are valid and the lines ASCII without surrounding blanks,
+    # hence the lines can be split without further checks
+    matches = [tuple(block[start:end].decode().split("\t")) for start, end in
+               zip(starts[hits].tolist(), ends[hits].tolist())]
+    return nlines, matches, None
+
+
+def scan_table(file, sequence_filter, parser="vectorized", stats=None):
+    """
+    Yield the annotation table rows whose sequence passes the given filter,
+    in table order. The number of scanned lines is added to stats["lines"].
+    """
+    offset = 0
+    for block in iter_chunks(file):
+        nlines, matches, error = scan_block(block, sequence_filter, parser)
+        yield from matches
+        if error is not None:
+            raise SyntaxError(
+                "Error parsing line {} in annotation table.".format(offset + error))
+        offset += nlines
+    if stats is not None:
+        stats["lines"] = stats.get("lines", 0) + offset
+
+
+# size of the blocks of decompressed lines that are parsed at once
+SCAN_CHUNK_SIZE = 1 << 22
+
+_scan_sequence_filter = None
+_scan_parser = None
+
+
+def _init_scan_worker(sequence_set, parser, core_length):
+    global _scan_sequence_filter, _scan_parser
+    _scan_sequence_filter = SequenceFilter(sequence_set, core_length)
+    _scan_parser = parser
+
+
+def _scan_chunk(chunk):
+    return scan_block(chunk, _scan_sequence_filter, _scan_parser)
+
+
+def iter_chunks(file, chunk_size=SCAN_CHUNK_SIZE):
+    """
+    Read a binary file in blocks that end at line boundaries.
+    """
+    rest = b""
+    for block in iter(lambda: file.read(chunk_size), b""):
+        block = rest + block
+        end = block.rfind(b"\n") + 1
+        if end == 0:
+            rest = block
+            continue
+        rest = block[end:]
+        yield block[:end]
+    if rest:
+        yield rest
+
+
+def parallel_scan(candidate_files, sequence_set, threads, parser="vectorized",
+                  stats=None, core_length=None):
+    """
+    Scan the given annotation tables with a pool of worker processes.
+
+    Each table is decompressed by its own reader thread and split into
+    blocks of lines that are parsed by the workers. Matching records are
+    yielded in table and line order, such that the result is identical to
+    a sequential scan. The number of scanned lines is added to
+    stats["lines"]. sequence_set and core_length are passed to the
+    SequenceFilter of each worker.
+
+    The futures of each table are passed on through a bounded queue as soon
+    as they are submitted. If the scan fails or is not consumed until the
+    end, the readers stop and pending blocks are cancelled.
+    """
+    # bound the number of decompressed blocks waiting for a worker
+    slots = threading.BoundedSemaphore(2 * threads)
+    stop = threading.Event()
+    queues = [Queue(2 * threads) for _ in candidate_files]
+
+    def put(queue, item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+        # nobody reads the queue anymore
+        if item is not None:
+            item.cancel()
+
+    def submit_chunks(pool, candidate_file, queue):
+        try:
+            with open_table(candidate_file) as file:
+                for chunk in iter_chunks(file):
+                    slots.acquire()
+                    if stop.is_set():
+                        slots.release()
+                        break
+                    future = pool.submit(_scan_chunk, chunk)
+                    future.add_done_callback(lambda f: slots.release())
+                    put(queue, future)
+        finally:
+            # end of table (or error, which is raised by the reader's result)
+            put(queue, None)
+
+    def cancel_queued():
+        for queue in queues:
+            while True:
+                try:
+                    future = queue.get_nowait()
+                except Empty:
+                    break
+                if future is not None:
+                    future.cancel()
+
+    with ProcessPoolExecutor(threads, initializer=_init_scan_worker,
+                             initargs=(sequence_set, parser, core_length)) as pool, \
+            ThreadPoolExecutor(len(candidate_files)) as reader_pool:
+        readers = [reader_pool.submit(submit_chunks, pool, candidate_file, queue)
+                   for candidate_file, queue in zip(candidate_files, queues)]
+        try:
+            for reader, queue in zip(readers, queues):
+                offset = 0
+                for future in iter(queue.get, None):
+                    nlines, matches, error = future.result()
+                    if error is not None:
+                        raise SyntaxError(
+                            "Error parsing line {} in annotation table.".format(
+                                offset + error))
+                    offset += nlines
+                    yield from matches
+                reader.result()
+                if stats is not None:
+                    stats["lines"] = stats.get("lines", 0) + offset
+        finally:
+            stop.set()
+            # cancelling queued blocks frees slots for readers waiting on them
+            while not all(reader.done() for reader in readers):
+                cancel_queued()
+                wait(readers, timeout=0.1)
+            cancel_queued()
+
+
+# size of the write buffer of output files
+OUTPUT_BUFFER_SIZE = 1 << 24
+
+# columns of the report of library sequences without (gene-matching)
+# annotation
+REPORT_COLUMNS = ["reason", "sgrna", "sequence", "gene", "chrom", "start",
+                  "end", "annotated_gene"]
+
+
+def open_output(path=None, compression=None):
+    """
+    Open a text file for writing with a large buffer, optionally compressed
+    with gzip or bgzip (the default for paths ending with .gz). Without a
+    path, standard output is used.
+    """
+    if path is None or path == "-":
+        return open(sys.stdout.fileno(), "w", buffering=OUTPUT_BUFFER_SIZE,
+                    closefd=False)
+    if compression is None:
+        compression = "bgzip" if path.endswith(".gz") else "none"
+    if compression == "none":
+        return open(path, "w", buffering=OUTPUT_BUFFER_SIZE)
+    if compression == "bgzip":
+        file = BgzfWriter(path)
+    else:
+        file = gzip.GzipFile(path, "wb")
+    return io.TextIOWrapper(io.BufferedWriter(file, OUTPUT_BUFFER_SIZE))
+
+
+def read_values(path, column):
+    """
+    Read a column of a tab-separated file with header, keyed by the first
+    column (the sgRNA ID). Values are kept as given in the file.
+    """
+    with open(path) as f:
+        header = f.readline().rstrip("\n").split("\t")
+        if column not in header[1:]:
+            raise SyntaxError(""+column+" is not in the columns of "+path+".")
+        j = header.index(column)
+        values = {}
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            values.setdefault(fields[0], fields[j])
+        return values
+
+
+def iter_bed(bed):
+    with open(bed) as f:
+        for line in f:
+            yield line.rstrip("\n").split("\t")
+
+
+def rescore_bed(bed, value_files, column, outputs, records=None):
+    """
+    Write a copy of an annotation BED file for each given value file, with
+    the score column replaced by the values of the given column (0 for
+    sgRNAs without a value). The BED file is read only once, or not at all
+    if its records (lists of fields) are given.
+    """
+    if len(value_files) != len(outputs):
+        raise SyntaxError("need to specify one output file per value file.")
+    values = [read_values(path, column) for path in value_files]
+    outputs = [open_output(path) for path in outputs]
+    try:
+        for fields in (iter_bed(bed) if records is None else records):
+            fields = list(fields)
+            for value, out in zip(values, outputs):
+                fields[4] = value.get(fields[3], "0")
+                out.write("\t".join(fields) + "\n")
+    finally:
+        for out in outputs:
+            out.close()
+
+
+def index_table(annotation_table, output=None, cache=None):
+    """
+    Build a sequence-keyed index for the given annotation table. By default,
+    the index is stored next to the table, or next to the copy of a
+    downloaded table in the given download cache.
+    """
+    if output is None and annotation_table.startswith("http") and cache is not None:
+        blob = cache.get(annotation_table)
+        return cache.derived(blob, CACHED_INDEX, build=index_table)
+    if output is None:
+        output = index_path(annotation_table)
+        if annotation_table.startswith("http"):
+            output = os.path.basename(output)
+    with open_table(annotation_table) as file:
+        build_index(file, output)
+    return output
+
+
+# library sequences are matched by their 3' (PAM-proximal) core of this
+# many bases at least; shorter sequences are not annotated
+MIN_CORE_LENGTH = 17
+# sgRNA lengths of the precomputed annotation tables
+TABLE_SGRNA_LENGTHS = (19, 20)
+# lines of a custom annotation table read to determine its sequence lengths
+TABLE_PEEK_LINES = 10000
+
+
+def table_sgrna_length(length):
+    """
+    Return the length of the precomputed annotation table used for library
+    sgRNAs of the given length: the table of the same length or, if there is
+    none, the one verifying the most of its bases.
+    """
+    if length in TABLE_SGRNA_LENGTHS:
+        return length
+    return max(TABLE_SGRNA_LENGTHS) if length > max(TABLE_SGRNA_LENGTHS) \
+        else min(TABLE_SGRNA_LENGTHS)
+
+
+def table_sequence_lengths(candidate_file, lines=TABLE_PEEK_LINES):
+    """
+    Return the set of sequence lengths among the first lines of an
+    annotation table (or among a sample of the keys of an index).
+    """
+    if candidate_file.endswith(INDEX_SUFFIX):
+        with AnnotationIndex(candidate_file) as idx:
+            return idx.key_lengths()
+    lengths = set()
+    with open_table(candidate_file) as file:
+        for i, line in enumerate(file):
+            if i == lines:
+                break
+            lengths.add(len(parse_line(line, i)[6]))
+    return lengths
 
 
 class Annotator():
     def __init__(self, library ):
         #self.customized_table = annotation_table
-        self.sequence_table = library
+        # one or more library files, annotated in a single scan
+        self.sequence_tables = [library] if isinstance(library, str) else list(library)
+        # combined index: sequence -> [[library index, sgRNA id, gene id], ...]
         self.sequence_dict = defaultdict(list)
         self.sequence_set = set()
+        # sequences of each library, in library order
+        self.library_sequences = [[] for _ in self.sequence_tables]
         self.seq_match_record = defaultdict(list)
         self.non_gene_match_record = defaultdict(list)
-        self.value_frame = pd.DataFrame()
+        self.value_dict = {}
         self.value_frame_column=None
         self.estimated_sgrna_len=None # estimation of sgrna length
+        self.matched_sequences = set()
+        # library sequences by their 3' core (see index_cores)
+        self.core_dict = defaultdict(list)
+        self.core_length = None
+        self.table_lengths = set()
+        # matches of each sequence and site, if sites can be found repeatedly
+        self.match_sites = None
+        # sequences too short to be annotated, or only matched by their 3'
+        # bases
+        self.unsupported = set()
+        self.unverified = set()
+        self.outputs = [sys.stdout]
+        self.reports = [None]
+        # write the matches of sequences while looking them up in an index,
+        # instead of keeping them for write_output
+        self.stream = True
+        self.metrics = PhaseMetrics()
+        # lines scanned, index lookups and matching rows of the annotation tables
+        self.scan_stats = {"lines": 0, "index_lookups": 0, "matches": 0}
 
     def add_value_frame(self,args):
         if args.bedvalue is not None:
-            self.value_frame=pd.read_table(args.bedvalue,index_col=0)
             self.value_frame_column=args.bedvalue_column
             if self.value_frame_column is None:
                 raise SyntaxError("need to specify --bedvalue-column option.")
                 # exit(1)
-            if self.value_frame_column not in self.value_frame:
-                raise SyntaxError(""+args.bedvalue_column+" is not in the columns of "+args.bedvalue+".")
-                #exit(1)
+            # only the sgRNA IDs and the requested column are loaded
+            self.value_dict=read_values(args.bedvalue, self.value_frame_column)
 
     def annotate(self,args):
-        self.sequence_table_import()
-        self.custom_bed_get(args)
-        self.write_output()
+        with self.metrics.phase("import") as phase:
+            self.sequence_table_import()
+            phase["sequences"] = len(self.sequence_dict)
+        try:
+            self.open_outputs(args)
+            with self.metrics.phase("scan", rate="lines") as phase:
+                self.custom_bed_get(args)
+                phase.update(self.scan_stats)
+            with self.metrics.phase("write") as phase:
+                self.write_output()
+                phase["matched_sequences"] = len(self.matched_sequences)
+                phase["unmatched_sequences"] = len(self.sequence_dict) - len(
+                    self.matched_sequences)
+        finally:
+            self.close_outputs()
+        if getattr(args, "metrics", None):
+            self.metrics.write(args.metrics)
+
+    def open_outputs(self, args, libraries=None):
+        """
+        Open the BED files (and reports) given in args, one per library.
+        With libraries (indices into the library files), only these
+        libraries are written.
+        """
+        self.outputs = [None] * len(self.sequence_tables)
+        self.reports = [None] * len(self.sequence_tables)
+        if libraries is None:
+            libraries = range(len(self.sequence_tables))
+        outputs = getattr(args, "output", None) or [None]
+        unmatched = getattr(args, "unmatched", None)
+        if isinstance(outputs, str):
+            outputs, unmatched = [outputs], [unmatched]
+        elif unmatched is None:
+            unmatched = [None] * len(outputs)
+        if len(libraries) != len(outputs) or len(outputs) != len(unmatched):
+            raise SyntaxError("need to specify one --output (and --unmatched) "
+                              "file per library.")
+        compression = getattr(args, "compression", None)
+        # sorted output is collected and written when closed
+        output_class = SortedBedWriter if getattr(args, "sort", False) else open_output
+        for lib, output, report in zip(libraries, outputs, unmatched):
+            self.outputs[lib] = output_class(output, compression)
+            if report:
+                self.reports[lib] = open_output(report)
+                self.reports[lib].write("\t".join(REPORT_COLUMNS) + "\n")
+
+    def close_outputs(self):
+        for f in self.outputs + self.reports:
+            if f is not None:
+                f.close()
+        self.outputs = []
+        self.reports = []
 
     def sequence_table_import(self):
-        with open(self.sequence_table) as csvfile:
-            # [cuiyb]++ to support gRNA library in csv and tab-separated txt format
-            if self.sequence_table.upper().endswith('CSV'):
-                delimiter = ','
-            else:
-                delimiter = '\t'
-            reader = csv.reader(csvfile, delimiter=delimiter) # sgRNAid seq gene_id
-            possible_sg_len={}
-            for elements in reader:
-                self.sequence_dict[elements[1].upper()] = [elements[0],
-                        elements[2].upper()] # 
-                self.sequence_set.add(elements[1].upper())
-                this_sg_len=len(elements[1])
-                if this_sg_len not in possible_sg_len:
-                    possible_sg_len[this_sg_len]=0
-                possible_sg_len[this_sg_len]=possible_sg_len[this_sg_len]+1
-            # estimate the most likely sgrna length
-            if len(possible_sg_len)>1: # a mixture of different sgrna length?
-                logging.warning('The library file contails a mixture of sgRNAs with different lengths.')
-                leninfo=','.join([str(a)+':'+str(b) for (a,b) in possible_sg_len.items()])
-                logging.warning('sgRNA length and count in the library is: '+leninfo)
-            #self.estimated_sgrna_len=max(possible_sg_len.items(),key=operator.itemgetter(1))[0]
-            self.estimated_sgrna_len=[k for k in possible_sg_len.keys()]
-            logging.info('Estimated sgRNA length:'+str(self.estimated_sgrna_len))
+        possible_sg_len={}
+        for lib, sequence_table in enumerate(self.sequence_tables):
+            library_dict = {}
+            with open(sequence_table) as csvfile:
+                # [cuiyb]++ to support gRNA library in csv and tab-separated txt format
+                if sequence_table.upper().endswith('CSV'):
+                    delimiter = ','
+                else:
+                    delimiter = '\t'
+                reader = csv.reader(csvfile, delimiter=delimiter) # sgRNAid seq gene_id
+                for elements in reader:
+                    seq = encode_sequence(elements[1])
+                    library_dict[seq] = [lib, elements[0],
+                            elements[2].upper()] # 
+                    this_sg_len=len(elements[1])
+                    if this_sg_len not in possible_sg_len:
+                        possible_sg_len[this_sg_len]=0
+                    possible_sg_len[this_sg_len]=possible_sg_len[this_sg_len]+1
+            # later entries of a sequence within a library take precedence,
+            # as before; across libraries, all owners are kept
+            for seq, owner in library_dict.items():
+                self.sequence_dict[seq].append(owner)
+                self.sequence_set.add(seq)
+            self.library_sequences[lib] = list(library_dict)
+        # estimate the most likely sgrna length
+        if len(possible_sg_len)>1: # a mixture of different sgrna length?
+            logging.warning('The library file contails a mixture of sgRNAs with different lengths.')
+            leninfo=','.join([str(a)+':'+str(b) for (a,b) in possible_sg_len.items()])
+            logging.warning('sgRNA length and count in the library is: '+leninfo)
+        #self.estimated_sgrna_len=max(possible_sg_len.items(),key=operator.itemgetter(1))[0]
+        self.estimated_sgrna_len=[k for k in possible_sg_len.keys()]
+        logging.info('Estimated sgRNA length:'+str(self.estimated_sgrna_len))
 
 
 
     def custom_bed_get(self,args):
         #library=args.library
-        library=self.sequence_table
 
         annotation_table=args.annotation_table
         assembly=args.assembly
         sgrna_len=args.sgrna_len
+        # annotation tables with the library sgRNA lengths annotated by each
+        # (None: all lengths)
         candidate_file_list=[]
         if sgrna_len=='AUTO':
             sgrna_len=None
         if annotation_table is None: 
             if assembly is None:
                 logging.error('Need to specify the --assembly option if annotation table is not provided.')
-            sgrna_len_candidate=[]
+            sgrna_len_candidate=defaultdict(list)
             if sgrna_len is None: # the sgrna_len is not specified, get from the library
-                #sgrna_len_candidate=self.estimated_sgrna_len
-                for sg_i in self.estimated_sgrna_len: 
-                    if sg_i!=19 and sg_i!=20:
-                        logging.warning('Unsupported sgRNA length: '+str(sg_i)+'. These sgRNAs will not be annotated.')
-                        #exit(0)
-                    else:
-                        sgrna_len_candidate+=[sg_i]
+                # sgRNAs are annotated with the table of their length; other
+                # lengths are matched by their 3' end (see index_cores)
+                for sg_i in self.estimated_sgrna_len:
+                    sgrna_len_candidate[table_sgrna_length(sg_i)].append(sg_i)
             else:
-                sgrna_len_candidate=[sgrna_len] # the sgrna_len is specified
+                sgrna_len_candidate[int(sgrna_len)]=None # the sgrna_len is specified
 
-            for sg_c in sgrna_len_candidate:
+            for sg_c, lengths in sgrna_len_candidate.items():
                 if args.annotation_table_folder is not None:
                     annotation_table_file = (
                         "sgrna_annotation_{assembly}_exome_{len}bp.txt.bz2"
@@ -114,75 +825,242 @@ class Annotator():
                         "downloads/sgrna_annotation_{assembly}_exome_{len}bp.txt.bz2"
                     ).format(assembly=assembly,len=sg_c)
                     logging.info("Downloading files from bitbucket:"+annotation_table)
-                candidate_file_list+=[annotation_table]
+                candidate_file_list+=[(annotation_table, {sg_c}, lengths)]
         else:
             # the annotation table is specified
             logging.info("Using existing annotation library:"+annotation_table)
-            candidate_file_list=[annotation_table]
+            candidate_file_list=[(annotation_table, None, None)]
 
         # self.customized_table=annotation_table
 
 
-        for candidate_file in candidate_file_list:
-            if candidate_file.startswith("http"):
-                file = urlopen(candidate_file)
+        cache = None
+        # the local copy of each table
+        local_files = {f: f for f, _, _ in candidate_file_list}
+        if not getattr(args, "no_cache", True):
+            cache = DownloadCache(args.cache_dir, args.cache_size)
+            for f in local_files:
+                if f.startswith("http"):
+                    local_files[f] = cache.get(f, args.annotation_table_sha256)
+
+        threads = getattr(args, "threads", 1) or 1
+        parser = getattr(args, "parser", "vectorized")
+        # the library sgRNAs annotated by each table are disjoint, hence
+        # each table is scanned (or looked up) on its own
+        for table, table_lengths, lengths in candidate_file_list:
+            candidate_file = local_files[table]
+            if table_lengths is None:
+                table_lengths = table_sequence_lengths(candidate_file)
+            self.index_cores(table_lengths, lengths)
+            if not self.core_dict:
+                continue
+            index = find_index(table, cache)
+            if index is not None and self.core_length < min(self.table_lengths) \
+                    and not candidate_file.endswith(INDEX_SUFFIX):
+                # the index only finds table sequences by their full length
+                logging.info("Not using annotation index {} for sgRNAs shorter "
+                             "than the table sequences.".format(index))
+                index = None
+            if index is not None:
+                logging.info("Using annotation index: "+index)
+                # the matches of a sequence are final right after its lookup
+                self.index_lookup(index, stream=self.stream)
+            elif threads > 1:
+                logging.info("Scanning annotation table {} with {} processes.".format(
+                    candidate_file, threads))
+                for fields in parallel_scan([candidate_file], set(self.core_dict),
+                                            threads, parser, self.scan_stats,
+                                            self.core_length):
+                    self.add_annotation(*fields)
             else:
-                file = open(candidate_file, "rb")
-            if candidate_file.endswith(".bz2"):
-                file = io.BufferedReader(bz2.open(file))
-            elif candidate_file.endswith(".gz"):
-                file = io.BufferedReader(gzip.open(file))
-
-            for i, line in enumerate(file):
-                chr, chrstart, chrend, gene, score, strand, seq = line.decode(
-                ).strip().split("\t")
-                gene = gene.upper()
-                seq = seq.upper()
-                try:
-                    int(chrstart)
-                    int(chrend)
-                    float(score)
-
-                except ValueError:
-                    raise SyntaxError(
-                        "Error parsing line {} in annotation table.".format(i))
-
-                if (seq in self.sequence_set):
-                    # sequence_dict[seq]=(sgRNA_id,gene_id)
-                    library_sg_id=self.sequence_dict[seq][0]
-                    library_gene_id=self.sequence_dict[seq][1]
-                    if self.value_frame_column is not None:
-                        if library_sg_id in self.value_frame.index:
-                            score=self.value_frame[self.value_frame_column][library_sg_id]
-                        else:
-                            score=0
-                        score=str(score)
-                    insert = [chr, chrstart, chrend, library_sg_id,
-                              score, strand]
-                    self.seq_match_record[seq].append(
-                        insert + [gene, library_gene_id, seq])
-
-            # end for i, line in enumerate(file):
+                with open_table(candidate_file) as file:
+                    sequence_filter = SequenceFilter(set(self.core_dict),
+                                                     self.core_length)
+                    for fields in scan_table(file, sequence_filter, parser,
+                                             self.scan_stats):
+                        self.add_annotation(*fields)
         # end for candidate_file in candidate_file_list:
 
-    def write_output(self):
-        for values in self.seq_match_record.values():
+    def index_cores(self, table_lengths, lengths=None):
+        """
+        Index the library sequences of the given lengths (default: all) by
+        their 3' (PAM-proximal) core, which is as long as the shortest
+        library or table sequence. Sequences of any length are thereby
+        resolved with a single scan of one table: the bases beyond the core
+        are verified against the table sequence, bases beyond the table
+        sequence are reported as not verified.
+        """
+        self.table_lengths = set(table_lengths)
+        if lengths is None:
+            lengths = self.estimated_sgrna_len
+        for l in lengths:
+            if l < MIN_CORE_LENGTH:
+                logging.warning('Unsupported sgRNA length: '+str(l)+'. These sgRNAs will not be annotated.')
+        lengths = sorted(l for l in lengths if l >= MIN_CORE_LENGTH)
+        self.core_dict = defaultdict(list)
+        if lengths:
+            self.core_length = max(min(lengths + list(self.table_lengths)),
+                                   MIN_CORE_LENGTH)
+            longer = [l for l in lengths if l > max(self.table_lengths)]
+            if longer:
+                logging.warning("sgRNAs of length {} are longer than the annotation "
+                                "table sequences ({}bp), their remaining 5' bases are "
+                                "not verified.".format(
+                                    ",".join(map(str, longer)), max(self.table_lengths)))
+            logging.info("Matching sgRNAs of length {} by their 3' {}bp.".format(
+                ",".join(map(str, lengths)), self.core_length))
+        lengths = set(lengths)
+        for seq in self.sequence_dict:
+            length = sequence_length(seq)
+            if length < MIN_CORE_LENGTH:
+                self.unsupported.add(seq)
+            elif length in lengths:
+                self.core_dict[sequence_suffix(seq, self.core_length)].append(seq)
+        # with table sequences of several lengths, a site can be found by
+        # each of them
+        self.match_sites = {} if len(self.table_lengths) > 1 else None
+
+    def index_lookup(self, index, stream=False):
+        # a sequence is only final after its lookup if no other library
+        # sequence shares its core
+        stream = stream and all(len(seqs) == 1 for seqs in self.core_dict.values())
+        if self.core_length < min(self.table_lengths):
+            raise SyntaxError(
+                "sgRNAs of {}bp are shorter than the sequences of annotation "
+                "index {} ({}bp) and cannot be looked up. Use the annotation "
+                "table instead.".format(self.core_length, index,
+                                        min(self.table_lengths)))
+        looked_up = set()
+        with AnnotationIndex(index) as idx:
+            for seqs in self.core_dict.values():
+                for seq in seqs:
+                    # the index finds table sequences by their full length
+                    for length in sorted(self.table_lengths):
+                        if not self.core_length <= length <= sequence_length(seq):
+                            continue
+                        key = sequence_suffix(seq, length)
+                        if key in looked_up:
+                            continue
+                        looked_up.add(key)
+                        self.scan_stats["index_lookups"] += 1
+                        for i, line in enumerate(idx.lookup(decode_sequence(key))):
+                            self.add_annotation(*parse_line(line, i))
+                    if stream and seq in self.seq_match_record:
+                        self.write_record(seq, self.seq_match_record.pop(seq))
+
+    def add_annotation(self, chr, chrstart, chrend, gene, score, strand, seq):
+        code = encode_sequence(seq)
+        length = sequence_length(code)
+        if length < self.core_length:
+            return
+        for library_seq in self.core_dict.get(sequence_suffix(code, self.core_length), ()):
+            library_length = sequence_length(library_seq)
+            common = min(library_length, length)
+            if sequence_suffix(library_seq, common) != sequence_suffix(code, common):
+                continue
+            # sgRNA ids and scores are filled in per library when writing
+            record = [chr, chrstart, chrend, score, strand, gene.upper(),
+                      seq.upper(), max(library_length - length, 0)]
+            if library_length != length:
+                # move the 5' end of the site to the one of the library sequence
+                shift = length - library_length
+                if strand == "-":
+                    record[2] = str(int(chrend) - shift)
+                else:
+                    record[1] = str(int(chrstart) + shift)
+                record[6] = decode_sequence(library_seq)
+            if self.match_sites is not None:
+                site = (library_seq, chr, record[1], record[2], strand)
+                previous = self.match_sites.get(site)
+                if previous is not None:
+                    # keep the match verifying the most bases
+                    if record[7] < previous[7]:
+                        previous[:] = record
+                    continue
+                self.match_sites[site] = record
+            self.scan_stats["matches"] += 1
+            self.seq_match_record[library_seq].append(record)
+
+    def write_record(self, seq, values):
+        """
+        Write the BED lines of all matches of a sequence to each library
+        containing it.
+        """
+        self.matched_sequences.add(seq)
+        # bases of the library sequence that no match could verify; matches
+        # verifying fewer bases (e.g. partial matches of shorter table
+        # sequences besides a full-length match) are dropped
+        unverified = min(i[7] for i in values)
+        values = [i for i in values if i[7] == unverified]
+        if unverified:
+            self.unverified.add(seq)
+        for lib, library_sg_id, library_gene_id in self.sequence_dict[seq]:
+            output = self.outputs[lib]
+            report = self.reports[lib]
+            if output is None:
+                continue
             record = 0
             for i in values:
-                if i[6] == i[7]:
-                    print("{0}".format("\t".join(i[:6])))
+                score = i[3]
+                if self.value_frame_column is not None:
+                    score = self.value_dict.get(library_sg_id, "0")
+                line = "\t".join(i[:3] + [library_sg_id, score, i[4]]) + "\n"
+                if i[5] == library_gene_id:
+                    output.write(line)
                     record = 1
 
             if record == 0:
-                print("{0}".format("\t".join(i[:6])))
-                logging.warning("{0}".format("\t".join(
-                    ["Warning: gene not matched"] + [i[k] for k in [3, 8, 7]] +
-                    ["|"] + [i[k] for k in [0, 1, 2, 6]])))
-
-        for j in [i for i in self.sequence_dict.keys()
-            if i not in self.seq_match_record.keys()]:
-                temp = self.sequence_dict[j]
-                logging.warning("{0}".format("\t".join(["Warning: sequence not found", temp[0],j, temp[1]])))
-
+                output.write(line)
+                if report is not None:
+                    report.write("\t".join(
+                        ["gene not matched", library_sg_id, i[6], library_gene_id] +
+                        i[:3] + [i[5]]) + "\n")
+                else:
+                    logging.warning("{0}".format("\t".join(
+                        ["Warning: gene not matched", library_sg_id, i[6],
+                         library_gene_id, "|"] + i[:3] + [i[5]])))
+            if unverified and report is not None:
+                report.write("\t".join(
+                    ["{} bases not verified".format(unverified), library_sg_id,
+                     values[0][6], library_gene_id] + values[0][:3] +
+                    [values[0][5]]) + "\n")
 
+    def write_output(self, keep=False):
+        """
+        Write the matches and the unmatched sequences of all libraries with
+        an open output. With keep, the matches are kept, such that they can
+        be written again.
+        """
+        for seq, values in self.seq_match_record.items():
+            self.write_record(seq, values)
+        if not keep:
+            self.seq_match_record.clear()
 
+        for lib, sequences in enumerate(self.library_sequences):
+            if self.outputs[lib] is None:
+                continue
+            report = self.reports[lib]
+            unmatched = 0
+            for j in sequences:
+                if j in self.matched_sequences:
+                    continue
+                unmatched += 1
+                temp = next(owner[1:] for owner in self.sequence_dict[j]
+                            if owner[0] == lib)
+                reason = ("length not supported" if j in self.unsupported
+                          else "sequence not found")
+                if report is not None:
+                    report.write("\t".join(
+                        [reason, temp[0], decode_sequence(j), temp[1]] +
+                        [""] * 4) + "\n")
+                else:
+                    logging.warning("{0}".format("\t".join(["Warning: "+reason, temp[0],decode_sequence(j), temp[1]])))
+            if report is not None and unmatched:
+                logging.warning("{} of {} sequences of library {} were not found "
+                                "in the annotation table.".format(
+                                    unmatched, len(sequences),
+                                    self.sequence_tables[lib]))
+        if self.unverified:
+            logging.warning("{} sequences were only matched by their 3' bases, "
+                            "their 5' bases could not be verified.".format(
+                                len(self.unverified)))
@@ -0,0 +1,202 @@
+__author__ = "Chen-Hao Chen"
+__copyright__ = "Copyright 2015, Chen-Hao Chen, Liu lab"
+__email__ = "hyalin1127@gmail.com"
+__license__ = "MIT"
+
+"""
+Sequence-keyed on-disk index for sgRNA annotation tables.
+
+The index file consists of a fixed size header, a table of sorted sequence
+keys and a data section holding the original (uncompressed) annotation lines
+grouped by sequence. The key table is searched by bisection on a memory map,
+so only the pages touched by the lookups are ever read from disk.
+"""
+
+import os
+import mmap
+import struct
+import shutil
+import logging
+import tempfile
+
+
+INDEX_MAGIC = b"MVAIDX01"
+INDEX_SUFFIX = ".idx"
+# name of the index of a downloaded table in the download cache
+CACHED_INDEX = "annotation" + INDEX_SUFFIX
+
+# magic, key width, number of keys, offset of the data section
+_HEADER = struct.Struct("<8sIQQ")
+
+
+def _entry_struct(key_width):
+    # padded sequence, offset into data section, length of the line block
+    return struct.Struct("<{}sQI".format(key_width))
+
+
+def index_path(table):
+    """
+    Return the path of the index belonging to the given annotation table.
+    """
+    return table + INDEX_SUFFIX
+
+
+def find_index(table, cache=None):
+    """
+    Return the path to an up-to-date index of the given annotation table, or
+    None if there is none. The index of a downloaded table is looked up next
+    to its copy in the given download cache.
+    """
+    if table.startswith("http"):
+        blob = cache.cached(table) if cache is not None else None
+        return None if blob is None else cache.derived(blob, CACHED_INDEX)
+    if table.endswith(INDEX_SUFFIX):
+        return table
+    path = index_path(table)
+    if os.path.exists(path):
+        if os.path.exists(table) and os.path.getmtime(path) < os.path.getmtime(table):
+            logging.warning("Ignoring outdated annotation index " + path + ".")
+            return None
+        return path
+    return None
+
+
+def parse_line(line, i):
+    """
+    Split and validate a raw annotation table line.
+    """
+    try:
+        chr, chrstart, chrend, gene, score, strand, seq = line.decode(
+        ).strip().split("\t")
+        int(chrstart)
+        int(chrend)
+        float(score)
+    except ValueError:
+        raise SyntaxError(
+            "Error parsing line {} in annotation table.".format(i))
+    return chr, chrstart, chrend, gene, score, strand, seq
+
+
+def build_index(lines, output, prefix_len=3):
+    """
+    Build an index from an iterable of raw annotation table lines.
+
+    Lines are first distributed into temporary buckets by sequence prefix,
+    such that each bucket can be sorted in memory on its own.
+    """
+    tmpdir = tempfile.mkdtemp(prefix="mageck-vispr-index-",
+                              dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        buckets = {}
+        key_width = 0
+        nlines = 0
+        for i, line in enumerate(lines):
+            seq = parse_line(line, i)[6].upper().encode()
+            if not line.endswith(b"\n"):
+                line += b"\n"
+            prefix = seq[:prefix_len]
+            bucket = buckets.get(prefix)
+            if bucket is None:
+                bucket = buckets[prefix] = open(
+                    os.path.join(tmpdir, "{}.bucket".format(len(buckets))),
+                    "w+b")
+            bucket.write(seq + b"\t" + line)
+            key_width = max(key_width, len(seq))
+            nlines = i + 1
+
+        entry = _entry_struct(key_width)
+        n_keys = 0
+        data_offset = 0
+        with open(os.path.join(tmpdir, "data"), "w+b") as data, \
+                open(output + ".tmp", "wb") as out:
+            out.write(_HEADER.pack(INDEX_MAGIC, key_width, 0, 0))
+            for prefix in sorted(buckets, key=lambda p: p.ljust(key_width)):
+                bucket = buckets[prefix]
+                bucket.seek(0)
+                records = [record.split(b"\t", 1) for record in bucket]
+                bucket.close()
+                records.sort(key=lambda r: r[0].ljust(key_width))
+                current = None
+                start = data_offset
+                for seq, line in records:
+                    if seq != current:
+                        if current is not None:
+                            out.write(entry.pack(current.ljust(key_width),
+                                                 start, data_offset - start))
+                            n_keys += 1
+                        current = seq
+                        start = data_offset
+                    data.write(line)
+                    data_offset += len(line)
+                if current is not None:
+                    out.write(entry.pack(current.ljust(key_width), start,
+                                         data_offset - start))
+                    n_keys += 1
+            data_start = out.tell()
+            data.seek(0)
+            shutil.copyfileobj(data, out)
+            out.seek(0)
+            out.write(_HEADER.pack(INDEX_MAGIC, key_width, n_keys, data_start))
+        os.replace(output + ".tmp", output)
+        logging.info("Indexed {} annotation lines with {} distinct "
+                     "sequences into {}.".format(nlines, n_keys, output))
+    finally:
+        for bucket in buckets.values():
+            bucket.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+class AnnotationIndex():
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.key_width, self.n_keys, self.data_offset = _HEADER.unpack_from(
+            self.mmap, 0)
+        if magic != INDEX_MAGIC:
+            raise SyntaxError("{} is not a valid annotation index.".format(path))
+        self.entry = _entry_struct(self.key_width)
+        self.entry_size = self.entry.size
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _key(self, i):
+        pos = _HEADER.size + i * self.entry_size
+        return self.mmap[pos:pos + self.key_width]
+
+    def key_lengths(self, sample=1000):
+        """
+        Return the set of sequence lengths among (at most) sample evenly
+        spaced keys.
+        """
+        step = max(self.n_keys // sample, 1)
+        return {len(self._key(i).rstrip()) for i in range(0, self.n_keys, step)}
+
+    def lookup(self, seq):
+        """
+        Return the raw annotation lines for the given sequence.
+        """
+        key = seq.upper().encode().ljust(self.key_width)
+        if len(key) > self.key_width:
+            return []
+        lo, hi = 0, self.n_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.n_keys or self._key(lo) != key:
+            return []
+        _, offset, length = self.entry.unpack_from(
+            self.mmap, _HEADER.size + lo * self.entry_size)
+        start = self.data_offset + offset
+        return self.mmap[start:start + length].splitlines()
@@ -0,0 +1,397 @@
+__author__ = "Chen-Hao Chen"
+__copyright__ = "Copyright 2015, Chen-Hao Chen, Liu lab"
+__email__ = "hyalin1127@gmail.com"
+__license__ = "MIT"
+
+"""
+Long-running server for annotate-library and rescore-annotation.
+
+Annotating a library needs parsing the library and scanning (or looking up)
+the annotation table, rescoring needs reading the annotated BED file. The
+server does this once and keeps the matches of the annotated libraries and
+the records of the rescored BED files in memory, as long as the files are
+unchanged. Commands are sent over a Unix socket as JSON lines holding the
+command and its (absolute) arguments. Requests are answered concurrently,
+such that e.g. a ping does not wait for a library being loaded. The server
+writes the output files under temporary names next to them and answers
+with {"status": "ok", "outputs": [[temporary, path], ...]} or
+{"status": "error", "message": ...}; the client moves the temporary files
+into place. Clients run the command themselves if no server is running or
+the server fails, which is safe as the server never writes the output
+files themselves.
+"""
+
+import os
+import glob
+import json
+import uuid
+import signal
+import socket
+import logging
+import argparse
+import threading
+import socketserver
+from collections import OrderedDict
+
+from mageck_vispr.annotation import Annotator, iter_bed, rescore_bed
+from mageck_vispr.annotation_index import index_path
+from mageck_vispr.metrics import PhaseMetrics
+from mageck_vispr import ANNOTATION_SOCKET as DEFAULT_SOCKET
+
+
+# options of annotate-library that select the annotation table
+TABLE_OPTIONS = ("annotation_table", "annotation_table_folder", "assembly",
+                 "sgrna_len", "parser", "annotation_table_sha256", "cache_dir",
+                 "cache_size", "no_cache")
+# arguments holding local paths, which are made absolute by the client
+PATH_OPTIONS = ("library", "annotation_table", "annotation_table_folder",
+                "output", "unmatched", "metrics", "bedvalue", "bed",
+                "cache_dir")
+# arguments holding the paths of output files, which the server writes
+# under temporary names
+OUTPUT_OPTIONS = ("output", "unmatched", "metrics")
+# seconds to wait for the server to answer; a cold scan of a genome-wide
+# table can take several minutes
+REQUEST_TIMEOUT = 3600
+# number of annotators and rescored BED files kept in memory
+MAX_ANNOTATORS = 4
+MAX_BEDS = 16
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _table_files(args):
+    # local annotation tables (and their indexes) the matches are taken from
+    table = getattr(args, "annotation_table", None)
+    if table is not None and not table.startswith("http"):
+        return [table, index_path(table)]
+    folder = getattr(args, "annotation_table_folder", None)
+    if folder is not None:
+        return sorted(glob.glob(os.path.join(folder, "sgrna_annotation_*")))
+    return []
+
+
+def table_key(args):
+    """
+    Return the annotation table options of args, with the size and
+    modification time of the local tables, such that changed tables are
+    loaded again.
+    """
+    return [getattr(args, option, None) for option in TABLE_OPTIONS] + [
+        [path] + _stamp(path) for path in _table_files(args)
+        if os.path.exists(path)]
+
+
+def _temporary(path):
+    # keeps the suffix, which e.g. selects the compression of the output
+    head, tail = os.path.split(path)
+    return os.path.join(head, ".{}.{}".format(uuid.uuid4().hex[:16], tail))
+
+
+def temporary_outputs(args):
+    """
+    Return a copy of the given arguments writing to temporary files next to
+    the outputs, and the list of (temporary file, output) pairs.
+    """
+    args = argparse.Namespace(**vars(args))
+    outputs = []
+    for option in OUTPUT_OPTIONS:
+        value = getattr(args, option, None)
+        if value is None or value == "-":
+            continue
+        paths = [_temporary(path) for path in
+                 (value if isinstance(value, list) else [value])]
+        outputs.extend(zip(paths, value if isinstance(value, list) else [value]))
+        setattr(args, option, paths if isinstance(value, list) else paths[0])
+    return args, outputs
+
+
+def _written(outputs):
+    # the temporary files that were written, with the tabix index of sorted
+    # and compressed BED files
+    written = []
+    for temporary, path in outputs:
+        for suffix in ("", ".tbi"):
+            if os.path.exists(temporary + suffix):
+                written.append([temporary + suffix, path + suffix])
+    return written
+
+
+def _remove(outputs):
+    for temporary, _ in outputs:
+        try:
+            os.remove(temporary)
+        except FileNotFoundError:
+            pass
+
+
+class AnnotationServer():
+    def __init__(self):
+        # annotators by number, least recently used first; each entry holds
+        # the annotation table options, the libraries and the stamps of the
+        # tables and libraries it was loaded with
+        self.annotators = OrderedDict()
+        self.loaded = 0
+        # records of rescored BED files: path -> (stamp, records), least
+        # recently used first
+        self.beds = OrderedDict()
+        # guards both of the above; each annotator has its own lock
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _state(args, libraries):
+        return table_key(args), {lib: _stamp(lib) for lib in libraries}
+
+    def _entry(self, args):
+        """
+        Return the entry of an annotator for the libraries and annotation
+        table given in args, which is created (but not loaded) if there is
+        none. Entries of changed tables or libraries are replaced.
+        """
+        options = [getattr(args, option, None) for option in TABLE_OPTIONS]
+        with self.lock:
+            for number, entry in list(self.annotators.items()):
+                if entry["options"] != options or \
+                        not set(args.library) <= set(entry["libraries"]):
+                    continue
+                if entry["state"] != self._state(args, entry["libraries"]):
+                    logging.info("Annotation of {} is outdated.".format(
+                        ", ".join(entry["libraries"])))
+                    del self.annotators[number]
+                    continue
+                self.annotators.move_to_end(number)
+                return entry
+            # taken before loading, a table changed meanwhile is loaded again
+            entry = {"options": options, "libraries": list(args.library),
+                     "state": self._state(args, args.library),
+                     "annotator": None, "lock": threading.Lock()}
+            self.loaded += 1
+            self.annotators[self.loaded] = entry
+            while len(self.annotators) > MAX_ANNOTATORS:
+                self.annotators.popitem(last=False)
+            return entry
+
+    def _discard(self, entry):
+        with self.lock:
+            for number, other in list(self.annotators.items()):
+                if other is entry:
+                    del self.annotators[number]
+
+    def load(self, args):
+        """
+        Annotate the libraries given in args with a single scan of the
+        annotation table, and keep the matches. Returns the entry of the
+        annotator.
+        """
+        entry = self._entry(args)
+        with entry["lock"]:
+            if entry["annotator"] is None:
+                try:
+                    entry["annotator"] = self._load(args)
+                except Exception:
+                    self._discard(entry)
+                    raise
+        return entry
+
+    @staticmethod
+    def _load(args):
+        annotator = Annotator(args.library)
+        # all matches are kept for write_output
+        annotator.stream = False
+        with annotator.metrics.phase("import"):
+            annotator.sequence_table_import()
+        with annotator.metrics.phase("scan") as phase:
+            annotator.custom_bed_get(args)
+            phase.update(annotator.scan_stats)
+        logging.info("Loaded annotation of {}.".format(", ".join(args.library)))
+        return annotator
+
+    def annotate(self, args):
+        metrics = PhaseMetrics()
+        with metrics.phase("scan"):
+            entry = self.load(args)
+        # the annotator is shared by all requests for its libraries
+        with entry["lock"]:
+            annotator = entry["annotator"]
+            if annotator is None:
+                # discarded by a concurrent request whose load failed
+                raise RuntimeError("Annotation of {} failed.".format(
+                    ", ".join(args.library)))
+            libraries = [annotator.sequence_tables.index(lib)
+                         for lib in args.library]
+            annotator.value_frame_column = None
+            annotator.value_dict = {}
+            annotator.add_value_frame(args)
+            with metrics.phase("write") as phase:
+                try:
+                    annotator.open_outputs(args, libraries)
+                    annotator.write_output(keep=True)
+                finally:
+                    annotator.close_outputs()
+                phase["server"] = True
+        if getattr(args, "metrics", None):
+            metrics.write(args.metrics)
+
+    def rescore(self, args):
+        stamp = _stamp(args.bed)
+        with self.lock:
+            cached = self.beds.get(args.bed)
+            if cached is not None:
+                self.beds.move_to_end(args.bed)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, list(iter_bed(args.bed)))
+            with self.lock:
+                self.beds[args.bed] = cached
+                while len(self.beds) > MAX_BEDS:
+                    self.beds.popitem(last=False)
+        rescore_bed(args.bed, args.bedvalue, args.bedvalue_column, args.output,
+                    records=cached[1])
+
+    def handle(self, request):
+        """
+        Run the given request, writing to temporary files. Returns the
+        list of written temporary files with the paths they belong to.
+        """
+        args = argparse.Namespace(**request["args"])
+        if request["command"] == "ping":
+            return []
+        if request["command"] not in ("annotate", "rescore"):
+            raise ValueError("Unknown command {}.".format(request["command"]))
+        args, outputs = temporary_outputs(args)
+        try:
+            if request["command"] == "annotate":
+                self.annotate(args)
+            else:
+                self.rescore(args)
+            return _written(outputs)
+        except BaseException:
+            _remove(_written(outputs))
+            raise
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            outputs = []
+            try:
+                outputs = self.server.annotation_server.handle(json.loads(line))
+                response = {"status": "ok", "outputs": outputs}
+            except Exception as e:
+                logging.exception("Request failed.")
+                response = {"status": "error", "message": str(e)}
+            try:
+                self.wfile.write((json.dumps(response) + "\n").encode())
+            except OSError:
+                # the client gave up and runs the command itself
+                logging.warning("Client left before the answer, discarding "
+                                "its output.")
+                _remove(outputs)
+                return
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def make_server(socket_path=DEFAULT_SOCKET, preload=None):
+    """
+    Return a server listening on the given socket, see serve.
+    """
+    if os.path.exists(socket_path):
+        if request(socket_path, "ping", argparse.Namespace(), timeout=10):
+            raise RuntimeError("An annotation server is already listening "
+                               "on {}.".format(socket_path))
+        # left behind by a server that was killed
+        os.remove(socket_path)
+    annotation_server = AnnotationServer()
+    if preload is not None:
+        annotation_server.load(preload)
+    if os.path.dirname(socket_path):
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    server = _Server(socket_path, _Handler)
+    server.annotation_server = annotation_server
+    return server
+
+
+def serve(socket_path=DEFAULT_SOCKET, preload=None):
+    """
+    Answer requests on the given socket until interrupted. preload are
+    the arguments of libraries to annotate at startup (with absolute
+    paths, see absolute_paths).
+    """
+    with make_server(socket_path, preload) as server:
+        signal.signal(signal.SIGTERM, _raise_interrupt)
+        logging.info("Serving annotations on {}.".format(socket_path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+
+
+def _absolute(value):
+    if value is None or value == "-" or value.startswith("http"):
+        return value
+    return os.path.abspath(value)
+
+
+def absolute_paths(args):
+    """
+    Return a copy of the given arguments with absolute local paths.
+    """
+    args = argparse.Namespace(**vars(args))
+    for option in PATH_OPTIONS:
+        value = getattr(args, option, None)
+        if isinstance(value, list):
+            setattr(args, option, [_absolute(v) for v in value])
+        elif isinstance(value, str):
+            setattr(args, option, _absolute(value))
+    return args
+
+
+def request(socket_path, command, args, timeout=REQUEST_TIMEOUT):
+    """
+    Send a command with the given arguments (as parsed by the command line
+    interface) to the server listening on socket_path, and move the files
+    it wrote into place. Returns False if no server is running, the server
+    failed or did not answer within timeout seconds, i.e. if the command
+    still has to be run.
+    """
+    if socket_path is None or not os.path.exists(socket_path):
+        return False
+    args = vars(absolute_paths(args))
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(socket_path)
+            client.sendall((json.dumps({"command": command, "args": args}) +
+                            "\n").encode())
+            with client.makefile("rb") as f:
+                response = json.loads(f.readline())
+    except socket.timeout:
+        logging.warning("Annotation server {} did not answer within {} "
+                        "seconds.".format(socket_path, timeout))
+        return False
+    except (OSError, ValueError) as e:
+        logging.info("Annotation server {} is not available ({}).".format(
+            socket_path, e))
+        return False
+    if response["status"] != "ok":
+        logging.warning("Annotation server failed: {}".format(response["message"]))
+        return False
+    try:
+        for temporary, path in response["outputs"]:
+            os.replace(temporary, path)
+    except OSError as e:
+        logging.warning("Output of the annotation server is missing "
+                        "({}).".format(e))
+        return False
+    return True
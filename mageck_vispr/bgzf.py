@@ -0,0 +1,150 @@
+__author__ = "Chen-Hao Chen"
+__copyright__ = "Copyright 2015, Chen-Hao Chen, Liu lab"
+__email__ = "hyalin1127@gmail.com"
+__license__ = "MIT"
+
+"""
+Writer and reader for the blocked gzip format (BGZF) used by bgzip and tabix.
+
+A BGZF file is a series of gzip members of at most 64 KB each, followed by
+an empty end-of-file member. It can be read by any gzip decompressor, while
+the block structure allows random access through virtual file offsets.
+"""
+
+import io
+import zlib
+import struct
+
+
+# maximum amount of uncompressed data per block (as used by htslib)
+BLOCK_DATA_SIZE = 0xff00
+MAX_BLOCK_SIZE = 1 << 16
+
+# gzip header with the BC extra subfield holding the block size
+_HEADER = struct.Struct("<BBBBIBBHBBHH")
+_FOOTER = struct.Struct("<II")
+EOF_BLOCK = bytes.fromhex(
+    "1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def _block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    size = _HEADER.size + len(cdata) + _FOOTER.size
+    if size > MAX_BLOCK_SIZE:
+        # incompressible data, split it up
+        half = len(data) // 2
+        return _block(data[:half], level) + _block(data[half:], level)
+    return (_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, size - 1) +
+            cdata + _FOOTER.pack(zlib.crc32(data), len(data)))
+
+
+class BgzfWriter(io.RawIOBase):
+    def __init__(self, path, level=6):
+        self.file = open(path, "wb")
+        self.level = level
+        self.buffer = bytearray()
+        # compressed offset of the block that is currently filled
+        self.block_address = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BLOCK_DATA_SIZE:
+            self._flush_block(bytes(self.buffer[:BLOCK_DATA_SIZE]))
+            del self.buffer[:BLOCK_DATA_SIZE]
+        return len(data)
+
+    def _flush_block(self, data):
+        block = _block(data, self.level)
+        self.file.write(block)
+        self.block_address += len(block)
+
+    def virtual_offset(self):
+        """
+        Return the virtual offset of the next byte that will be written.
+        """
+        return (self.block_address << 16) | len(self.buffer)
+
+    def flush_block(self):
+        """
+        End the current block, such that the next byte starts a new one.
+        """
+        if self.buffer:
+            self._flush_block(bytes(self.buffer))
+            self.buffer.clear()
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush_block()
+        self.file.write(EOF_BLOCK)
+        self.file.close()
+        super().close()
+
+
+class BgzfReader():
+    """
+    Reader of BGZF files that can seek to virtual file offsets.
+    """
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self._load(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def _load(self, address):
+        self.file.seek(address)
+        header = self.file.read(_HEADER.size)
+        self.block_address = address
+        self.pos = 0
+        if len(header) < _HEADER.size:
+            self.data = b""
+            self.next_address = address
+            return
+        size = _HEADER.unpack(header)[-1] + 1
+        block = self.file.read(size - _HEADER.size)
+        self.data = zlib.decompress(block[:-_FOOTER.size], -15)
+        self.next_address = address + size
+
+    def seek(self, virtual_offset):
+        # the chunks of a query often start in the block that is loaded
+        if virtual_offset >> 16 != self.block_address:
+            self._load(virtual_offset >> 16)
+        self.pos = virtual_offset & 0xffff
+
+    def _advance(self):
+        # skip exhausted (and empty) blocks; returns False at the end of file
+        while self.pos >= len(self.data):
+            if self.next_address == self.block_address:
+                return False
+            self._load(self.next_address)
+        return True
+
+    def tell(self):
+        """
+        Return the virtual offset of the next byte that will be read.
+        """
+        self._advance()
+        return (self.block_address << 16) | self.pos
+
+    def readline(self):
+        parts = []
+        while self._advance():
+            end = self.data.find(b"\n", self.pos)
+            if end != -1:
+                parts.append(self.data[self.pos:end + 1])
+                self.pos = end + 1
+                break
+            parts.append(self.data[self.pos:])
+            self.pos = len(self.data)
+        return b"".join(parts)
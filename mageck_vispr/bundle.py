@@ -0,0 +1,161 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2015, Johannes Köster, Liu lab"
+__email__ = "koester@jimmy.harvard.edu"
+__license__ = "MIT"
+
+"""
+Columnar data bundle of an experiment for VISPR.
+
+The text results of an experiment are converted once into Parquet files
+with typed columns, indexed by gene or sgRNA, such that VISPR can load
+(or memory map) them without parsing the text files at startup:
+
+    genes.parquet           gene summary, indexed by gene
+    sgrnas.parquet          sgRNA summary, indexed by sgRNA
+    counts.parquet          normalized counts, indexed by sgRNA
+    annotation.parquet      sgRNA annotation (BED), indexed by sgRNA
+    fastqc/{module}.parquet FastQC modules of all reports (pairedfastqc/
+                            for the second mates)
+    bundle.yaml             tables of the bundle and their index columns
+
+Writing bundles needs the optional pyarrow package.
+"""
+
+import os
+import re
+import logging
+
+import yaml
+import pandas as pd
+
+
+BED_COLUMNS = ["chrom", "start", "end", "sgrna", "score", "strand"]
+# columns with few distinct values that are stored dictionary encoded
+CATEGORICAL_COLUMNS = {"Gene", "chrom", "strand"}
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("Writing VISPR bundles requires the pyarrow package "
+                          "(e.g. conda install pyarrow).")
+
+
+def _optimize(table):
+    for column in CATEGORICAL_COLUMNS.intersection(table.columns):
+        table[column] = table[column].astype("category")
+    return table
+
+
+def _write(table, path):
+    _optimize(table).to_parquet(path, engine="pyarrow")
+
+
+def read_fastqc_modules(path):
+    """
+    Return the modules of a fastqc_data.txt file as dict of data frames
+    (with string columns).
+    """
+    modules = {}
+    name = header = rows = None
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith(">>END_MODULE"):
+                if header is not None:
+                    modules[name] = pd.DataFrame(rows, columns=header)
+                name = header = rows = None
+            elif line.startswith(">>"):
+                name = line[2:].split("\t")[0]
+                rows = []
+            elif line.startswith("#") and name is not None and header is None:
+                header = line[1:].split("\t")
+            elif name is not None and header is not None:
+                rows.append(line.split("\t"))
+    return modules
+
+
+def _typed(table, skip=()):
+    # convert numeric columns (e.g. qualities and counts), keep the others
+    # as strings
+    for column in table.columns:
+        if column in skip:
+            continue
+        try:
+            table[column] = pd.to_numeric(table[column])
+        except (ValueError, TypeError):
+            table[column] = table[column].astype(str)
+    return table
+
+
+def module_file(module):
+    return re.sub(r"[^a-z0-9]+", "_", module.lower()).strip("_") + ".parquet"
+
+
+def _write_fastqc(path, name, reports):
+    modules = {}
+    for sample, sample_reports in reports.items():
+        for report in sample_reports:
+            for module, table in read_fastqc_modules(report).items():
+                table.insert(0, "report", os.path.basename(os.path.dirname(report)))
+                table.insert(0, "sample", sample)
+                modules.setdefault(module, []).append(table)
+    os.makedirs(os.path.join(path, name), exist_ok=True)
+    tables = {}
+    for module, module_tables in modules.items():
+        f = os.path.join(name, module_file(module))
+        table = _typed(pd.concat(module_tables, ignore_index=True),
+                       skip=("sample", "report"))
+        table["sample"] = table["sample"].astype(str).astype("category")
+        table["report"] = table["report"].astype("category")
+        _write(table.set_index("sample"), os.path.join(path, f))
+        tables[module] = {"file": f, "index": "sample"}
+    return tables
+
+
+def write_bundle(path, results, sgrna_results, counts, annotation=None,
+                 fastqc=None, pairedfastqc=None):
+    """
+    Write the bundle of an experiment to the directory path. fastqc and
+    pairedfastqc are dicts of sample names to lists of fastqc_data.txt
+    files. Returns the description of the bundle, which is also stored in
+    bundle.yaml.
+    """
+    _require_pyarrow()
+    os.makedirs(path, exist_ok=True)
+    tables = {}
+
+    genes = pd.read_csv(results, sep="\t")
+    # RRA uses id, MLE Gene as name of the first column
+    genes = genes.set_index(genes.columns[0])
+    _write(genes, os.path.join(path, "genes.parquet"))
+    tables["genes"] = {"file": "genes.parquet", "index": genes.index.name}
+
+    sgrnas = pd.read_csv(sgrna_results, sep="\t")
+    sgrnas = sgrnas.set_index(sgrnas.columns[0])
+    _write(sgrnas, os.path.join(path, "sgrnas.parquet"))
+    tables["sgrnas"] = {"file": "sgrnas.parquet", "index": sgrnas.index.name}
+
+    counts = pd.read_csv(counts, sep="\t")
+    counts = counts.set_index(counts.columns[0])
+    _write(counts, os.path.join(path, "counts.parquet"))
+    tables["counts"] = {"file": "counts.parquet", "index": counts.index.name}
+
+    if annotation:
+        bed = pd.read_csv(annotation, sep="\t", header=None,
+                          names=BED_COLUMNS, usecols=range(len(BED_COLUMNS)),
+                          dtype={"chrom": str, "sgrna": str, "strand": str})
+        bed = bed.set_index("sgrna")
+        _write(bed, os.path.join(path, "annotation.parquet"))
+        tables["annotation"] = {"file": "annotation.parquet", "index": "sgrna"}
+
+    for name, reports in (("fastqc", fastqc), ("pairedfastqc", pairedfastqc)):
+        if reports:
+            tables[name] = _write_fastqc(path, name, reports)
+
+    description = {"format": "parquet", "tables": tables}
+    with open(os.path.join(path, "bundle.yaml"), "w") as out:
+        yaml.dump(description, out, default_flow_style=False)
+    logging.info("Wrote VISPR bundle {}.".format(path))
+    return description
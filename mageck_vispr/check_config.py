@@ -5,6 +5,17 @@ __license__ = "MIT"
 
 import os
 import sys
+import json
+import stat
+from concurrent.futures import ThreadPoolExecutor
+
+
+# threads used to check the existence of files, which is dominated by the
+# latency of network file systems
+PATH_CHECK_THREADS = 32
+# cache of validated files used by the workflow, relative to its working
+# directory
+PATH_CACHE = os.path.join(".snakemake", "mageck-vispr", "validated_paths.json")
 
 
 class ConfigError(Exception):
@@ -13,48 +24,51 @@ class ConfigError(Exception):
         super().__init__("Error in configuration file{}: {}".format(entry, msg))
 
 
-def is_file(key, entry):
-    if not os.path.exists(str(entry)):
+def is_file(key, entry, paths=None):
+    # with a list of paths, files are collected and checked at once
+    if paths is not None:
+        paths.append((key, str(entry)))
+    elif not os.path.exists(str(entry)):
         raise ConfigError("File does not exist.", key, entry)
 
 
-def is_str(key, entry):
+def is_str(key, entry, paths=None):
     if not isinstance(entry, str):
         raise ConfigError("Expecting a string.", key, entry)
 
 
-def is_bool(key, entry):
+def is_bool(key, entry, paths=None):
     if not isinstance(entry, bool):
         raise ConfigError("Expecting a string.", key, entry)
 
 
-def is_int(key, entry):
+def is_int(key, entry, paths=None):
     if not isinstance(entry, int):
         raise ConfigError("Expecting an integer.", key, entry)
 
-def is_str_or_int(key, entry):
+def is_str_or_int(key, entry, paths=None):
     if not isinstance(entry, int) and not isinstance(entry,str):
         raise ConfigError("Expecting an integer or a string.", key, entry)
 
 
-def is_sample(key, entry):
+def is_sample(key, entry, paths=None):
     if isinstance(entry, str):
-        is_file(key, entry)
+        is_file(key, entry, paths)
     elif isinstance(entry, list):
         for f in entry:
-            is_file(key, f)
+            is_file(key, f, paths)
     else:
         raise ConfigError("Expecting a list of files or a single file.", key, entry)
 
 
-def is_samples(key, entry):
+def is_samples(key, entry, paths=None):
     if not isinstance(entry, dict):
         raise ConfigError("Expecting an assignment of samples to FASTQ files.", key, entry)
     for sample, entry in entry.items():
-        is_sample(sample, entry)
+        is_sample(sample, entry, paths)
 
 
-def is_experiment(key, entry, msg="Expecting treatment and control samples or a design matrix."):
+def is_experiment(key, entry, paths=None, msg="Expecting treatment and control samples or a design matrix."):
     if key.startswith("myexperiment"):
         print("Warning: You use the experiment name '{}' in your config file which is "
               "intended as a placeholder. This won't affect functionality, but "
@@ -71,14 +85,14 @@ def is_experiment(key, entry, msg="Expecting treatment and control samples or a
             for sample in entry[condition]:
                 is_str(key, sample)
     else:
-        is_file(key, entry["designmatrix"])
+        is_file(key, entry["designmatrix"], paths)
 
 
-def is_experiments(key, entry):
+def is_experiments(key, entry, paths=None):
     if not isinstance(entry, dict):
         raise ConfigError("Expecting an assignment of experiments to treatment and control samples or a design matrix.", key, entry)
     for experiment, entry in entry.items():
-        is_experiment(experiment, entry)
+        is_experiment(experiment, entry, paths)
 
 
 config_structure = {
@@ -94,15 +108,24 @@ config_structure = {
         "len": (is_str_or_int, True),
         "annotation": (is_file, False),
         "adapter": (is_str, False),
+        "trim-pipe": (is_bool, False),
+        "annotation-server": (is_str, False),
     },
     "samples": (is_samples, False),
+    "qc": (is_str, False),
+    "preview_reads": (is_int, False),
+    "shard_count": (is_bool, False),
+    "count_cache_dir": (is_str, False),
+    "normalize_once": (is_bool, False),
+    "subset_samples": (is_bool, False),
+    "vispr_bundle": (is_bool, False),
     "correct_cnv": (is_bool, True),
     "cnv_norm": (is_file, False),
     "experiments": (is_experiments, True)
 }
 
 
-def _check_config(subconfig, substructure):
+def _check_config(subconfig, substructure, paths=None):
     for key, entry in substructure.items():
         if isinstance(entry, dict):
             test = None
@@ -114,10 +137,99 @@ def _check_config(subconfig, substructure):
                 raise ConfigError("Missing {} entry.".format(key))
         else:
             if test:
-                test(key, subconfig[key])
+                test(key, subconfig[key], paths)
             else:
-                _check_config(subconfig[key], substructure[key])
-
-
-def check_config(config):
-    _check_config(config, config_structure)
+                _check_config(subconfig[key], substructure[key], paths)
+
+
+def _stat(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def _file_stat(path):
+    # the stat of the file and whether it is a symlink, in one pool task
+    st = _stat(path)
+    return st, st is not None and os.path.islink(path)
+
+
+def _load_path_cache(cache):
+    try:
+        with open(cache) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _store_path_cache(cache, entries):
+    try:
+        os.makedirs(os.path.dirname(cache) or ".", exist_ok=True)
+        tmp = "{}.{}.tmp".format(cache, os.getpid())
+        with open(tmp, "w") as out:
+            json.dump(entries, out)
+        # atomic, such that concurrent invocations never read partial files
+        os.replace(tmp, cache)
+    except OSError:
+        pass
+
+
+def missing_paths(paths, threads=PATH_CHECK_THREADS, cache=None):
+    """
+    Return the given paths that do not exist. Paths are checked in parallel.
+    If a cache file is given (e.g. PATH_CACHE), files found earlier are only checked again if
+    the modification time of their directory changed (i.e. files were added,
+    removed or renamed), which needs a single stat per directory.
+    """
+    paths = sorted(set(paths))
+    entries = _load_path_cache(cache) if cache else {}
+    # names of the regular files found in each directory
+    found = {d: set(entry["files"]) for d, entry in entries.items()}
+    dirs = sorted(set(os.path.dirname(os.path.abspath(p)) for p in paths))
+    with ThreadPoolExecutor(max(1, threads)) as pool:
+        dir_stats = dict(zip(dirs, pool.map(_stat, dirs)))
+        unchanged = {
+            d for d, st in dir_stats.items()
+            if st is not None and d in entries and entries[d]["mtime"] == st.st_mtime_ns}
+        uncached = [
+            p for p in paths
+            if os.path.dirname(os.path.abspath(p)) not in unchanged or
+            os.path.basename(p) not in found[os.path.dirname(os.path.abspath(p))]]
+        stats = dict(zip(uncached, pool.map(_file_stat, uncached)))
+
+    missing = [p for p in uncached if stats[p][0] is None]
+    if cache and len(missing) < len(uncached):
+        for path, (st, link) in stats.items():
+            d = os.path.dirname(os.path.abspath(path))
+            # symlinks can break without their directory changing
+            if st is None or dir_stats[d] is None or link:
+                continue
+            if d not in unchanged:
+                entries[d] = {"mtime": dir_stats[d].st_mtime_ns}
+                found[d] = set()
+                unchanged.add(d)
+            if stat.S_ISREG(st.st_mode):
+                found[d].add(os.path.basename(path))
+        for d, entry in entries.items():
+            entry["files"] = sorted(found[d])
+        _store_path_cache(cache, entries)
+    return missing
+
+
+def check_config(config, threads=PATH_CHECK_THREADS, cache=None):
+    """
+    Check the structure of the config and the existence of all files it
+    refers to. All missing files are reported in a single ConfigError. See
+    missing_paths for the cache.
+    """
+    paths = []
+    _check_config(config, config_structure, paths)
+    missing = set(missing_paths([path for key, path in paths], threads, cache))
+    missing = [(key, path) for key, path in paths if path in missing]
+    if len(missing) == 1:
+        raise ConfigError("File does not exist.", *missing[0])
+    if missing:
+        raise ConfigError("{} files do not exist:\n{}".format(
+            len(missing),
+            "\n".join("  {}: {}".format(key, path) for key, path in missing)))
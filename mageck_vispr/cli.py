@@ -14,6 +14,10 @@ import yaml
 
 from mageck_vispr.version import __version__
 from mageck_vispr import annotation
+from mageck_vispr import qc
+from mageck_vispr import combat
+from mageck_vispr import tabix
+from mageck_vispr import annotation_server
 
 
 def init_workflow(directory, reads, keep_config=False):
@@ -72,6 +76,9 @@ def init_workflow(directory, reads, keep_config=False):
 
 
 def annotate_library(args):
+    # the output has to be a file for the server to write it
+    if args.output and annotation_server.request(args.server, "annotate", args):
+        return
     library=args.library
     #assembly=args.assembly
     #sgrna_len=args.sgrna_len
@@ -86,6 +93,41 @@ def annotate_library(args):
     a.annotate(args)
 
 
+def rescore_annotation(args):
+    if annotation_server.request(args.server, "rescore", args):
+        return
+    annotation.rescore_bed(args.bed, args.bedvalue, args.bedvalue_column,
+                           args.output)
+
+
+def read_qc(args):
+    for fastq in args.fastq:
+        qc.qc(fastq, args.outdir, batch_size=args.batch_size)
+
+
+def index_annotation(args):
+    cache = None
+    if args.annotation_table.startswith("http"):
+        cache = annotation.DownloadCache(args.cache_dir, args.cache_size)
+    index = annotation.index_table(args.annotation_table, output=args.output,
+                                   cache=cache)
+    logging.info("Annotation index: " + index)
+
+
+def serve_annotation(args):
+    preload = annotation_server.absolute_paths(args) if args.library else None
+    annotation_server.serve(args.socket, preload=preload)
+
+
+def index_bed(args):
+    tabix.index_bed(args.bed, output=args.output)
+
+
+def remove_batch(args):
+    combat.remove_batch(args.counts, args.batchmatrix, args.output,
+                        chunk_rows=args.chunk_size)
+
+
 def main():
     # create arg parser
     parser = argparse.ArgumentParser(
@@ -118,22 +160,81 @@ def main():
     workflow.add_argument("--keep-config", action="store_true",
                           help="Keep existing config file.")
 
+    # options of the download cache, shared by annotate-library,
+    # annotation-server and index-annotation
+    cache_options = argparse.ArgumentParser(add_help=False)
+    cache_options.add_argument(
+        "--cache-dir",
+        default=annotation.DEFAULT_CACHE_DIR,
+        help="Directory for caching downloaded annotation tables "
+        "(default: $MAGECK_VISPR_CACHE or ~/.cache/mageck-vispr).")
+    cache_options.add_argument(
+        "--cache-size",
+        default=annotation.DEFAULT_CACHE_SIZE,
+        help="Maximum size of the download cache (e.g. 500M, 20G). Least "
+        "recently used tables are removed when the limit is exceeded "
+        "(default: %(default)s).")
+
+    # options selecting the annotation table, shared by annotate-library and
+    # annotation-server
+    table_options = argparse.ArgumentParser(add_help=False,
+                                            parents=[cache_options])
+    table_options.add_argument("--sgrna-len",
+                               #type=int,
+                               choices=['19', '20', 'AUTO'],
+                               help="Length of sgrnas in library file, i.e. the "
+                               "annotation table to use (AUTO: the table of each "
+                               "sgrna length). sgRNAs of other lengths are matched "
+                               "by their 3' end against the 20bp (if longer) or "
+                               "19bp table.")
+    table_options.add_argument("--assembly",
+                               choices=["mm10", "mm9", "hg38", "hg19"],
+                               help="Assembly to use.")
+    table_options.add_argument(
+        "--annotation-table-folder",
+        help="After specifying the sgrna length and assembly, instead of downloading directly from bitbucket, search in the folder for corresponding annotation table.")
+    table_options.add_argument(
+        "--annotation-table",
+        help="As an alternative to specifying the sgrna length and assembly, "
+        "a path to an annotation table can be provided "
+        "(tab separated, no header; with columns chromosome, "
+        "start, end, gene, score, strand, sequence). This can also be a URL "
+        "or an index created with index-annotation. If an index (suffix .idx) "
+        "exists next to a local annotation table, it is used automatically. "
+        "See https://bitbucket.org/liulab/mageck-vispr/downloads for precomputed tables.")
+    table_options.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of processes used to scan annotation tables "
+        "(default: %(default)s).")
+    table_options.add_argument(
+        "--parser",
+        choices=["vectorized", "python"],
+        default="vectorized",
+        help="Parser for annotation tables: vectorized parses and filters "
+        "large blocks of the table with array operations, python parses it "
+        "line by line (default: %(default)s).")
+    table_options.add_argument(
+        "--annotation-table-sha256",
+        help="Expected SHA-256 checksum of a downloaded annotation table.")
+    table_options.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not cache downloaded annotation tables.")
+
     annotate = subparsers.add_parser(
         "annotate-library",
+        parents=[table_options],
         help="Annotate an sgRNA library design with information about "
         "sgRNA position and predicted efficiency. Annotation is printed in "
         "BED format.")
     annotate.add_argument(
         "library",
+        nargs="+",
         help="Path to sgRNA library design file (comma separated, columns "
-        "identifier, sequence, gene).")
-    annotate.add_argument("--sgrna-len",
-                          #type=int,
-                          choices=['19', '20', 'AUTO'],
-                          help="Length of sgrnas in library file.")
-    annotate.add_argument("--assembly",
-                          choices=["mm10", "mm9", "hg38", "hg19"],
-                          help="Assembly to use.")
+        "identifier, sequence, gene). Several libraries can be given, they "
+        "are annotated with a single scan of the annotation table.")
     annotate.add_argument(
         "--bedvalue",
         help="Instead of providing an efficiency value in the output bed file, "
@@ -145,15 +246,159 @@ def main():
         help="Provide a column name in the file in --bedvalue option as the column to fill in. "
             "For example, the 'LFC' column in sgrna_summary.txt in MAGeCK RRA represents the log fold change value. ")
     annotate.add_argument(
-        "--annotation-table-folder",
-        help="After specifying the sgrna length and assembly, instead of downloading directly from bitbucket, search in the folder for corresponding annotation table.")
+        "--output",
+        nargs="+",
+        help="Path to the BED file to write (default: standard output), one "
+        "per library. Paths ending with .gz are compressed with bgzip, unless "
+        "--compression is given.")
     annotate.add_argument(
-        "--annotation-table",
-        help="As an alternative to specifying the sgrna length and assembly, "
-        "a path to an annotation table can be provided "
-        "(tab separated, no header; with columns chromosome, "
-        "start, end, gene, score, strand, sequence). This can also be a URL. "
-        "See https://bitbucket.org/liulab/mageck-vispr/downloads for precomputed tables.")
+        "--compression",
+        choices=["none", "gzip", "bgzip"],
+        help="Compression of the BED file given with --output.")
+    annotate.add_argument(
+        "--sort",
+        action="store_true",
+        help="Sort the BED file by chromosome and start. Compressed with "
+        "bgzip, a tabix index (suffix .tbi) is created next to it.")
+    annotate.add_argument(
+        "--unmatched",
+        nargs="+",
+        help="Write library sgRNAs that were not found in the annotation "
+        "table, or were only found with a different gene, to this "
+        "tab-separated file (one per library) instead of logging a warning "
+        "for each of them.")
+    annotate.add_argument(
+        "--server",
+        help="Send the command to the annotation server listening on this "
+        "socket (see annotation-server), if it is running. Otherwise, or if "
+        "the server fails, the command is run as usual.")
+    annotate.add_argument(
+        "--metrics",
+        help="Write wall time, CPU time, peak memory and counts (e.g. lines "
+        "scanned per second, matches) of each phase (import, scan, write) "
+        "to this JSON file.")
+    rescore = subparsers.add_parser(
+        "rescore-annotation",
+        help="Create copies of an annotated sgRNA library (a BED file "
+        "created by annotate-library) with the score column replaced by "
+        "the values in one or more sgRNA summary files. The BED file is "
+        "read only once, regardless of the number of summary files.")
+    rescore.add_argument(
+        "bed",
+        help="Path to the BED file created by annotate-library.")
+    rescore.add_argument(
+        "--bedvalue",
+        nargs="+",
+        required=True,
+        help="Tab separated files with header, whose first column is the "
+        "sgRNA ID (e.g. sgrna_summary.txt of MAGeCK RRA).")
+    rescore.add_argument(
+        "--bedvalue-column",
+        required=True,
+        help="Name of the column in the --bedvalue files to use as score "
+        "(e.g. LFC).")
+    rescore.add_argument(
+        "--output",
+        nargs="+",
+        required=True,
+        help="Paths to the BED files to write, one per --bedvalue file.")
+    rescore.add_argument(
+        "--server",
+        help="Send the command to the annotation server listening on this "
+        "socket (see annotation-server), if it is running. Otherwise, or if "
+        "the server fails, the command is run as usual.")
+
+    server = subparsers.add_parser(
+        "annotation-server",
+        parents=[table_options],
+        help="Run a server that keeps the annotation of sgRNA libraries and "
+        "annotated BED files in memory and answers the requests of "
+        "annotate-library and rescore-annotation given the --server option, "
+        "over a Unix socket. Libraries not given here are annotated at "
+        "their first request. Stop the server with Ctrl-C or SIGTERM.")
+    server.add_argument(
+        "--socket",
+        default=annotation_server.DEFAULT_SOCKET,
+        help="Path to the Unix socket to listen on (default: %(default)s).")
+    server.add_argument(
+        "--library",
+        nargs="+",
+        help="sgRNA library design files to annotate at startup (with the "
+        "given annotation table options).")
+
+    index = subparsers.add_parser(
+        "index-annotation",
+        parents=[cache_options],
+        help="Build a sequence-keyed index for an sgRNA annotation table. "
+        "If the index is stored next to the table (the default), "
+        "annotate-library looks up library sequences in the index instead "
+        "of scanning the whole table. The index of a URL is stored next to "
+        "its download in the cache.")
+    index.add_argument(
+        "annotation_table",
+        help="Path or URL to an annotation table (tab separated, no header; "
+        "with columns chromosome, start, end, gene, score, strand, sequence; "
+        "optionally compressed with bz2 or gzip).")
+    index.add_argument(
+        "--output",
+        help="Path to the index file to create (default: the path of the "
+        "annotation table with suffix .idx, or the download cache for URLs).")
+
+    index_bed_parser = subparsers.add_parser(
+        "index-bed",
+        help="Sort a BED file (e.g. annotation/sgrnas.bed) by chromosome and "
+        "start, compress it with bgzip and create a tabix index, such that "
+        "the sgRNAs of genomic regions can be queried without reading the "
+        "whole file.")
+    index_bed_parser.add_argument(
+        "bed",
+        help="BED file (optionally gzip compressed).")
+    index_bed_parser.add_argument(
+        "-o", "--output",
+        help="Path to the compressed BED file to create (default: the path "
+        "of the BED file with suffix .gz). The index is written to the same "
+        "path with suffix .tbi.")
+
+    qc_parser = subparsers.add_parser(
+        "qc",
+        help="Compute read quality statistics of FASTQ files (per base "
+        "quality, per base sequence content, GC content and read lengths) "
+        "in a single pass. Reports are written as FastQC compatible "
+        "OUTDIR/NAME_fastqc/fastqc_data.txt files, which can be shown by VISPR.")
+    qc_parser.add_argument(
+        "fastq",
+        nargs="+",
+        help="FASTQ files (optionally gzip or bzip2 compressed).")
+    qc_parser.add_argument(
+        "-o", "--outdir",
+        required=True,
+        help="Directory to write the reports to.")
+    qc_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=qc.BATCH_SIZE,
+        help="Number of reads processed at once (default: %(default)s).")
+
+    batch = subparsers.add_parser(
+        "remove-batch",
+        help="Remove batch effects from a count table with parametric "
+        "ComBat (as in the R package sva) on log2 transformed counts.")
+    batch.add_argument(
+        "counts",
+        help="Count table (e.g. results/count/all.count_normalized.txt).")
+    batch.add_argument(
+        "batchmatrix",
+        help="Tab separated file with header and columns sample, batch and "
+        "optional covariates.")
+    batch.add_argument(
+        "-o", "--output",
+        required=True,
+        help="Path to the batch corrected count table to write.")
+    batch.add_argument(
+        "--chunk-size",
+        type=int,
+        default=combat.CHUNK_ROWS,
+        help="Number of sgRNAs processed at once (default: %(default)s).")
 
     logging.basicConfig(format="%(message)s",
                         level=logging.INFO,
@@ -173,6 +418,18 @@ def main():
             parser.print_help()
             print("Error: need to specify one of the following: path to an annotation table (--annotation-table); or  assembly (--assembly).")
             exit(1)
+    elif args.subcommand == "rescore-annotation":
+        rescore_annotation(args)
+    elif args.subcommand == "annotation-server":
+        serve_annotation(args)
+    elif args.subcommand == "qc":
+        read_qc(args)
+    elif args.subcommand == "index-annotation":
+        index_annotation(args)
+    elif args.subcommand == "index-bed":
+        index_bed(args)
+    elif args.subcommand == "remove-batch":
+        remove_batch(args)
     else:
         parser.print_help()
         exit(1)
@@ -0,0 +1,211 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2015, Johannes Köster, Liu lab"
+__email__ = "koester@jimmy.harvard.edu"
+__license__ = "MIT"
+
+"""
+Batch effect removal from count tables with parametric ComBat (Johnson et
+al. 2007), as implemented in ComBat of the R package sva.
+
+Counts are log2(x + 1) transformed and corrected with an empirical Bayes
+estimate of the additive and multiplicative batch effect of each sgRNA.
+The count table is read twice, in chunks of sgRNAs, such that memory usage
+is bounded by the chunk size: the first pass fits the linear model of each
+sgRNA and collects the per batch mean and sum of squares of its
+standardized values, which are all that is needed to estimate the priors
+and to iterate the empirical Bayes estimates; the second pass applies the
+correction and writes the table.
+
+Two deliberate differences to combat.R, which earlier versions of the
+workflow used: all columns of the batch matrix after the batch are used as
+covariates (combat.R skipped the first one, and used none if there was only
+one), and sgRNAs without any variance are written with their counts
+(combat.R wrote them log2(x + 1) transformed).
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+from mageck_vispr.count_cache import iter_counts, read_samples, CHUNK_ROWS
+
+
+# relative change at which the iteration of the batch effects stops
+CONVERGENCE = 1e-4
+# significant digits of the written counts (formatting dominates the run time)
+PRECISION = 10
+
+
+def read_batchmatrix(path, samples):
+    """
+    Read a batch matrix (tab separated with header; columns sample, batch
+    and optional covariates) and return the batch of each given sample and
+    the covariate columns of the design matrix.
+    """
+    info = pd.read_csv(path, sep="\t", index_col=0, dtype=str)
+    missing = [sample for sample in samples if sample not in info.index]
+    if missing:
+        raise ValueError("Samples missing in batch matrix: {}".format(
+            ", ".join(missing)))
+    info = info.loc[samples]
+    batch = info.iloc[:, 0].to_numpy()
+    covariates = []
+    for column in info.columns[1:]:
+        values = info[column]
+        try:
+            covariates.append(pd.to_numeric(values).to_numpy(np.float64))
+        except ValueError:
+            # factors are coded with treatment contrasts, like in R
+            for level in sorted(values.unique())[1:]:
+                covariates.append((values == level).to_numpy(np.float64))
+    covariates = (np.column_stack(covariates) if covariates
+                  else np.zeros((len(samples), 0)))
+    return batch, covariates
+
+
+def constant_rows(data):
+    """
+    Return the rows of data without any variance. Unlike var(...) == 0,
+    this holds for all constant rows, as var in R.
+    """
+    return (data == data[:, :1]).all(axis=1)
+
+
+class ComBat():
+    def __init__(self, batch, covariates):
+        self.batches, self.batch_index = np.unique(batch, return_inverse=True)
+        self.batch_design = (
+            self.batch_index[:, None] == np.arange(len(self.batches))).astype(np.float64)
+        self.batch_sizes = self.batch_design.sum(axis=0)
+        if np.any(self.batch_sizes < 1):
+            raise ValueError("Empty batch.")
+        # sva: with a batch of a single sample only the mean is adjusted
+        self.mean_only = bool(np.any(self.batch_sizes == 1))
+        if self.mean_only:
+            logging.info("Found a batch with a single sample, adjusting only "
+                         "the mean of the batch effect.")
+        self.design = np.hstack([self.batch_design, covariates])
+        if np.linalg.matrix_rank(self.design) < self.design.shape[1]:
+            raise ValueError("Covariates are confounded with the batches.")
+        self.n = len(batch)
+        # least squares fit of all sgRNAs at once: B = H y
+        self.hat = np.linalg.solve(self.design.T @ self.design, self.design.T)
+        self.covariate_design = self.design.copy()
+        self.covariate_design[:, :len(self.batches)] = 0
+
+    def _keep(self, data):
+        # like sva, sgRNAs without variance within a batch are not adjusted
+        keep = np.ones(len(data), dtype=bool)
+        for b, size in enumerate(self.batch_sizes):
+            if size > 1:
+                keep &= ~constant_rows(data[:, self.batch_index == b])
+        return keep
+
+    def _standardize(self, data, coef, var_pooled):
+        grand_mean = (self.batch_sizes / self.n) @ coef[:len(self.batches)]
+        stand_mean = grand_mean[:, None] + (self.covariate_design @ coef).T
+        return (data - stand_mean) / np.sqrt(var_pooled)[:, None], stand_mean
+
+    def fit_chunk(self, data):
+        """
+        Fit the model to a chunk of log counts (sgRNAs x samples). Returns
+        the statistics needed by adjust_chunk and the estimation of the
+        batch effects.
+        """
+        keep = self._keep(data)
+        coef = self.hat @ data.T
+        var_pooled = ((data - (self.design @ coef).T) ** 2).mean(axis=1)
+        var_pooled[~keep] = 1
+        s_data, _ = self._standardize(data, coef, var_pooled)
+        gamma_hat = (s_data @ self.batch_design / self.batch_sizes).T
+        sum_sq = np.vstack([
+            ((s_data[:, self.batch_index == b] - gamma_hat[b][:, None]) ** 2).sum(axis=1)
+            for b in range(len(self.batches))])
+        return keep, coef, var_pooled, gamma_hat, sum_sq
+
+    def estimate(self, gamma_hat, sum_sq):
+        """
+        Return the empirical Bayes estimates of the additive and
+        multiplicative batch effects, given the per batch means and sums of
+        squares of the standardized data of all (adjusted) sgRNAs.
+        """
+        gamma_bar = gamma_hat.mean(axis=1)
+        t2 = gamma_hat.var(axis=1, ddof=1)
+        gamma_star = np.empty_like(gamma_hat)
+        delta_star = np.ones_like(gamma_hat)
+        for b, n in enumerate(self.batch_sizes):
+            if self.mean_only:
+                gamma_star[b] = (t2[b] * gamma_hat[b] + gamma_bar[b]) / (t2[b] + 1)
+                continue
+            delta_hat = sum_sq[b] / (n - 1)
+            m, s2 = delta_hat.mean(), delta_hat.var(ddof=1)
+            a = (2 * s2 + m ** 2) / s2
+            beta = (m * s2 + m ** 3) / s2
+            g_old, d_old = gamma_hat[b], delta_hat
+            change = 1
+            while change > CONVERGENCE:
+                g_new = ((t2[b] * n * gamma_hat[b] + d_old * gamma_bar[b]) /
+                         (t2[b] * n + d_old))
+                # sum of squares of the data around the new mean
+                sum2 = sum_sq[b] + n * (gamma_hat[b] - g_new) ** 2
+                d_new = (0.5 * sum2 + beta) / (n / 2 + a - 1)
+                change = max(np.max(np.abs(g_new - g_old) / g_old),
+                             np.max(np.abs(d_new - d_old) / d_old))
+                g_old, d_old = g_new, d_new
+            gamma_star[b], delta_star[b] = g_old, d_old
+        return gamma_star, delta_star
+
+    def adjust_chunk(self, data, keep, coef, var_pooled, gamma_star, delta_star):
+        """
+        Return the batch corrected log counts of a chunk.
+        """
+        s_data, stand_mean = self._standardize(data, coef, var_pooled)
+        s_data -= gamma_star[self.batch_index].T
+        s_data /= np.sqrt(delta_star[self.batch_index].T)
+        adjusted = s_data * np.sqrt(var_pooled)[:, None] + stand_mean
+        adjusted[~keep] = data[~keep]
+        return adjusted
+
+
+def remove_batch(count_table, batchmatrix, output, chunk_rows=CHUNK_ROWS):
+    """
+    Remove batch effects from the (normalized) counts of count_table and
+    write the corrected count table to output.
+    """
+    samples = read_samples(count_table)
+    batch, covariates = read_batchmatrix(batchmatrix, samples)
+    combat = ComBat(batch, covariates)
+
+    # first pass: fit the model of each sgRNA
+    fits = []
+    for sgrnas, genes, counts in iter_counts(count_table, chunk_rows):
+        data = np.log2(counts + 1)
+        # sgRNAs without any variance are kept as they are (see above)
+        fit = combat.fit_chunk(data)
+        fit[0][constant_rows(data)] = False
+        fits.append(fit)
+    keep, coef, var_pooled, gamma_hat, sum_sq = (
+        np.concatenate(values, axis=-1) for values in zip(*fits))
+    logging.info("Adjusting {} of {} sgRNAs.".format(keep.sum(), len(keep)))
+    gamma_star, delta_star = combat.estimate(gamma_hat[:, keep], sum_sq[:, keep])
+    full_gamma = np.zeros_like(gamma_hat)
+    full_delta = np.ones_like(sum_sq)
+    full_gamma[:, keep] = gamma_star
+    full_delta[:, keep] = delta_star
+
+    # second pass: apply the correction
+    start = 0
+    row_format = "%s\t%s\t" + "\t".join(["%.{}g".format(PRECISION)] * len(samples)) + "\n"
+    with open(output, "w") as out:
+        out.write("\t".join(["sgRNA", "Gene"] + samples) + "\n")
+        for sgrnas, genes, counts in iter_counts(count_table, chunk_rows):
+            rows = slice(start, start + len(sgrnas))
+            data = np.log2(counts + 1)
+            adjusted = combat.adjust_chunk(
+                data, keep[rows], coef[:, rows], var_pooled[rows],
+                full_gamma[:, rows], full_delta[:, rows])
+            corrected = 2 ** np.maximum(adjusted, 0) - 1
+            out.writelines(row_format % (sgrna, gene, *values)
+                           for sgrna, gene, values in zip(sgrnas, genes, corrected.tolist()))
+            start += len(sgrnas)
@@ -0,0 +1,151 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2015, Johannes Köster, Liu lab"
+__email__ = "koester@jimmy.harvard.edu"
+__license__ = "MIT"
+
+"""
+Binary columnar copy of MAGeCK count tables.
+
+The copy of a count table {table} is stored in the directory {table}.cache:
+
+    meta.json   sample names, number of sgRNAs and the size and
+                modification time of the text table it was made from
+    counts.npy  the count matrix (sgRNAs x samples, float64) in column-major
+                order, such that single samples are contiguous when memory
+                mapped
+    index.tsv   sgRNA and gene of each row
+
+The copy is only used as long as the text table is unchanged. Reading the
+sample names then only needs meta.json, and the counts are read in chunks
+of rows without parsing text (see combat.py).
+"""
+
+import os
+import json
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+
+
+# rows parsed at once when writing the copy
+CHUNK_ROWS = 100000
+
+
+def cache_dir(count_table):
+    return count_table + ".cache"
+
+
+def _source_stamp(count_table):
+    st = os.stat(count_table)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def _read_header(count_table):
+    with open(count_table) as f:
+        return f.readline().split()
+
+
+def load_meta(count_table):
+    """
+    Return the metadata of the columnar copy of the given count table, or
+    None if there is no up to date copy.
+    """
+    try:
+        with open(os.path.join(cache_dir(count_table), "meta.json")) as f:
+            meta = json.load(f)
+        if meta["source"] != _source_stamp(count_table):
+            return None
+        return meta
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_count_cache(count_table, chunk_rows=CHUNK_ROWS):
+    """
+    Write the columnar copy of a count table. The table is parsed in chunks,
+    such that memory usage does not depend on the number of sgRNAs.
+    """
+    source = _source_stamp(count_table)
+    header = _read_header(count_table)
+    samples = header[2:]
+    with open(count_table) as f:
+        rows = sum(1 for line in f if line.strip()) - 1
+
+    path = cache_dir(count_table)
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(os.path.join(path, "meta.json")):
+        os.remove(os.path.join(path, "meta.json"))
+    counts = np.lib.format.open_memmap(
+        os.path.join(path, "counts.npy"), mode="w+", dtype=np.float64,
+        shape=(rows, len(samples)), fortran_order=True)
+    with open(os.path.join(path, "index.tsv"), "w") as index:
+        start = 0
+        for chunk in pd.read_csv(count_table, sep=r"\s+", chunksize=chunk_rows,
+                                 dtype={header[0]: str, header[1]: str}):
+            counts[start:start + len(chunk)] = chunk[samples].to_numpy(np.float64)
+            index.writelines("{}\t{}\n".format(sgrna, gene) for sgrna, gene in
+                             zip(chunk[header[0]], chunk[header[1]]))
+            start += len(chunk)
+    counts.flush()
+    del counts
+
+    meta = {"source": source, "columns": header[:2], "samples": samples,
+            "rows": rows}
+    # written last, such that an incomplete copy is never used
+    with open(os.path.join(path, "meta.json"), "w") as out:
+        json.dump(meta, out, indent=2)
+    return meta
+
+
+def read_samples(count_table):
+    """
+    Return the sample names of a count table.
+    """
+    meta = load_meta(count_table)
+    if meta is not None:
+        return meta["samples"]
+    return _read_header(count_table)[2:]
+
+
+def iter_counts(count_table, chunk_rows=CHUNK_ROWS):
+    """
+    Yield the sgRNAs, genes and counts (as array of sgRNAs x samples) of a
+    count table in chunks of rows. The columnar copy is used if it is up to
+    date, otherwise the text table is parsed chunk by chunk.
+    """
+    meta = load_meta(count_table)
+    if meta is None:
+        header = _read_header(count_table)
+        for chunk in pd.read_csv(count_table, sep=r"\s+", chunksize=chunk_rows,
+                                 dtype={header[0]: str, header[1]: str}):
+            yield (chunk[header[0]].tolist(), chunk[header[1]].tolist(),
+                   chunk[header[2:]].to_numpy(np.float64))
+        return
+
+    path = cache_dir(count_table)
+    counts = np.load(os.path.join(path, "counts.npy"), mmap_mode="r")
+    with open(os.path.join(path, "index.tsv")) as f:
+        for start in range(0, meta["rows"], chunk_rows):
+            rows = [line.rstrip("\n").split("\t") for line in islice(f, chunk_rows)]
+            yield ([row[0] for row in rows], [row[1] for row in rows],
+                   np.array(counts[start:start + len(rows)]))
+
+
+def subset_count_table(count_table, samples, output):
+    """
+    Write the columns of the given samples of a count table to output. The
+    values are copied as they are.
+    """
+    header = _read_header(count_table)
+    columns = {sample: i for i, sample in enumerate(header) if i >= 2}
+    missing = [sample for sample in samples if sample not in columns]
+    if missing:
+        raise ValueError("Samples not found in {}: {}".format(
+            count_table, ", ".join(missing)))
+    indices = [0, 1] + [columns[sample] for sample in samples]
+    with open(count_table) as f, open(output, "w") as out:
+        for line in f:
+            fields = line.split()
+            if fields:
+                out.write("\t".join([fields[i] for i in indices]) + "\n")
@@ -0,0 +1,248 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2015, Johannes Köster, Liu lab"
+__email__ = "koester@jimmy.harvard.edu"
+__license__ = "MIT"
+
+"""
+Content-addressed store of per-replicate sgRNA counts.
+
+The counts of a replicate are stored under a key derived from the content
+of its FASTQ files and of the library, and from the counting options
+(trim-5, adapter, count-pair). Renaming samples, or adding samples to a
+screen, therefore does not require counting the reads again. Layout of the
+store directory:
+
+    hashes/<sha256 of path>.json   content hash of a file, valid as long as
+                                   its size and modification time are unchanged
+    counts/<key>/count.txt         counts of the replicate (label "count")
+    counts/<key>/countsummary.txt  mapping statistics of the replicate
+    locks/                         per-key lock files
+
+Entries are created by atomic renames, and jobs counting the same
+replicate serialize on the lock of its key. Entries are never evicted; the
+store has to be cleaned by hand (while no workflow is using it).
+"""
+
+import os
+import csv
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+from mageck_vispr.download import _locked, _read_json, _write_json, CHUNK_SIZE
+
+
+# part of every key, to be increased if the stored format changes
+STORE_VERSION = 1
+STORED_LABEL = "count"
+
+
+def _sha256(data):
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class CountStore():
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        for d in ("hashes", "counts", "locks"):
+            os.makedirs(os.path.join(self.store_dir, d), exist_ok=True)
+
+    def _path(self, *parts):
+        return os.path.join(self.store_dir, *parts)
+
+    def file_hash(self, path):
+        """
+        Return the SHA-256 checksum of the content of a file. Checksums are
+        remembered until the size or modification time of the file changes.
+        """
+        st = os.stat(path)
+        memo_path = self._path("hashes", _sha256(os.path.realpath(path)) + ".json")
+        memo = _read_json(memo_path)
+        if memo is not None and memo["size"] == st.st_size and \
+                memo["mtime_ns"] == st.st_mtime_ns:
+            return memo["sha256"]
+        checksum = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                checksum.update(chunk)
+        digest = checksum.hexdigest()
+        _write_json(memo_path, {"path": os.path.realpath(path),
+                                "size": st.st_size,
+                                "mtime_ns": st.st_mtime_ns,
+                                "sha256": digest})
+        return digest
+
+    def key(self, fastq, library, fastq2=None, trim5=None, countpair=None,
+            adapter=None):
+        """
+        Return the key of the counts of the given reads and options.
+        """
+        return _sha256(json.dumps({
+            "version": STORE_VERSION,
+            "fastq": self.file_hash(fastq),
+            "fastq2": self.file_hash(fastq2) if fastq2 else None,
+            "library": self.file_hash(library),
+            "trim5": str(trim5),
+            "countpair": str(countpair) if countpair is not None else None,
+            "adapter": adapter,
+        }, sort_keys=True))
+
+    def get(self, key):
+        """
+        Return the paths of the stored count table and summary of the given
+        key, or None if they are not stored.
+        """
+        entry = self._path("counts", key)
+        if os.path.exists(entry):
+            # record the last use
+            os.utime(entry)
+            return (os.path.join(entry, "count.txt"),
+                    os.path.join(entry, "countsummary.txt"))
+        return None
+
+    def put(self, key, count_file, summary_file):
+        tmp = tempfile.mkdtemp(dir=self._path("counts"), prefix=".tmp-")
+        shutil.copy(count_file, os.path.join(tmp, "count.txt"))
+        shutil.copy(summary_file, os.path.join(tmp, "countsummary.txt"))
+        try:
+            os.rename(tmp, self._path("counts", key))
+        except OSError:
+            # stored concurrently
+            shutil.rmtree(tmp)
+        return self.get(key)
+
+    def count(self, key, fastq, library, fastq2=None, trim5=None,
+              countpair=None, adapter=None, threads=1, log=None):
+        """
+        Return the stored counts of the given key, counting the reads with
+        MAGeCK if they are not stored yet.
+        """
+        with _locked(self._path("locks", key + ".lock")):
+            stored = self.get(key)
+            if stored is not None:
+                logging.info("Using stored counts of {}.".format(fastq))
+                return stored
+            with tempfile.TemporaryDirectory(dir=self._path("counts"),
+                                             prefix=".count-") as tmp:
+                if adapter:
+                    trimmed = os.path.join(tmp, "trimmed.fastq.gz")
+                    _run(["cutadapt", "-j", str(threads), "-a", adapter,
+                          "-o", trimmed, fastq], log)
+                    fastq = trimmed
+                prefix = os.path.join(tmp, "replicate")
+                cmd = ["mageck", "count", "--output-prefix", prefix,
+                       "--norm-method", "none", "--list-seq", library,
+                       "--fastq", fastq, "--sample-label", STORED_LABEL]
+                if fastq2:
+                    cmd += ["--fastq-2", fastq2]
+                if countpair is not None:
+                    cmd += ["--count-pair", str(countpair)]
+                if trim5 is not None:
+                    cmd += ["--trim-5", str(trim5)]
+                _run(cmd, log)
+                return self.put(key, prefix + ".count.txt",
+                                prefix + ".countsummary.txt")
+
+
+def _run(cmd, log):
+    with open(log or os.devnull, "a") as err:
+        subprocess.run(cmd, check=True, stdout=err, stderr=err)
+
+
+def _read_counts(count_file):
+    counts = OrderedDict()
+    with open(count_file) as f:
+        labels = f.readline().rstrip("\n").split("\t")[2:]
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            counts[fields[0]] = (fields[1], [int(float(c)) for c in fields[2:]])
+    return labels, counts
+
+
+def _read_summary(summary_file):
+    with open(summary_file) as f:
+        return list(csv.DictReader(f, delimiter="\t"))
+
+
+def count_replicate(store_dir, replicate, fastq, library, count_output,
+                    summary_output, fastq2=None, trim5=None, countpair=None,
+                    adapter=None, threads=1, log=None):
+    """
+    Write the counts and the summary of a replicate, taking them from the
+    store if possible.
+    """
+    store = CountStore(store_dir)
+    key = store.key(fastq, library, fastq2=fastq2, trim5=trim5,
+                    countpair=countpair, adapter=adapter)
+    count_file, summary_file = store.count(
+        key, fastq, library, fastq2=fastq2, trim5=trim5, countpair=countpair,
+        adapter=adapter, threads=threads, log=log)
+    with open(count_file) as f, open(count_output, "w") as out:
+        header = f.readline().rstrip("\n").split("\t")
+        out.write("\t".join(header[:2] + [replicate]) + "\n")
+        shutil.copyfileobj(f, out)
+    rows = _read_summary(summary_file)
+    with open(summary_output, "w") as out:
+        writer = csv.DictWriter(out, list(rows[0]), delimiter="\t",
+                                lineterminator="\n")
+        writer.writeheader()
+        for row in rows:
+            # the stored summary names the reads the key was first counted
+            # from, report the (untrimmed) input reads of this replicate
+            row.update(Label=replicate, File=fastq)
+            writer.writerow(row)
+
+
+def assemble_count_table(sample_counts, output):
+    """
+    Write a count table with a column per sample, given as dict of sample
+    names to lists of replicate count tables. The counts of the replicates
+    of a sample are summed up.
+    """
+    genes = OrderedDict()
+    columns = []
+    for sample, count_files in sample_counts.items():
+        total = {}
+        for count_file in count_files:
+            _, counts = _read_counts(count_file)
+            for sgrna, (gene, values) in counts.items():
+                genes.setdefault(sgrna, gene)
+                total[sgrna] = total.get(sgrna, 0) + sum(values)
+        columns.append(total)
+    with open(output, "w") as out:
+        out.write("\t".join(["sgRNA", "Gene"] + list(sample_counts)) + "\n")
+        for sgrna, gene in genes.items():
+            out.write("\t".join([sgrna, gene] + [
+                str(total.get(sgrna, 0)) for total in columns]) + "\n")
+
+
+def assemble_countsummary(sample_summaries, table_summary, output):
+    """
+    Write the count summary of the samples: the read and mapping statistics
+    are summed up over the replicate summaries of each sample (dict of
+    sample names to lists of files), all other statistics (e.g. zero counts,
+    Gini index) are taken from the summary MAGeCK created for the assembled
+    count table.
+    """
+    rows = {row["Label"]: row for row in _read_summary(table_summary)}
+    columns = None
+    with open(output, "w") as out:
+        for sample, summary_files in sample_summaries.items():
+            replicates = [row for f in summary_files for row in _read_summary(f)]
+            row = rows[sample]
+            if columns is None:
+                columns = list(row)
+                writer = csv.DictWriter(out, columns, delimiter="\t",
+                                        lineterminator="\n")
+                writer.writeheader()
+            reads = sum(int(float(r["Reads"])) for r in replicates)
+            mapped = sum(int(float(r["Mapped"])) for r in replicates)
+            row.update(File=",".join(r["File"] for r in replicates),
+                       Reads=reads, Mapped=mapped)
+            if "Percentage" in row:
+                row["Percentage"] = "{:.4g}".format(mapped / reads if reads else 0)
+            writer.writerow(row)
@@ -0,0 +1,265 @@
+__author__ = "Chen-Hao Chen"
+__copyright__ = "Copyright 2015, Chen-Hao Chen, Liu lab"
+__email__ = "hyalin1127@gmail.com"
+__license__ = "MIT"
+
+"""
+Persistent, content-addressed cache for downloaded annotation tables.
+
+Layout of the cache directory:
+
+    urls/<sha256 of url>.json      metadata (url, sha256 of content, size)
+    blobs/<sha256>-<basename>      downloaded files, shared by equal content
+    partial/<sha256 of url>.part   interrupted downloads, resumed on next use
+    derived/<blob name>/           files built from a blob (e.g. its index)
+    locks/                         per-url and global lock files
+
+Blobs are only ever created by atomic renames, and concurrent processes
+(e.g. several Snakemake jobs) serialize on a per-url lock, so the same file
+is downloaded at most once. The modification time of a blob records its last
+use and drives the LRU eviction once the cache exceeds its size limit.
+Derived files count towards the size of their blob and are evicted with it.
+Lookups, new blobs and eviction serialize on the global lock, and blobs used
+within the last EVICT_MIN_AGE seconds are never evicted, so that a returned
+path stays valid while the caller opens it.
+"""
+
+import os
+import json
+import fcntl
+import hashlib
+import time
+import shutil
+import logging
+from contextlib import contextmanager
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from urllib.parse import urlparse
+
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "MAGECK_VISPR_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "mageck-vispr"))
+DEFAULT_CACHE_SIZE = "20G"
+
+CHUNK_SIZE = 1 << 20
+# seconds since their last use during which blobs are not evicted
+EVICT_MIN_AGE = 600
+
+_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(size):
+    """
+    Parse a size like 500M or 20G into bytes.
+    """
+    if size is None or isinstance(size, int):
+        return size
+    size = str(size).strip().upper().rstrip("B")
+    unit = size[-1:] if size[-1:] in _UNITS else ""
+    try:
+        return int(float(size[:len(size) - len(unit)]) * _UNITS[unit])
+    except ValueError:
+        raise ValueError("Invalid size: {}".format(size))
+
+
+def _sha256(data):
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+@contextmanager
+def _locked(path):
+    with open(path, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _write_json(path, data):
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+class DownloadCache():
+    def __init__(self, cache_dir=None, max_size=DEFAULT_CACHE_SIZE):
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.max_size = parse_size(max_size)
+        for d in ("urls", "blobs", "partial", "derived", "locks"):
+            os.makedirs(os.path.join(self.cache_dir, d), exist_ok=True)
+
+    def _path(self, *parts):
+        return os.path.join(self.cache_dir, *parts)
+
+    def _cache_lock(self):
+        return _locked(self._path("locks", "cache.lock"))
+
+    def _cached(self, key, sha256):
+        meta = _read_json(self._path("urls", key + ".json"))
+        if meta is not None and (sha256 is None or meta["sha256"] == sha256):
+            blob = self._path("blobs", meta["blob"])
+            if os.path.exists(blob):
+                return blob
+        return None
+
+    def cached(self, url, sha256=None):
+        """
+        Return the path to the cached copy of the given url, or None if it
+        is not cached.
+        """
+        with self._cache_lock():
+            return self._cached(_sha256(url), sha256)
+
+    def get(self, url, sha256=None):
+        """
+        Return the path to a local copy of the given url, downloading it
+        if it is not yet cached. If sha256 is given, the content has to
+        match the checksum.
+        """
+        key = _sha256(url)
+        with _locked(self._path("locks", key + ".lock")):
+            with self._cache_lock():
+                # marking the blob as used protects it from eviction
+                blob = self._cached(key, sha256)
+                if blob is not None:
+                    logging.info("Using cached download of {}: {}".format(
+                        url, blob))
+                    os.utime(blob)
+                    return blob
+            blob = self._download(url, key, sha256)
+        self.evict(keep=blob)
+        return blob
+
+    def derived(self, blob, name, build=None):
+        """
+        Return the path to the file of the given name derived from a blob,
+        or None if it does not exist. If build is given, a missing file is
+        created with build(blob, path).
+        """
+        blob_name = os.path.basename(blob)
+        path = self._path("derived", blob_name, name)
+        if build is not None and not os.path.exists(path):
+            with _locked(self._path("locks", blob_name + ".lock")):
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    build(blob, path)
+            self.evict(keep=blob)
+        return path if os.path.exists(path) else None
+
+    def _download(self, url, key, sha256):
+        part = self._path("partial", key + ".part")
+        part_meta_path = part + ".json"
+        part_meta = _read_json(part_meta_path) or {}
+        request = Request(url)
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        validator = part_meta.get("etag") or part_meta.get("last_modified")
+        if offset and validator:
+            request.add_header("Range", "bytes={}-".format(offset))
+            request.add_header("If-Range", validator)
+
+        checksum = hashlib.sha256()
+        try:
+            response = urlopen(request)
+        except HTTPError as e:
+            if not (offset and validator and e.code == 416):
+                raise
+            # the range starts at the end, i.e. the part is already complete
+            # (if the size matches), otherwise restart from scratch
+            if e.headers.get("Content-Range") == "bytes */{}".format(offset):
+                logging.info("Download of {} is already complete.".format(url))
+                with open(part, "rb") as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                        checksum.update(chunk)
+                return self._publish(url, key, sha256, checksum.hexdigest())
+            os.remove(part)
+            return self._download(url, key, sha256)
+        with response:
+            if offset and validator and response.status == 206:
+                logging.info("Resuming download of {} at byte {}.".format(
+                    url, offset))
+                mode = "r+b"
+                with open(part, "rb") as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                        checksum.update(chunk)
+            else:
+                logging.info("Downloading {}.".format(url))
+                mode = "wb"
+            _write_json(part_meta_path, {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified")
+            })
+            with open(part, mode) as out:
+                out.seek(0, os.SEEK_END)
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                    checksum.update(chunk)
+                    out.write(chunk)
+        return self._publish(url, key, sha256, checksum.hexdigest())
+
+    def _publish(self, url, key, sha256, digest):
+        """
+        Move the complete partial download into the blobs, after checking
+        its checksum.
+        """
+        part = self._path("partial", key + ".part")
+        part_meta_path = part + ".json"
+        if sha256 is not None and digest != sha256:
+            os.remove(part)
+            os.remove(part_meta_path)
+            raise IOError("Checksum mismatch for {}: expected {}, got {}.".format(
+                url, sha256, digest))
+        name = "{}-{}".format(digest, os.path.basename(urlparse(url).path))
+        blob = self._path("blobs", name)
+        with self._cache_lock():
+            os.replace(part, blob)
+            os.remove(part_meta_path)
+            _write_json(self._path("urls", key + ".json"), {
+                "url": url, "sha256": digest, "blob": name,
+                "size": os.path.getsize(blob)
+            })
+        return blob
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used blobs (with their derived files) until the
+        cache fits into its size limit. Blobs used within the last
+        EVICT_MIN_AGE seconds are kept.
+        """
+        if self.max_size is None:
+            return
+        with self._cache_lock():
+            min_mtime = time.time() - EVICT_MIN_AGE
+            derived = {}
+            for entry in os.scandir(self._path("derived")):
+                derived[entry.name] = sum(
+                    f.stat().st_size for f in os.scandir(entry.path))
+            blobs = []
+            for entry in os.scandir(self._path("blobs")):
+                stat = entry.stat()
+                blobs.append((stat.st_mtime,
+                              stat.st_size + derived.pop(entry.name, 0),
+                              entry.path))
+            # derived files of blobs that no longer exist
+            for name in derived:
+                shutil.rmtree(self._path("derived", name), ignore_errors=True)
+            total = sum(size for _, size, _ in blobs)
+            for mtime, size, path in sorted(blobs):
+                if total <= self.max_size:
+                    break
+                if path == keep or mtime > min_mtime:
+                    continue
+                logging.info("Evicting {} from download cache.".format(path))
+                os.remove(path)
+                shutil.rmtree(self._path("derived", os.path.basename(path)),
+                              ignore_errors=True)
+                total -= size
@@ -0,0 +1,83 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2015, Johannes Köster, Liu lab"
+__email__ = "koester@jimmy.harvard.edu"
+__license__ = "MIT"
+
+"""
+Run time and memory metrics of commands and workflow rules.
+"""
+
+import os
+import csv
+import json
+import glob
+import time
+import resource
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def _cpu_seconds():
+    # CPU time of this process and of its terminated child processes
+    # (e.g. the workers of a process pool)
+    return sum(usage.ru_utime + usage.ru_stime for usage in (
+        resource.getrusage(resource.RUSAGE_SELF),
+        resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+
+def _peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is given in KB on Linux; for RUSAGE_CHILDREN, it is the peak
+    # of the largest terminated child, not of all children together
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+class PhaseMetrics():
+    def __init__(self):
+        self.phases = OrderedDict()
+
+    @contextmanager
+    def phase(self, name, rate=None):
+        """
+        Measure wall time, CPU time and peak memory of a phase. The yielded
+        dict can be used to record additional values (e.g. counts). If rate
+        is the name of such a value, its rate is added as <rate>_per_second.
+        """
+        values = OrderedDict()
+        wall = time.perf_counter()
+        cpu = _cpu_seconds()
+        yield values
+        values["wall_seconds"] = time.perf_counter() - wall
+        values["cpu_seconds"] = _cpu_seconds() - cpu
+        if rate is not None:
+            values[rate + "_per_second"] = values[rate] / values["wall_seconds"]
+        # the peaks of the process and of its largest terminated child (e.g.
+        # a worker of a process pool) up to the end of this phase
+        values["peak_rss_mb"] = _peak_rss_mb()
+        values["max_child_rss_mb"] = _peak_rss_mb(resource.RUSAGE_CHILDREN)
+        self.phases[name] = values
+
+    def write(self, path):
+        with open(path, "w") as out:
+            json.dump({"phases": self.phases}, out, indent=2)
+
+
+def aggregate_benchmarks(benchmark_dir, output):
+    """
+    Combine the benchmark files of Snakemake rules, stored as
+    benchmark_dir/{rule}/{job}.tsv, into a single table with a row per job.
+    """
+    rows = []
+    columns = ["rule", "job"]
+    for path in sorted(glob.glob(os.path.join(benchmark_dir, "*", "*.tsv"))):
+        rule = os.path.basename(os.path.dirname(path))
+        job = os.path.splitext(os.path.basename(path))[0]
+        with open(path) as f:
+            for row in csv.DictReader(f, delimiter="\t"):
+                columns.extend(c for c in row if c not in columns)
+                row.update(rule=rule, job=job)
+                rows.append(row)
+    with open(output, "w") as out:
+        writer = csv.DictWriter(out, columns, delimiter="\t", restval="NA",
+                                lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
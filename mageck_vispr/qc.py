@@ -0,0 +1,256 @@
+__author__ = "Johannes Köster"
+__copyright__ = "Copyright 2015, Johannes Köster, Liu lab"
+__email__ = "koester@jimmy.harvard.edu"
+__license__ = "MIT"
+
+"""
+Streaming read quality control with FastQC compatible output.
+
+Each FASTQ file is read once, in batches of reads. The bases and qualities of
+a batch are concatenated into flat arrays and counted per read position with
+numpy.bincount, so the per-read cost is independent of the read length. The
+statistics are written as fastqc_data.txt (the modules shown by VISPR), such
+that the reports can be used in place of those of FastQC.
+"""
+
+import os
+import bz2
+import gzip
+import logging
+from itertools import islice
+
+import numpy as np
+
+
+# version of the FastQC report format that is written
+FASTQC_VERSION = "0.11.9"
+BATCH_SIZE = 100000
+
+# bases in the column order of FastQC, anything else is counted as N
+_BASES = "GATC"
+_BASE_CODES = np.full(256, 4, dtype=np.int64)
+for i, base in enumerate(_BASES):
+    _BASE_CODES[ord(base)] = i
+    _BASE_CODES[ord(base.lower())] = i
+
+_ENCODINGS = {33: "Sanger / Illumina 1.9", 64: "Illumina 1.5"}
+_SUFFIXES = [".gz", ".bz2", ".txt", ".fastq", ".fq", ".csfastq", ".sam", ".bam"]
+
+
+def open_fastq(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    return open(path, "rb")
+
+
+def report_name(path):
+    """
+    Return the name FastQC would use for the report of the given file.
+    """
+    name = os.path.basename(path)
+    for suffix in _SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+
+def head_fastq(fastq, output, reads):
+    """
+    Write the first reads of a FASTQ file to a gzip compressed file. Unlike
+    random sampling, this only reads the beginning of the file and keeps
+    paired files in sync. The output only depends on the reads (the gzip
+    header has neither name nor time), such that the count store recognizes
+    unchanged previews.
+    """
+    with open_fastq(fastq) as f, open(output, "wb") as raw, \
+            gzip.GzipFile(filename="", mode="wb", compresslevel=1, fileobj=raw,
+                          mtime=0) as out:
+        out.writelines(islice(f, 4 * reads))
+
+
+def read_batches(path, batch_size=BATCH_SIZE):
+    """
+    Yield lists of sequences and qualities of batches of reads.
+    """
+    with open_fastq(path) as f:
+        while True:
+            lines = list(islice(f, 4 * batch_size))
+            if not lines:
+                return
+            if len(lines) % 4 or not lines[0].startswith(b"@"):
+                raise SyntaxError("Invalid FASTQ file {}.".format(path))
+            yield ([line.rstrip() for line in lines[1::4]],
+                   [line.rstrip() for line in lines[3::4]])
+
+
+class ReadStats():
+    def __init__(self):
+        self.reads = 0
+        # counts per position of bases (G, A, T, C, N) and of quality characters
+        self.base_counts = np.zeros((0, 5), dtype=np.int64)
+        self.qual_counts = np.zeros((0, 128), dtype=np.int64)
+        self.length_counts = np.zeros(1, dtype=np.int64)
+        # counts of the mean quality character and GC percentage of reads
+        self.mean_qual_counts = np.zeros(128, dtype=np.int64)
+        self.gc_counts = np.zeros(101, dtype=np.int64)
+
+    def _grow(self, length):
+        missing = length - len(self.base_counts)
+        if missing > 0:
+            self.base_counts = np.vstack(
+                [self.base_counts, np.zeros((missing, 5), dtype=np.int64)])
+            self.qual_counts = np.vstack(
+                [self.qual_counts, np.zeros((missing, 128), dtype=np.int64)])
+        if length + 1 > len(self.length_counts):
+            self.length_counts = np.concatenate([
+                self.length_counts,
+                np.zeros(length + 1 - len(self.length_counts), dtype=np.int64)])
+
+    def add(self, seqs, quals):
+        """
+        Add a batch of reads, given as lists of sequences and qualities.
+        """
+        lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+        seq = np.frombuffer(b"".join(seqs), dtype=np.uint8)
+        qual = np.frombuffer(b"".join(quals), dtype=np.uint8)
+        if len(seq) != len(qual) or np.any(
+                lengths != np.fromiter(map(len, quals), dtype=np.int64,
+                                       count=len(quals))):
+            raise SyntaxError("Sequence and quality of a read differ in length.")
+        if np.any(qual >= 128):
+            raise SyntaxError("Invalid quality character.")
+        length = int(lengths.max()) if len(lengths) else 0
+        self._grow(length)
+        self.reads += len(seqs)
+
+        starts = np.cumsum(lengths) - lengths
+        read = np.repeat(np.arange(len(seqs)), lengths)
+        pos = np.arange(len(seq)) - starts[read]
+        codes = _BASE_CODES[seq]
+        size = len(self.base_counts)
+        self.base_counts += np.bincount(
+            pos * 5 + codes, minlength=size * 5).reshape(size, 5)
+        self.qual_counts += np.bincount(
+            pos * 128 + qual, minlength=size * 128).reshape(size, 128)
+        self.length_counts += np.bincount(
+            lengths, minlength=len(self.length_counts))
+
+        nonempty = lengths > 0
+        lengths = lengths[nonempty]
+        qual_sum = np.bincount(
+            read, weights=qual, minlength=len(seqs))[nonempty].astype(np.int64)
+        gc = np.bincount(read, weights=(codes == 0) | (codes == 3),
+                         minlength=len(seqs))[nonempty]
+        # like FastQC, the mean quality of a read is truncated
+        self.mean_qual_counts += np.bincount(qual_sum // lengths, minlength=128)
+        self.gc_counts += np.bincount(
+            np.rint(gc / lengths * 100).astype(np.int64), minlength=101)
+
+    def offset(self):
+        """
+        Return the offset of the quality encoding (33 or 64).
+        """
+        used = np.flatnonzero(self.qual_counts.sum(axis=0))
+        if len(used) and used[0] < 33:
+            raise SyntaxError("Invalid quality character.")
+        return 64 if len(used) and used[0] >= 64 else 33
+
+
+def _percentile(counts, values, p):
+    cumsum = np.cumsum(counts)
+    return values[np.searchsorted(cumsum, cumsum[-1] * p / 100)]
+
+
+def _module(out, name, status, header, rows):
+    out.write(">>{}\t{}\n".format(name, status))
+    out.write("#" + "\t".join(header) + "\n")
+    for row in rows:
+        out.write("\t".join(map(str, row)) + "\n")
+    out.write(">>END_MODULE\n")
+
+
+def write_report(stats, filename, out):
+    """
+    Write the statistics in the format of fastqc_data.txt.
+    """
+    offset = stats.offset()
+    out.write("##FastQC\t{}\n".format(FASTQC_VERSION))
+
+    lengths = np.flatnonzero(stats.length_counts)
+    base_counts = stats.base_counts
+    acgt = base_counts[:, :4].sum()
+    gc = base_counts[:, [0, 3]].sum()
+    _module(out, "Basic Statistics", "pass", ["Measure", "Value"], [
+        ["Filename", filename],
+        ["File type", "Conventional base calls"],
+        ["Encoding", _ENCODINGS[offset]],
+        ["Total Sequences", stats.reads],
+        ["Sequences flagged as poor quality", 0],
+        ["Sequence length", "0" if not len(lengths) else
+         str(lengths[0]) if lengths[0] == lengths[-1] else
+         "{}-{}".format(lengths[0], lengths[-1])],
+        ["%GC", int(round(gc / acgt * 100)) if acgt else 0],
+    ])
+
+    qualities = np.arange(128) - offset
+    rows = []
+    status = "pass"
+    for pos, counts in enumerate(stats.qual_counts):
+        total = counts.sum()
+        if not total:
+            continue
+        mean = (counts * qualities).sum() / total
+        percentiles = [_percentile(counts, qualities, p) for p in (50, 25, 75, 10, 90)]
+        median, lower = percentiles[0], percentiles[1]
+        if lower < 5 or median < 20:
+            status = "fail"
+        elif status == "pass" and (lower < 10 or median < 25):
+            status = "warn"
+        rows.append([pos + 1, mean] + percentiles)
+    _module(out, "Per base sequence quality", status,
+            ["Base", "Mean", "Median", "Lower Quartile", "Upper Quartile",
+             "10th Percentile", "90th Percentile"], rows)
+
+    used = np.flatnonzero(stats.mean_qual_counts)
+    _module(out, "Per sequence quality scores", "pass", ["Quality", "Count"], [
+        [q - offset, float(stats.mean_qual_counts[q])]
+        for q in range(used[0], used[-1] + 1)] if len(used) else [])
+
+    rows = []
+    max_diff = 0
+    for pos, counts in enumerate(base_counts):
+        total = counts[:4].sum()
+        if not counts.sum():
+            continue
+        g, a, t, c = counts[:4] / total * 100 if total else np.zeros(4)
+        max_diff = max(max_diff, abs(a - t), abs(g - c))
+        rows.append([pos + 1, g, a, t, c])
+    status = "fail" if max_diff > 20 else "warn" if max_diff > 10 else "pass"
+    _module(out, "Per base sequence content", status,
+            ["Base"] + list(_BASES), rows)
+
+    _module(out, "Per sequence GC content", "pass", ["GC Content", "Count"], [
+        [i, float(count)] for i, count in enumerate(stats.gc_counts)])
+
+    _module(out, "Sequence Length Distribution", "pass", ["Length", "Count"], [
+        [length, float(stats.length_counts[length])]
+        for length in range(lengths[0], lengths[-1] + 1)] if len(lengths) else [])
+
+
+def qc(fastq, outdir, batch_size=BATCH_SIZE):
+    """
+    Compute the quality statistics of a FASTQ file and write them to
+    {outdir}/{name}_fastqc/fastqc_data.txt. Returns the path of the report.
+    """
+    stats = ReadStats()
+    for seqs, quals in read_batches(fastq, batch_size):
+        stats.add(seqs, quals)
+    report_dir = os.path.join(outdir, report_name(fastq) + "_fastqc")
+    os.makedirs(report_dir, exist_ok=True)
+    report = os.path.join(report_dir, "fastqc_data.txt")
+    with open(report, "w") as out:
+        write_report(stats, os.path.basename(fastq), out)
+    logging.info("Analyzed {} reads of {}.".format(stats.reads, fastq))
+    return report
@@ -0,0 +1,254 @@
+__author__ = "Chen-Hao Chen"
+__copyright__ = "Copyright 2015, Chen-Hao Chen, Liu lab"
+__email__ = "hyalin1127@gmail.com"
+__license__ = "MIT"
+
+"""
+Coordinate-sorted, BGZF compressed BED files with a tabix index.
+
+The index (file suffix .tbi) follows the tabix format of htslib with the
+BED preset, such that the files can also be queried with tabix, pysam or
+IGV. Each chromosome has a binning index, assigning the records to the
+smallest of a hierarchy of bins (of 16 kb up to 512 Mb) containing them,
+and a linear index, holding the virtual offset of the first record
+overlapping each 16 kb window. A region query thus only decompresses the
+few BGZF blocks that hold records near the region.
+"""
+
+import gzip
+import struct
+from collections import OrderedDict
+
+from mageck_vispr.bgzf import BgzfWriter, BgzfReader
+
+
+TABIX_SUFFIX = ".tbi"
+TABIX_MAGIC = b"TBI\1"
+# BED preset of tabix: 0-based, half-open coordinates in columns 1-3
+TBX_UCSC = 0x10000
+# size of the windows of the linear index and number of binning levels
+MIN_SHIFT = 14
+DEPTH = 5
+
+_INT = struct.Struct("<i")
+_UINT64 = struct.Struct("<Q")
+_CHUNK = struct.Struct("<QQ")
+_CONF = struct.Struct("<4siiiiiiii")
+
+
+def index_path(bed):
+    return bed + TABIX_SUFFIX
+
+
+def reg2bin(start, end):
+    """
+    Return the smallest bin containing the interval [start, end).
+    """
+    end -= 1
+    shift, first = MIN_SHIFT, ((1 << 3 * DEPTH) - 1) // 7
+    for level in range(DEPTH, 0, -1):
+        if start >> shift == end >> shift:
+            return first + (start >> shift)
+        shift += 3
+        first -= 1 << 3 * (level - 1)
+    return 0
+
+
+def reg2bins(start, end):
+    """
+    Return all bins that may contain records overlapping [start, end).
+    """
+    end -= 1
+    bins = [0]
+    shift, first = MIN_SHIFT + 3 * (DEPTH - 1), 1
+    for level in range(1, DEPTH + 1):
+        bins.extend(range(first + (start >> shift), first + (end >> shift) + 1))
+        first += 1 << 3 * level
+        shift -= 3
+    return bins
+
+
+def _interval(fields):
+    start, end = int(fields[1]), int(fields[2])
+    # as tabix, records of length 0 are treated as if they were of length 1
+    return start, max(end, start + 1)
+
+
+def bed_sort_key(line):
+    fields = line.split("\t", 3)
+    return fields[0], int(fields[1]), int(fields[2])
+
+
+def write_indexed_bed(lines, path):
+    """
+    Sort BED lines by chromosome and start, write them to path with bgzip
+    and create the tabix index path.tbi. Lines starting with # are kept
+    at the top.
+    """
+    header = [line for line in lines if line.startswith("#")]
+    records = sorted((line for line in lines if not line.startswith("#")),
+                     key=bed_sort_key)
+    refs = OrderedDict()
+    writer = BgzfWriter(path)
+    try:
+        for line in header:
+            writer.write(line.encode())
+        for line in records:
+            fields = line.split("\t", 3)
+            start, end = _interval(fields)
+            offset = writer.virtual_offset()
+            writer.write(line.encode())
+            ref = refs.get(fields[0])
+            if ref is None:
+                ref = refs[fields[0]] = (OrderedDict(), [])
+            bins, linear = ref
+            chunks = bins.setdefault(reg2bin(start, end), [])
+            if chunks and chunks[-1][1] == offset:
+                chunks[-1][1] = writer.virtual_offset()
+            else:
+                chunks.append([offset, writer.virtual_offset()])
+            last = (end - 1) >> MIN_SHIFT
+            if len(linear) <= last:
+                linear.extend([None] * (last + 1 - len(linear)))
+            for window in range(start >> MIN_SHIFT, last + 1):
+                if linear[window] is None:
+                    linear[window] = offset
+    finally:
+        writer.close()
+
+    names = b"".join(name.encode() + b"\0" for name in refs)
+    index = BgzfWriter(index_path(path))
+    try:
+        index.write(_CONF.pack(TABIX_MAGIC, len(refs), TBX_UCSC, 1, 2, 3,
+                               ord("#"), 0, len(names)) + names)
+        for bins, linear in refs.values():
+            data = [_INT.pack(len(bins))]
+            for b, chunks in bins.items():
+                data.append(struct.pack("<Ii", b, len(chunks)))
+                data.extend(_CHUNK.pack(*chunk) for chunk in chunks)
+            # windows without records get the offset of the preceding one
+            previous = 0
+            for window, offset in enumerate(linear):
+                if offset is None:
+                    linear[window] = previous
+                previous = linear[window]
+            data.append(_INT.pack(len(linear)))
+            data.extend(_UINT64.pack(offset) for offset in linear)
+            index.write(b"".join(data))
+    finally:
+        index.close()
+    return path
+
+
+class TabixIndex():
+    def __init__(self, path):
+        with gzip.open(path, "rb") as f:
+            data = f.read()
+        (magic, n_ref, self.format, self.col_seq, self.col_beg, self.col_end,
+         self.meta, self.skip, l_nm) = _CONF.unpack_from(data, 0)
+        if magic != TABIX_MAGIC:
+            raise SyntaxError("{} is not a valid tabix index.".format(path))
+        pos = _CONF.size
+        names = data[pos:pos + l_nm].split(b"\0")[:n_ref]
+        pos += l_nm
+        self.refs = {}
+        for name in names:
+            bins = {}
+            n_bin, = _INT.unpack_from(data, pos)
+            pos += 4
+            for _ in range(n_bin):
+                b, n_chunk = struct.unpack_from("<Ii", data, pos)
+                pos += 8
+                bins[b] = [_CHUNK.unpack_from(data, pos + i * _CHUNK.size)
+                           for i in range(n_chunk)]
+                pos += n_chunk * _CHUNK.size
+            n_intv, = _INT.unpack_from(data, pos)
+            pos += 4
+            linear = struct.unpack_from("<{}Q".format(n_intv), data, pos)
+            pos += n_intv * 8
+            self.refs[name.decode()] = (bins, linear)
+
+    def chunks(self, chrom, start, end):
+        """
+        Return the sorted, non-overlapping chunks of virtual offsets that
+        hold all records of chrom overlapping [start, end).
+        """
+        if chrom not in self.refs:
+            return []
+        bins, linear = self.refs[chrom]
+        window = start >> MIN_SHIFT
+        min_offset = linear[window] if window < len(linear) else (
+            linear[-1] if linear else 0)
+        chunks = sorted(chunk for b in reg2bins(start, end)
+                        for chunk in bins.get(b, ()) if chunk[1] > min_offset)
+        merged = []
+        for chunk_start, chunk_end in chunks:
+            if merged and chunk_start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], chunk_end)
+            else:
+                merged.append([chunk_start, chunk_end])
+        return merged
+
+
+def fetch(path, chrom, start, end, index=None):
+    """
+    Yield the lines of an indexed BED file that overlap the region
+    [start, end) of chrom.
+    """
+    if index is None:
+        index = TabixIndex(index_path(path))
+    with BgzfReader(path) as reader:
+        for chunk_start, chunk_end in index.chunks(chrom, start, end):
+            reader.seek(chunk_start)
+            while reader.tell() < chunk_end:
+                line = reader.readline().decode()
+                if not line:
+                    break
+                fields = line.split("\t", 3)
+                record_start, record_end = _interval(fields)
+                if fields[0] != chrom or record_start >= end:
+                    break
+                if record_end > start:
+                    yield line.rstrip("\n")
+
+
+def index_bed(bed, output=None):
+    """
+    Write a sorted, bgzip compressed and tabix indexed copy of a (plain or
+    gzip compressed) BED file.
+    """
+    if output is None:
+        output = bed + ".gz"
+    opener = gzip.open if bed.endswith(".gz") else open
+    with opener(bed, "rt") as f:
+        lines = [line if line.endswith("\n") else line + "\n"
+                 for line in f if line.strip()]
+    return write_indexed_bed(lines, output)
+
+
+class SortedBedWriter():
+    """
+    File-like object collecting BED lines that are written sorted by
+    chromosome and start when closed: with bgzip compression (the default
+    for paths ending with .gz) together with a tabix index, otherwise as
+    text.
+    """
+    def __init__(self, path=None, compression=None):
+        self.path = path
+        self.compression = compression
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def close(self):
+        from mageck_vispr.annotation import open_output
+        compression = self.compression
+        if compression is None and self.path is not None and self.path.endswith(".gz"):
+            compression = "bgzip"
+        if compression == "bgzip":
+            write_indexed_bed(self.lines, self.path)
+        else:
+            with open_output(self.path, compression) as out:
+                out.writelines(sorted(self.lines, key=bed_sort_key))
+        self.lines = []
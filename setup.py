@@ -32,6 +32,7 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=["jinja2"],
+    extras_require={"bundle": ["pandas", "pyarrow"]},
     entry_points={"console_scripts": ["mageck-vispr = mageck_vispr.cli:main"]},
     classifiers=[
         "Development Status :: 4 - Beta",
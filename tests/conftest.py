@@ -0,0 +1,76 @@
+"""
+Synthetic sgRNA libraries and annotation tables shared by the tests.
+"""
+
+import random
+import argparse
+
+import pytest
+
+from mageck_vispr.download import DEFAULT_CACHE_SIZE
+
+
+def random_sequence(rng, length):
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+def write_table(path, rows):
+    with open(path, "w") as f:
+        for row in rows:
+            f.write("\t".join(map(str, row)) + "\n")
+
+
+def write_library(path, sgrnas):
+    with open(path, "w") as f:
+        for sgrna in sgrnas:
+            f.write(",".join(sgrna) + "\n")
+
+
+def annotate_args(library, **options):
+    """
+    Return the arguments of annotate-library for the given libraries, with
+    the defaults of the command line interface.
+    """
+    args = dict(library=library, annotation_table=None,
+                annotation_table_folder=None, assembly=None, sgrna_len=None,
+                threads=1, parser="vectorized", annotation_table_sha256=None,
+                cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, no_cache=True,
+                bedvalue=None, bedvalue_column=None, output=None,
+                compression=None, sort=False, unmatched=None, server=None,
+                metrics=None)
+    args.update(options)
+    return argparse.Namespace(**args)
+
+
+@pytest.fixture
+def annotation_data(tmp_path):
+    """
+    A 20bp annotation table and two libraries holding some of its
+    sequences, with some sequences missing from the table and some
+    annotated with another gene. Sequences may occur at several sites.
+    """
+    rng = random.Random(1)
+    rows = []
+    libraries = [[], []]
+    for i in range(3000):
+        seq = random_sequence(rng, 20)
+        gene = "GENE{}".format(i // 5)
+        sites = 2 if i % 17 == 0 else 1
+        for _ in range(sites):
+            start = rng.randrange(1, 10 ** 6)
+            rows.append(("chr{}".format(rng.randrange(1, 4)), start, start + 20,
+                         gene, round(rng.random(), 4), rng.choice("+-"), seq))
+        if i % 3 == 0:
+            libraries[i % 2].append(
+                ("sg{}".format(i), seq, "OTHER" if i % 31 == 0 else gene))
+    for i in range(20):
+        libraries[i % 2].append(("missing{}".format(i),
+                                 random_sequence(rng, 20), "GENE0"))
+    table = str(tmp_path / "table.txt")
+    write_table(table, rows)
+    paths = []
+    for i, sgrnas in enumerate(libraries):
+        paths.append(str(tmp_path / "library{}.csv".format(i)))
+        write_library(paths[-1], sgrnas)
+    return argparse.Namespace(table=table, libraries=paths, rows=rows,
+                              sgrnas=libraries)
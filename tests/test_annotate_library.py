@@ -0,0 +1,234 @@
+"""
+Tests for annotate-library on synthetic libraries and annotation tables.
+"""
+
+import bz2
+import gzip
+import random
+
+import pytest
+
+from mageck_vispr import cli, annotation
+
+from conftest import annotate_args, random_sequence, write_library, write_table
+
+
+def _expected(data, lib):
+    """
+    Return the BED lines and unmatched report lines of a library, following
+    the rules of Annotator.write_record: sites of the sgRNA's gene, or the
+    last site if the gene does not match any of them.
+    """
+    sites = {}
+    for row in data.rows:
+        sites.setdefault(row[6], []).append(row)
+    bed = []
+    unmatched = []
+    for sgrna, seq, gene in data.sgrnas[lib]:
+        rows = sites.get(seq)
+        if rows is None:
+            unmatched.append(["sequence not found", sgrna, seq, gene, "", "",
+                              "", ""])
+            continue
+        same_gene = [row for row in rows if row[3] == gene]
+        if not same_gene:
+            row = rows[-1]
+            unmatched.append(["gene not matched", sgrna, seq, gene] +
+                             [str(v) for v in row[:3]] + [row[3]])
+        for row in same_gene or rows[-1:]:
+            bed.append("\t".join(map(str, row[:3] + (sgrna, row[4], row[5]))))
+    return sorted(bed), sorted(unmatched)
+
+
+def _read(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as f:
+        return f.read().splitlines()
+
+
+def _annotate(data, tmp_path, suffix=".bed", **options):
+    n = len(data.libraries)
+    args = annotate_args(
+        data.libraries, annotation_table=data.table,
+        output=[str(tmp_path / "lib{}{}".format(i, suffix)) for i in range(n)],
+        unmatched=[str(tmp_path / "lib{}.tsv".format(i)) for i in range(n)],
+        **options)
+    cli.annotate_library(args)
+    return args
+
+
+@pytest.mark.parametrize("suffix,compression", [(".bed", None),
+                                                (".bed.gz", None),
+                                                (".bed.gz", "gzip")])
+def test_bed_output(annotation_data, tmp_path, suffix, compression):
+    args = _annotate(annotation_data, tmp_path, suffix, compression=compression)
+    for lib, (output, report) in enumerate(zip(args.output, args.unmatched)):
+        bed, unmatched = _expected(annotation_data, lib)
+        assert sorted(_read(output)) == bed
+        lines = [line.split("\t") for line in _read(report)]
+        assert lines[0] == ["reason", "sgrna", "sequence", "gene", "chrom",
+                            "start", "end", "annotated_gene"]
+        assert sorted(lines[1:]) == unmatched
+        assert any(line[0] == "gene not matched" for line in lines)
+        assert any(line[0] == "sequence not found" for line in lines)
+
+
+def test_bgzip_output(annotation_data, tmp_path):
+    args = _annotate(annotation_data, tmp_path, ".bed.gz")
+    with open(args.output[0], "rb") as f:
+        # BGZF blocks carry the BC extra field
+        assert f.read(16)[12:14] == b"BC"
+
+
+def test_stdout_output(annotation_data, tmp_path, capfd):
+    args = annotate_args(annotation_data.libraries[0],
+                         annotation_table=annotation_data.table)
+    cli.annotate_library(args)
+    bed, _ = _expected(annotation_data, 0)
+    assert sorted(capfd.readouterr().out.splitlines()) == bed
+
+
+def test_bedvalue(annotation_data, tmp_path):
+    values = str(tmp_path / "values.txt")
+    with open(values, "w") as f:
+        f.write("sgrna\tLFC\n")
+        for sgrna in annotation_data.sgrnas[0][::2]:
+            f.write("{}\t{}\n".format(sgrna[0], len(sgrna[0])))
+    scores = {sgrna[0]: str(len(sgrna[0]))
+              for sgrna in annotation_data.sgrnas[0][::2]}
+    args = _annotate(annotation_data, tmp_path, bedvalue=values,
+                     bedvalue_column="LFC")
+    for line in _read(args.output[0]):
+        fields = line.split("\t")
+        assert fields[4] == scores.get(fields[3], "0")
+
+
+def test_libraries(annotation_data, tmp_path, monkeypatch):
+    # a third library shares sequences with the first one
+    shared = [("shared{}".format(i), seq, "GENE{}".format(i))
+              for i, (_, seq, _) in enumerate(annotation_data.sgrnas[0][:40])]
+    path = str(tmp_path / "shared.csv")
+    write_library(path, shared)
+    annotation_data.libraries.append(path)
+    annotation_data.sgrnas.append(shared)
+    scans = []
+    scan_table = annotation.scan_table
+
+    def counting_scan_table(file, *args):
+        scans.append(file.name)
+        return scan_table(file, *args)
+    monkeypatch.setattr(annotation, "scan_table", counting_scan_table)
+    # outputs are mapped to the libraries in the given order
+    annotation_data.libraries.reverse()
+    annotation_data.sgrnas.reverse()
+    args = _annotate(annotation_data, tmp_path)
+    # the table is scanned once
+    assert scans == [annotation_data.table]
+    for lib, output in enumerate(args.output):
+        assert sorted(_read(output)) == _expected(annotation_data, lib)[0]
+        single = annotate_args(annotation_data.libraries[lib],
+                               annotation_table=annotation_data.table,
+                               output=str(tmp_path / "single.bed"))
+        cli.annotate_library(single)
+        assert _read(output) == _read(single.output)
+
+
+def test_libraries_outputs(annotation_data, tmp_path):
+    args = annotate_args(annotation_data.libraries,
+                         annotation_table=annotation_data.table,
+                         output=[str(tmp_path / "lib.bed")])
+    with pytest.raises(SyntaxError, match="one --output"):
+        cli.annotate_library(args)
+
+
+def _annotate_table(tmp_path, rows, sgrnas):
+    table = str(tmp_path / "lengths.txt")
+    write_table(table, rows)
+    library = str(tmp_path / "lengths.csv")
+    write_library(library, sgrnas)
+    args = annotate_args([library], annotation_table=table,
+                         output=[str(tmp_path / "lengths.bed")],
+                         unmatched=[str(tmp_path / "lengths.tsv")])
+    cli.annotate_library(args)
+    report = {line.split("\t")[1]: line.split("\t")[0]
+              for line in _read(args.unmatched[0])[1:]}
+    return sorted(_read(args.output[0])), report
+
+
+def _other_base(base):
+    return "A" if base != "A" else "C"
+
+
+def test_sgrna_lengths(tmp_path):
+    rng = random.Random(2)
+    s1, s2 = random_sequence(rng, 20), random_sequence(rng, 20)
+    rows = [("chr1", 1000, 1020, "GENEA", 0.1, "+", s1),
+            ("chr1", 2000, 2020, "GENEB", 0.2, "-", s2)]
+    bed, report = _annotate_table(tmp_path, rows, [
+        ("full", s1, "GENEA"),
+        ("short_plus", s1[1:], "GENEA"),
+        ("short_minus", s2[1:], "GENEB"),
+        ("long", "G" + s1, "GENEA"),
+        ("mismatch", _other_base(s1[0]) + s1[1:], "GENEA"),
+        ("tiny", s1[4:], "GENEA"),
+    ])
+    # sites are moved to the 5' end of the library sequence
+    assert bed == sorted([
+        "chr1\t1000\t1020\tfull\t0.1\t+",
+        "chr1\t1001\t1020\tshort_plus\t0.1\t+",
+        "chr1\t2000\t2019\tshort_minus\t0.2\t-",
+        "chr1\t999\t1020\tlong\t0.1\t+",
+    ])
+    assert report == {"long": "1 bases not verified",
+                      "mismatch": "sequence not found",
+                      "tiny": "length not supported"}
+
+
+def test_partial_matches(tmp_path):
+    rng = random.Random(3)
+    t, u, v = (random_sequence(rng, 20) for _ in range(3))
+    rows = [
+        # a full-length and a partial match at different sites
+        ("chr2", 100, 120, "GENEC", 0.1, "+", t),
+        ("chr3", 500, 519, "GENEC", 0.2, "+", t[1:]),
+        # only a partial match
+        ("chr4", 10, 29, "GENED", 0.3, "+", u[1:]),
+        # the same site found by sequences of both lengths
+        ("chr5", 100, 120, "GENEE", 0.4, "-", v),
+        ("chr5", 100, 119, "GENEE", 0.4, "-", v[1:]),
+    ]
+    bed, report = _annotate_table(tmp_path, rows, [
+        ("t", t, "GENEC"), ("u", u, "GENED"), ("v", v, "GENEE")])
+    assert bed == sorted([
+        "chr2\t100\t120\tt\t0.1\t+",
+        "chr4\t9\t29\tu\t0.3\t+",
+        "chr5\t100\t120\tv\t0.4\t-",
+    ])
+    assert report == {"u": "1 bases not verified"}
+
+
+def test_table_per_length(tmp_path):
+    # the precomputed tables of 19 and 20bp place the same sgRNA at
+    # different sites, such that the table used can be told from the BED
+    rng = random.Random(4)
+    s = random_sequence(rng, 21)
+    folder = tmp_path / "tables"
+    folder.mkdir()
+    for length, chrom in ((19, "chr19"), (20, "chr20")):
+        path = folder / "sgrna_annotation_hg38_exome_{}bp.txt.bz2".format(length)
+        with bz2.open(str(path), "wt") as f:
+            f.write("{}\t100\t{}\tGENEA\t0.5\t+\t{}\n".format(
+                chrom, 100 + length, s[-length:]))
+    library = str(tmp_path / "library.csv")
+    write_library(library, [("sg{}".format(length), s[-length:], "GENEA")
+                            for length in (18, 19, 20, 21)])
+    args = annotate_args([library], assembly="hg38",
+                         annotation_table_folder=str(folder),
+                         output=[str(tmp_path / "library.bed")])
+    cli.annotate_library(args)
+    assert sorted(_read(args.output[0])) == [
+        "chr19\t100\t119\tsg19\t0.5\t+",
+        "chr19\t101\t119\tsg18\t0.5\t+",
+        "chr20\t100\t120\tsg20\t0.5\t+",
+        "chr20\t99\t120\tsg21\t0.5\t+",
+    ]
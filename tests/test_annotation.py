@@ -0,0 +1,241 @@
+"""
+Tests for parsing and matching annotation tables.
+"""
+
+import io
+import gzip
+import random
+
+import numpy as np
+import pytest
+
+from mageck_vispr import annotation
+from mageck_vispr.annotation import (scan_block, scan_table, SequenceFilter,
+                                     encode_sequence, decode_sequence,
+                                     sequence_length, sequence_suffix,
+                                     pack_sequences, valid_sequences,
+                                     iter_chunks, parallel_scan)
+from mageck_vispr.annotation_index import parse_line
+
+from conftest import random_sequence, write_table
+
+
+SEQ = "ACGTACGTACGTACGTACGT"
+OTHER = "TTTTACGTACGTACGTACGT"
+
+
+def _line(start="100", end="120", score="0.5", seq=SEQ, gene="GENE"):
+    return "chr1\t{}\t{}\t{}\t{}\t+\t{}".format(start, end, gene, score, seq)
+
+
+def _reference(lines, sequences, core_length=None):
+    # the original line by line parser
+    matches = []
+    for i, line in enumerate(lines):
+        try:
+            fields = parse_line(line, i)
+        except SyntaxError:
+            return i, matches, i
+        seq = fields[6][-core_length:] if core_length else fields[6]
+        if seq.upper() in sequences:
+            matches.append(fields)
+    return len(lines), matches, None
+
+
+LINES = {
+    "regular": [_line(), _line(seq=OTHER), _line("5", "25", "1")],
+    "crlf": [_line() + "\r", _line(seq=OTHER) + "\r"],
+    "lowercase": [_line(seq=SEQ.lower()), _line(seq="acgtACGTacgtACGTacgt")],
+    "ambiguous base": [_line(seq=SEQ[:-1] + "N"), _line()],
+    "blanks": [_line() + " ", " " + _line(), _line(seq=SEQ + "\t")],
+    "non-ascii gene": [_line(gene="GéNE"), _line()],
+    "invalid utf-8": [_line().encode(), b"chr1\t1\t2\t\xff\t0\t+\tA", _line().encode()],
+    "missing field": [_line(), "chr1\t1\t2\tGENE\t0.5\t+", _line()],
+    "extra field": [_line(), _line() + "\tx", _line()],
+    "header": ["chrom\tstart\tend\tgene\tscore\tstrand\tsequence", _line()],
+    "empty line": [_line(), "", _line()],
+}
+NUMBERS = ["1", "-3", "+4", "007", "1.5", "1-2", ".", "-", "--", "1.", ".5",
+           "-.5", "1e5", "1E5", "1e", "e5", "1.5e-3", "-1.5E+03", "1e+",
+           "1.2.3", "1e5e5", "+-1", "0x1", "1_0", " 5", "5 ", "inf", "nan",
+           ""]
+for number in NUMBERS:
+    LINES["start " + number] = [_line(), _line(start=number), _line()]
+    LINES["end " + number] = [_line(), _line(end=number), _line()]
+    LINES["score " + number] = [_line(), _line(score=number), _line()]
+
+
+@pytest.mark.parametrize("name", sorted(LINES))
+@pytest.mark.parametrize("core_length", [None, 19])
+def test_scan_block(name, core_length):
+    lines = [line if isinstance(line, bytes) else line.encode()
+             for line in LINES[name]]
+    block = b"\n".join(lines) + b"\n"
+    sequences = {SEQ[-core_length:] if core_length else SEQ}
+    sequence_filter = SequenceFilter({encode_sequence(seq) for seq in sequences},
+                                     core_length)
+    expected = _reference(lines, sequences, core_length)
+    for parser in ("vectorized", "python"):
+        assert scan_block(block, sequence_filter, parser) == expected
+    # the last line may lack its newline
+    for parser in ("vectorized", "python"):
+        assert scan_block(block[:-1], sequence_filter, parser) == expected
+
+
+@pytest.mark.parametrize("name", ["regular", "crlf", "lowercase",
+                                  "ambiguous base", "start -3", "score -.5",
+                                  "score 1.5e-3"])
+def test_scan_block_vectorized(name, monkeypatch):
+    # regular blocks are not handed to the line by line parser
+    def fail(block, sequence_filter):
+        raise AssertionError("line by line parser used")
+    monkeypatch.setattr(annotation, "_scan_lines", fail)
+    block = ("\n".join(LINES[name]) + "\n").encode()
+    sequence_filter = SequenceFilter({encode_sequence(SEQ)})
+    assert scan_block(block, sequence_filter) == _reference(
+        block[:-1].split(b"\n"), {SEQ})
+
+
+@pytest.mark.parametrize("parser", ["vectorized", "python"])
+def test_scan_table_error(parser):
+    lines = [_line(start=str(i)) for i in range(10)]
+    lines[7] = _line(score="x")
+    file = io.BytesIO(("\n".join(lines) + "\n").encode())
+    sequence_filter = SequenceFilter({encode_sequence(SEQ)})
+    with pytest.raises(SyntaxError, match="Error parsing line 7 in"):
+        list(scan_table(file, sequence_filter, parser))
+
+
+@pytest.mark.parametrize("length", [1, 2, 3, 4, 5, 19, 20, 28, 29])
+def test_encode_sequence(length):
+    rng = random.Random(length)
+    for _ in range(50):
+        seq = random_sequence(rng, length)
+        code = encode_sequence(seq)
+        assert isinstance(code, int)
+        assert decode_sequence(code) == seq
+        assert sequence_length(code) == length
+        assert encode_sequence(seq.lower()) == code
+        for k in range(1, length + 2):
+            assert sequence_suffix(code, k) == encode_sequence(seq[-k:])
+    # sequences differing only in length differ
+    assert encode_sequence("A" * length) != encode_sequence("A" * (length + 1))
+
+
+@pytest.mark.parametrize("seq", ["", "ACGN", "acgn", "AC GT", "ACG3", "ACGé",
+                                 "A" * 30])
+def test_encode_sequence_unpacked(seq):
+    code = encode_sequence(seq)
+    assert code == seq.upper()
+    assert decode_sequence(code) == seq.upper()
+    assert sequence_length(code) == len(seq)
+
+
+@pytest.mark.parametrize("width", [1, 4, 19, 20, 23, 29, 32, 40])
+def test_pack_sequences(width):
+    rng = random.Random(width)
+    alphabet = "ACGTacgtN0\t\n\x00"
+    rows = []
+    for i in range(500):
+        length = rng.randrange(width + 1)
+        if i % 2:
+            seq = random_sequence(rng, length)
+        else:
+            seq = "".join(rng.choice(alphabet) for _ in range(length))
+        # bytes after the sequence are ignored
+        padding = "".join(rng.choice(alphabet) for _ in range(width - length))
+        rows.append((seq, seq + padding))
+    chars = np.frombuffer("".join(row for _, row in rows).encode(),
+                          dtype=np.uint8).reshape(len(rows), width)
+    lengths = np.array([len(seq) for seq, _ in rows])
+    packed = pack_sequences(chars, lengths)
+    valid = valid_sequences(chars, lengths)
+    for (seq, _), code, is_valid in zip(rows, packed.tolist(), valid.tolist()):
+        expected = encode_sequence(seq)
+        assert is_valid == isinstance(expected, int)
+        if is_valid:
+            assert code == expected
+            assert decode_sequence(code) == seq.upper()
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    """
+    Split tables into small blocks, and count the blocks read.
+    """
+    read = []
+    iter_chunks = annotation.iter_chunks
+
+    def small(file):
+        for chunk in iter_chunks(file, 4096):
+            read.append(chunk)
+            yield chunk
+    monkeypatch.setattr(annotation, "iter_chunks", small)
+    return read
+
+
+def _sequence_set(annotation_data):
+    return {encode_sequence(sgrna[1]) for sgrnas in annotation_data.sgrnas
+            for sgrna in sgrnas}
+
+
+def _sequential(tables, sequence_set):
+    sequence_filter = SequenceFilter(sequence_set)
+    matches = []
+    stats = {}
+    for table in tables:
+        with annotation.open_table(table) as file:
+            matches.extend(scan_table(file, sequence_filter, stats=stats))
+    return matches, stats
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_parallel_scan(annotation_data, tmp_path, small_chunks, threads):
+    gz = str(tmp_path / "table.txt.gz")
+    with open(annotation_data.table, "rb") as f, gzip.open(gz, "wb") as out:
+        out.write(f.read())
+    tables = [annotation_data.table, gz]
+    sequence_set = _sequence_set(annotation_data)
+    expected, expected_stats = _sequential(tables, sequence_set)
+    stats = {}
+    assert list(parallel_scan(tables, sequence_set, threads,
+                              stats=stats)) == expected
+    assert stats == expected_stats
+    assert len(small_chunks) > 2 * len(tables) * threads
+
+
+def _total_chunks(table):
+    with open(table, "rb") as file:
+        return sum(1 for _ in iter_chunks(file, 4096))
+
+
+def test_parallel_scan_cancel(annotation_data, small_chunks):
+    sequence_set = _sequence_set(annotation_data)
+    scan = parallel_scan([annotation_data.table], sequence_set, 1)
+    next(scan)
+    scan.close()
+    # the reader stops once the scan is abandoned
+    assert len(small_chunks) < _total_chunks(annotation_data.table) / 2
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_parallel_scan_error(annotation_data, tmp_path, small_chunks, threads):
+    rows = list(annotation_data.rows)
+    rows[1000] = rows[1000][:4] + ("x",) + rows[1000][5:]
+    table = str(tmp_path / "broken.txt")
+    write_table(table, rows)
+    sequence_set = _sequence_set(annotation_data)
+    with pytest.raises(SyntaxError, match="Error parsing line 1000 in"):
+        list(parallel_scan([table, annotation_data.table], sequence_set,
+                           threads))
+    # the remaining blocks are not read
+    assert len(small_chunks) < (_total_chunks(table) +
+                                _total_chunks(annotation_data.table)) / 2
+
+
+def test_parallel_scan_missing_table(annotation_data, tmp_path):
+    sequence_set = _sequence_set(annotation_data)
+    tables = [annotation_data.table, str(tmp_path / "missing.txt")]
+    scan = parallel_scan(tables, sequence_set, 2)
+    with pytest.raises(FileNotFoundError):
+        list(scan)
@@ -0,0 +1,139 @@
+"""
+Tests for index-annotation and the lookup of library sequences in an
+annotation index instead of scanning the table.
+"""
+
+import os
+import random
+import argparse
+import threading
+from functools import partial
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+import pytest
+
+from mageck_vispr import cli, annotation
+from mageck_vispr.annotation_index import (AnnotationIndex, find_index,
+                                           CACHED_INDEX)
+from mageck_vispr.download import DownloadCache, DEFAULT_CACHE_SIZE
+
+from conftest import annotate_args, random_sequence, write_library, write_table
+
+
+def _index_args(table, **options):
+    args = dict(annotation_table=table, output=None, cache_dir=None,
+                cache_size=DEFAULT_CACHE_SIZE)
+    args.update(options)
+    return argparse.Namespace(**args)
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+def _annotate(data, tmp_path, name, table, **options):
+    n = len(data.libraries)
+    args = annotate_args(
+        data.libraries, annotation_table=table,
+        output=[str(tmp_path / "{}{}.bed".format(name, i)) for i in range(n)],
+        unmatched=[str(tmp_path / "{}{}.tsv".format(name, i)) for i in range(n)],
+        **options)
+    cli.annotate_library(args)
+    return [(_read(output), _read(report))
+            for output, report in zip(args.output, args.unmatched)]
+
+
+def test_index_annotation(annotation_data):
+    table = annotation_data.table
+    cli.index_annotation(_index_args(table))
+    assert find_index(table) == table + ".idx"
+    sites = {}
+    for row in annotation_data.rows:
+        sites.setdefault(row[6], []).append("\t".join(map(str, row)))
+    with AnnotationIndex(table + ".idx") as idx:
+        assert idx.n_keys == len(sites)
+        assert idx.key_lengths() == {20}
+        for seq, lines in sites.items():
+            assert [line.decode() for line in idx.lookup(seq)] == lines
+            assert [line.decode() for line in idx.lookup(seq.lower())] == lines
+        assert idx.lookup("A" * 20) == []
+        assert idx.lookup("A" * 21) == []
+    # a table changed after indexing is scanned again
+    os.utime(table, (os.path.getmtime(table) + 10,) * 2)
+    assert find_index(table) is None
+
+
+def test_lookup_matches_scan(annotation_data, tmp_path, monkeypatch):
+    table = annotation_data.table
+    scanned = _annotate(annotation_data, tmp_path, "scan", table)
+    cli.index_annotation(_index_args(table))
+    monkeypatch.setattr(annotation, "scan_table", None)
+    # the index next to the table is used, as is the index itself
+    assert _annotate(annotation_data, tmp_path, "lookup", table) == scanned
+    assert _annotate(annotation_data, tmp_path, "idx", table + ".idx") == scanned
+
+
+def _short_sgrnas(tmp_path):
+    rng = random.Random(5)
+    s1, s2 = random_sequence(rng, 20), random_sequence(rng, 20)
+    table = str(tmp_path / "lengths.txt")
+    write_table(table, [("chr1", 1000, 1020, "GENEA", 0.1, "+", s1),
+                        ("chr1", 2000, 2020, "GENEB", 0.2, "-", s2)])
+    library = str(tmp_path / "lengths.csv")
+    write_library(library, [("full", s1, "GENEA"),
+                            ("short_plus", s1[1:], "GENEA"),
+                            ("short_minus", s2[1:], "GENEB")])
+    return argparse.Namespace(table=table, libraries=[library])
+
+
+def test_lookup_short_sgrnas(tmp_path):
+    data = _short_sgrnas(tmp_path)
+    scanned = _annotate(data, tmp_path, "scan", data.table)
+    assert sorted(scanned[0][0]) == sorted([
+        "chr1\t1000\t1020\tfull\t0.1\t+",
+        "chr1\t1001\t1020\tshort_plus\t0.1\t+",
+        "chr1\t2000\t2019\tshort_minus\t0.2\t-"])
+    cli.index_annotation(_index_args(data.table))
+    # the index only finds sequences of the table length, the table is
+    # scanned instead
+    assert _annotate(data, tmp_path, "lookup", data.table) == scanned
+    with pytest.raises(SyntaxError, match="cannot be looked up"):
+        _annotate(data, tmp_path, "idx", data.table + ".idx")
+
+
+class _Handler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(annotation_data):
+    handler = partial(_Handler, directory=os.path.dirname(annotation_data.table))
+    httpd = HTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_cached_index(annotation_data, tmp_path, server, monkeypatch):
+    url = "http://127.0.0.1:{}/{}".format(
+        server.server_port, os.path.basename(annotation_data.table))
+    cache_dir = str(tmp_path / "cache")
+    scanned = _annotate(annotation_data, tmp_path, "scan", url,
+                        no_cache=False, cache_dir=cache_dir)
+    cache = DownloadCache(cache_dir)
+    assert find_index(url, cache) is None
+    cli.index_annotation(_index_args(url, cache_dir=cache_dir))
+    # the index is stored next to the downloaded table
+    index = find_index(url, cache)
+    blob = cache.cached(url)
+    assert index == os.path.join(cache_dir, "derived", os.path.basename(blob),
+                                 CACHED_INDEX)
+    monkeypatch.setattr(annotation, "scan_table", None)
+    assert _annotate(annotation_data, tmp_path, "lookup", url,
+                     no_cache=False, cache_dir=cache_dir) == scanned
+    # without the cache, the table is streamed and scanned
+    assert find_index(url) is None
@@ -0,0 +1,173 @@
+"""
+Tests for the annotation server, which has to write the same files as
+annotate-library and rescore-annotation run locally.
+"""
+
+import os
+import time
+import argparse
+import threading
+
+import pytest
+
+from mageck_vispr import cli, annotation_server
+from mageck_vispr.annotation import rescore_bed
+
+from conftest import annotate_args, write_table
+
+
+@pytest.fixture
+def server(tmp_path):
+    socket_path = str(tmp_path / "server.sock")
+    server = annotation_server.make_server(socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _outputs(tmp_path, name, n, suffix=".bed"):
+    return [str(tmp_path / "{}{}{}".format(name, i, suffix)) for i in range(n)]
+
+
+def _annotate(data, tmp_path, name, socket_path=None, suffix=".bed", **options):
+    output = _outputs(tmp_path, name, 2, suffix)
+    args = annotate_args(data.libraries, annotation_table=data.table,
+                         output=output,
+                         unmatched=_outputs(tmp_path, name + "-unmatched", 2,
+                                            ".txt"),
+                         server=socket_path, **options)
+    cli.annotate_library(args)
+    return args
+
+
+def _assert_same(args, expected):
+    for option in ("output", "unmatched"):
+        for path, other in zip(getattr(args, option), getattr(expected, option)):
+            assert _read(path) == _read(other)
+
+
+def _temporary_files(tmp_path):
+    return [f for f in os.listdir(str(tmp_path)) if f.startswith(".")]
+
+
+@pytest.mark.parametrize("options", [{}, {"sort": True, "suffix": ".bed.gz"}])
+def test_annotate(annotation_data, tmp_path, server, options):
+    local = _annotate(annotation_data, tmp_path, "local", **options)
+    served = _annotate(annotation_data, tmp_path, "served",
+                       server.server_address, **options)
+    _assert_same(served, local)
+    if options:
+        for path, other in zip(served.output, local.output):
+            assert _read(path + ".tbi") == _read(other + ".tbi")
+    assert len(server.annotation_server.annotators) == 1
+    assert not _temporary_files(tmp_path)
+
+
+def test_single_library(annotation_data, tmp_path, server):
+    local = _annotate(annotation_data, tmp_path, "local")
+    _annotate(annotation_data, tmp_path, "served", server.server_address)
+    # the kept annotation answers a request for a single library
+    args = annotate_args(annotation_data.libraries[1:],
+                         annotation_table=annotation_data.table,
+                         output=[str(tmp_path / "single.bed")])
+    assert annotation_server.request(server.server_address, "annotate", args)
+    assert _read(args.output[0]) == _read(local.output[1])
+    assert len(server.annotation_server.annotators) == 1
+
+
+def test_changed_table(annotation_data, tmp_path, server):
+    _annotate(annotation_data, tmp_path, "before", server.server_address)
+    rows = [row[:3] + ("CHANGED",) + row[4:] for row in annotation_data.rows]
+    write_table(annotation_data.table, rows)
+    stamp = time.time() + 10
+    os.utime(annotation_data.table, (stamp, stamp))
+    local = _annotate(annotation_data, tmp_path, "local")
+    served = _annotate(annotation_data, tmp_path, "served",
+                       server.server_address)
+    _assert_same(served, local)
+    assert b"CHANGED" in _read(served.unmatched[0])
+    # the outdated annotator is replaced
+    assert len(server.annotation_server.annotators) == 1
+
+
+def test_rescore(annotation_data, tmp_path, server):
+    bed = _annotate(annotation_data, tmp_path, "annotated").output[0]
+    values = []
+    for i in range(2):
+        values.append(str(tmp_path / "values{}.txt".format(i)))
+        with open(values[-1], "w") as f:
+            f.write("sgrna\tLFC\n")
+            for sgrna in annotation_data.sgrnas[0][::2]:
+                f.write("{}\t{}\n".format(sgrna[0], i + len(sgrna[0])))
+    local = _outputs(tmp_path, "local", 2)
+    rescore_bed(bed, values, "LFC", local)
+    for _ in range(2):
+        served = _outputs(tmp_path, "served", 2)
+        args = argparse.Namespace(bed=bed, bedvalue=values,
+                                  bedvalue_column="LFC", output=served)
+        assert annotation_server.request(server.server_address, "rescore", args)
+        for path, other in zip(served, local):
+            assert _read(path) == _read(other)
+    assert list(server.annotation_server.beds) == [bed]
+
+
+def test_failed_request(annotation_data, tmp_path, server):
+    args = annotate_args(annotation_data.libraries,
+                         annotation_table=str(tmp_path / "missing.txt"),
+                         output=_outputs(tmp_path, "failed", 2))
+    assert not annotation_server.request(server.server_address, "annotate", args)
+    assert not os.path.exists(args.output[0])
+    assert not _temporary_files(tmp_path)
+    assert not server.annotation_server.annotators
+
+
+def test_timeout(annotation_data, tmp_path, server):
+    args = annotate_args(annotation_data.libraries,
+                         annotation_table=annotation_data.table,
+                         output=_outputs(tmp_path, "timeout", 2))
+    assert not annotation_server.request(server.server_address, "annotate",
+                                         args, timeout=0.001)
+    # the server is not blocked by the load
+    assert annotation_server.request(server.server_address, "ping",
+                                     argparse.Namespace(), timeout=10)
+    # and discards the output of the abandoned request
+    other = annotate_args(annotation_data.libraries,
+                          annotation_table=annotation_data.table,
+                          output=_outputs(tmp_path, "other", 2))
+    assert annotation_server.request(server.server_address, "annotate", other)
+    for _ in range(100):
+        if not _temporary_files(tmp_path):
+            break
+        time.sleep(0.05)
+    assert not _temporary_files(tmp_path)
+    assert not any(os.path.exists(path) for path in args.output)
+
+
+def test_no_server(annotation_data, tmp_path):
+    socket_path = str(tmp_path / "none.sock")
+    local = _annotate(annotation_data, tmp_path, "local")
+    fallback = _annotate(annotation_data, tmp_path, "fallback", socket_path)
+    _assert_same(fallback, local)
+
+
+def test_absolute_paths(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    args = argparse.Namespace(library=["lib.csv", "/data/lib.csv"],
+                              annotation_table="https://example.org/table.txt",
+                              output=["-"], metrics="metrics.json",
+                              bedvalue=None, threads=4)
+    absolute = annotation_server.absolute_paths(args)
+    assert absolute.library == [str(tmp_path / "lib.csv"), "/data/lib.csv"]
+    assert absolute.annotation_table == "https://example.org/table.txt"
+    assert absolute.output == ["-"]
+    assert absolute.metrics == str(tmp_path / "metrics.json")
+    assert absolute.bedvalue is None and absolute.threads == 4
+    # the given arguments are left unchanged
+    assert args.library[0] == "lib.csv"
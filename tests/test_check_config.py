@@ -0,0 +1,161 @@
+"""
+Tests for the validation of the config and the existence check of the files
+it refers to.
+"""
+
+import os
+import json
+import importlib
+
+import pytest
+
+from mageck_vispr.check_config import (check_config, missing_paths, is_file,
+                                       ConfigError)
+
+# the module, which mageck_vispr shadows with the function check_config
+cc = importlib.import_module("mageck_vispr.check_config")
+
+
+def _touch(path):
+    path.write_text("")
+    return str(path)
+
+
+@pytest.fixture
+def file_stats(monkeypatch):
+    """
+    Record the files checked by missing_paths.
+    """
+    checked = []
+    file_stat = cc._file_stat
+
+    def recording_file_stat(path):
+        checked.append(path)
+        return file_stat(path)
+    monkeypatch.setattr(cc, "_file_stat", recording_file_stat)
+    return checked
+
+
+def _change_mtime(path):
+    # a change of the directory, independent of the timestamp resolution of
+    # the file system
+    mtime = os.stat(path).st_mtime_ns + 10 ** 9
+    os.utime(path, ns=(mtime, mtime))
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_missing_paths(tmp_path, threads):
+    a = _touch(tmp_path / "a.fastq")
+    (tmp_path / "sub").mkdir()
+    b = _touch(tmp_path / "sub" / "b.fastq")
+    missing = [str(tmp_path / "c.fastq"), str(tmp_path / "other" / "d.fastq")]
+    assert missing_paths([a, b, a] + missing, threads) == sorted(missing)
+    assert missing_paths([], threads) == []
+
+
+def test_missing_paths_cache(tmp_path, file_stats):
+    cache = str(tmp_path / "cache" / "paths.json")
+    reads = tmp_path / "reads"
+    reads.mkdir()
+    a = _touch(reads / "a.fastq")
+    b = _touch(reads / "b.fastq")
+    c = str(reads / "c.fastq")
+    assert missing_paths([a, b, c], cache=cache) == [c]
+    assert file_stats == [a, b, c]
+    with open(cache) as f:
+        assert json.load(f) == {str(reads): {
+            "mtime": os.stat(str(reads)).st_mtime_ns,
+            "files": ["a.fastq", "b.fastq"]}}
+
+    # files found earlier are not checked again, missing ones are
+    del file_stats[:]
+    assert missing_paths([a, b, c], cache=cache) == [c]
+    assert file_stats == [c]
+
+    # once the directory changes, all of its files are checked again
+    del file_stats[:]
+    os.remove(b)
+    _change_mtime(str(reads))
+    assert missing_paths([a, b, c], cache=cache) == [b, c]
+    assert file_stats == [a, b, c]
+    with open(cache) as f:
+        assert json.load(f)[str(reads)]["files"] == ["a.fastq"]
+
+
+def test_missing_paths_symlink(tmp_path, file_stats):
+    cache = str(tmp_path / "paths.json")
+    target = _touch(tmp_path / "target.fastq")
+    (tmp_path / "reads").mkdir()
+    link = str(tmp_path / "reads" / "a.fastq")
+    os.symlink(target, link)
+    assert missing_paths([link], cache=cache) == []
+    # a symlink breaks without its directory changing, hence it is not cached
+    os.remove(target)
+    assert missing_paths([link], cache=cache) == [link]
+    assert file_stats == [link, link]
+
+
+def test_missing_paths_invalid_cache(tmp_path):
+    cache = tmp_path / "paths.json"
+    cache.write_text("{")
+    a = _touch(tmp_path / "a.fastq")
+    assert missing_paths([a], cache=str(cache)) == []
+    with open(str(cache)) as f:
+        assert json.load(f)[str(tmp_path)]["files"] == ["a.fastq"]
+
+
+def _config(tmp_path, **options):
+    config = {
+        "library": _touch(tmp_path / "library.csv"),
+        "species": "homo_sapiens",
+        "assembly": "hg38",
+        "targets": {"genes": True},
+        "sgrnas": {"trim-5": "AUTO", "len": "AUTO"},
+        "samples": {
+            "A": _touch(tmp_path / "A.fastq"),
+            "B": [_touch(tmp_path / "B1.fastq"), str(tmp_path / "B2.fastq")],
+        },
+        "correct_cnv": False,
+        "experiments": {
+            "rra": {"treatment": ["A"], "control": ["B"]},
+            "mle": {"designmatrix": str(tmp_path / "design.txt")},
+        },
+    }
+    config.update(options)
+    return config
+
+
+def test_check_config(tmp_path):
+    config = _config(tmp_path)
+    # all missing files are reported at once
+    with pytest.raises(ConfigError, match="2 files do not exist") as e:
+        check_config(config)
+    assert "  B: {}".format(tmp_path / "B2.fastq") in str(e.value)
+    assert "  mle: {}".format(tmp_path / "design.txt") in str(e.value)
+
+    _touch(tmp_path / "design.txt")
+    with pytest.raises(ConfigError, match="entry={}.*File does not exist".format(
+            tmp_path / "B2.fastq")):
+        check_config(config)
+    _touch(tmp_path / "B2.fastq")
+    check_config(config, cache=str(tmp_path / "paths.json"))
+    check_config(config, cache=str(tmp_path / "paths.json"))
+
+
+def test_check_config_structure(tmp_path):
+    config = _config(tmp_path, correct_cnv="no")
+    with pytest.raises(ConfigError, match="key=correct_cnv"):
+        check_config(config)
+    del config["species"]
+    with pytest.raises(ConfigError, match="Missing species entry"):
+        check_config(config)
+
+
+def test_is_file(tmp_path):
+    # without a list collecting paths, the file is checked right away
+    is_file("library", _touch(tmp_path / "library.csv"))
+    with pytest.raises(ConfigError, match="File does not exist"):
+        is_file("library", str(tmp_path / "other.csv"))
+    paths = []
+    is_file("library", str(tmp_path / "other.csv"), paths)
+    assert paths == [("library", str(tmp_path / "other.csv"))]
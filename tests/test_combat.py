@@ -0,0 +1,79 @@
+"""
+Tests for the batch effect removal, against the output of parametric ComBat
+as implemented in sva (see data/combat/README.md).
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from mageck_vispr.combat import remove_batch, read_batchmatrix
+
+
+DATA = os.path.join(os.path.dirname(__file__), "data", "combat")
+
+
+def _read(path):
+    return pd.read_csv(path, sep="\t", index_col=0)
+
+
+@pytest.mark.parametrize("chunk_rows", [1000, 16])
+def test_remove_batch(tmp_path, chunk_rows):
+    output = str(tmp_path / "corrected.txt")
+    remove_batch(os.path.join(DATA, "counts.txt"),
+                 os.path.join(DATA, "batchmatrix.txt"), output,
+                 chunk_rows=chunk_rows)
+    corrected = _read(output)
+    expected = _read(os.path.join(DATA, "expected.txt"))
+    assert list(corrected.columns) == list(expected.columns)
+    assert list(corrected.index) == list(expected.index)
+    assert (corrected["Gene"] == expected["Gene"]).all()
+    np.testing.assert_allclose(corrected.iloc[:, 1:].to_numpy(),
+                               expected.iloc[:, 1:].to_numpy(),
+                               rtol=1e-6, atol=1e-6)
+
+
+def test_read_batchmatrix(tmp_path):
+    samples = ["S{}".format(i) for i in range(1, 10)]
+    batch, covariates = read_batchmatrix(os.path.join(DATA, "batchmatrix.txt"),
+                                         samples)
+    assert list(batch) == ["B1"] * 3 + ["B2"] * 3 + ["B3"] * 3
+    # unlike combat.R, the first (here: only) covariate is used
+    np.testing.assert_array_equal(covariates[:, 0], [0, 1, 0, 1, 0, 1, 1, 0, 0])
+    assert covariates.shape == (9, 1)
+
+    path = str(tmp_path / "batchmatrix.txt")
+    with open(path, "w") as f:
+        f.write("sample\tbatch\tdose\tcell\n")
+        for i, cell in enumerate(["a", "b", "c", "a"]):
+            f.write("S{}\tB{}\t{}\t{}\n".format(i, i % 2, i * 0.5, cell))
+    batch, covariates = read_batchmatrix(path, ["S3", "S0", "S1", "S2"])
+    assert list(batch) == ["B1", "B0", "B1", "B0"]
+    # numeric covariates as they are, factors in treatment contrasts
+    np.testing.assert_array_equal(covariates, [[1.5, 0, 0], [0, 0, 0],
+                                               [0.5, 1, 0], [1, 0, 1]])
+    with pytest.raises(ValueError, match="S4"):
+        read_batchmatrix(path, ["S0", "S4"])
+
+
+def test_constant_sgrnas(tmp_path):
+    counts = _read(os.path.join(DATA, "counts.txt"))
+    # an sgRNA constant within the first batch only, which sva does not adjust
+    counts.loc["within"] = ["GENE1", 5, 5, 5, 10, 20, 30, 40, 50, 60]
+    table = str(tmp_path / "counts.txt")
+    counts.to_csv(table, sep="\t")
+    output = str(tmp_path / "corrected.txt")
+    remove_batch(table, os.path.join(DATA, "batchmatrix.txt"), output)
+    corrected = _read(output)
+    # unlike combat.R, constant sgRNAs keep their counts instead of being
+    # written log transformed
+    for sgrna in ("s1", "s2", "within"):
+        assert (corrected.loc[sgrna] == counts.loc[sgrna]).all()
+    assert (corrected.loc["s1"].iloc[1:] == 12).all()
+    # the other sgRNAs are corrected as without the added one
+    expected = _read(os.path.join(DATA, "expected.txt"))
+    np.testing.assert_allclose(corrected.iloc[:-1, 1:].to_numpy(),
+                               expected.iloc[:, 1:].to_numpy(),
+                               rtol=1e-6, atol=1e-6)
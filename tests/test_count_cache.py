@@ -0,0 +1,63 @@
+"""
+Tests for the columnar copy of count tables.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from mageck_vispr.count_cache import (write_count_cache, load_meta, iter_counts,
+                                      read_samples, cache_dir)
+
+
+@pytest.fixture
+def count_table(tmp_path):
+    rng = np.random.RandomState(1)
+    path = str(tmp_path / "all.count_normalized.txt")
+    counts = rng.poisson(100, size=(250, 4)) * 1.5
+    with open(path, "w") as f:
+        f.write("sgRNA\tGene\tA\tB\tC\tD\n")
+        for i, row in enumerate(counts):
+            # sgRNA and gene names that look like numbers stay strings
+            f.write("{:03d}\t{}\t{}\n".format(
+                i, "1e{}".format(i // 10), "\t".join(map(str, row))))
+    return path, counts
+
+
+def _read_all(path, chunk_rows):
+    sgrnas, genes, counts = [], [], []
+    for chunk in iter_counts(path, chunk_rows):
+        sgrnas.extend(chunk[0])
+        genes.extend(chunk[1])
+        counts.append(chunk[2])
+    return sgrnas, genes, np.vstack(counts)
+
+
+@pytest.mark.parametrize("chunk_rows", [7, 1000])
+def test_iter_counts(count_table, chunk_rows):
+    path, counts = count_table
+    text = _read_all(path, chunk_rows)
+    meta = write_count_cache(path, chunk_rows=chunk_rows)
+    assert meta["samples"] == ["A", "B", "C", "D"] and meta["rows"] == 250
+    assert load_meta(path) == meta
+    cached = _read_all(path, chunk_rows)
+    assert cached[0] == text[0] == ["{:03d}".format(i) for i in range(250)]
+    assert cached[1] == text[1]
+    np.testing.assert_array_equal(cached[2], counts)
+    np.testing.assert_array_equal(text[2], counts)
+
+
+def test_outdated_copy(count_table):
+    path, counts = count_table
+    write_count_cache(path)
+    assert read_samples(path) == ["A", "B", "C", "D"]
+    with open(path) as f:
+        lines = f.readlines()
+    with open(path, "w") as f:
+        f.write(lines[0].replace("\tD", "\tE"))
+        f.writelines(lines[1:])
+    # the copy no longer matches the table
+    assert load_meta(path) is None
+    assert read_samples(path) == ["A", "B", "C", "E"]
+    assert os.path.exists(os.path.join(cache_dir(path), "counts.npy"))
@@ -0,0 +1,183 @@
+"""
+Tests for the download cache, against a local HTTP server that supports
+range requests like the servers hosting the annotation tables.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from mageck_vispr import download
+from mageck_vispr.download import DownloadCache
+
+
+CONTENT = {
+    "/table.txt": b"".join(b"chr1\t%d\t%d\t0.5\t+\tGENE\tACGT\n" % (i, i + 20)
+                           for i in range(5000)),
+    "/other.txt": b"other table\n" * 5000,
+}
+ETAG = '"v1"'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        body = CONTENT.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        start = 0
+        byte_range = self.headers.get("Range")
+        if byte_range and self.headers.get("If-Range") == ETAG:
+            start = int(byte_range[len("bytes="):].rstrip("-"))
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{}".format(len(body)))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                start, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _url(server, path):
+    return "http://127.0.0.1:{}{}".format(server.server_port, path)
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _partial(cache, url, data):
+    part = os.path.join(cache.cache_dir, "partial",
+                        download._sha256(url) + ".part")
+    with open(part, "wb") as f:
+        f.write(data)
+    with open(part + ".json", "w") as f:
+        json.dump({"etag": ETAG, "last_modified": None}, f)
+
+
+def test_download(server, tmp_path):
+    cache = DownloadCache(str(tmp_path))
+    url = _url(server, "/table.txt")
+    body = CONTENT["/table.txt"]
+    blob = cache.get(url, _sha256(body))
+    assert _read(blob) == body
+    assert os.path.basename(blob) == "{}-table.txt".format(_sha256(body))
+    assert not os.listdir(os.path.join(str(tmp_path), "partial"))
+    # the second time, the cached copy is used
+    assert cache.get(url) == blob
+    assert server.requests == [("/table.txt", None)]
+
+
+def test_resume(server, tmp_path):
+    cache = DownloadCache(str(tmp_path))
+    url = _url(server, "/table.txt")
+    body = CONTENT["/table.txt"]
+    _partial(cache, url, body[:1000])
+    assert _read(cache.get(url, _sha256(body))) == body
+    assert server.requests == [("/table.txt", "bytes=1000-")]
+
+
+def test_resume_complete(server, tmp_path):
+    cache = DownloadCache(str(tmp_path))
+    url = _url(server, "/table.txt")
+    body = CONTENT["/table.txt"]
+    # the server answers 416, the part is used as it is
+    _partial(cache, url, body)
+    assert _read(cache.get(url, _sha256(body))) == body
+    assert server.requests == [("/table.txt", "bytes={}-".format(len(body)))]
+
+
+def test_resume_too_long(server, tmp_path):
+    cache = DownloadCache(str(tmp_path))
+    url = _url(server, "/table.txt")
+    body = CONTENT["/table.txt"]
+    # a part longer than the file is discarded and downloaded again
+    _partial(cache, url, body + b"garbage")
+    assert _read(cache.get(url, _sha256(body))) == body
+    assert server.requests == [
+        ("/table.txt", "bytes={}-".format(len(body) + 7)), ("/table.txt", None)]
+
+
+def test_checksum_mismatch(server, tmp_path):
+    cache = DownloadCache(str(tmp_path))
+    url = _url(server, "/table.txt")
+    with pytest.raises(IOError, match="Checksum mismatch"):
+        cache.get(url, "0" * 64)
+    assert not os.listdir(os.path.join(str(tmp_path), "partial"))
+    assert not os.listdir(os.path.join(str(tmp_path), "blobs"))
+
+
+def test_evict(server, tmp_path):
+    table, other = CONTENT["/table.txt"], CONTENT["/other.txt"]
+    cache = DownloadCache(str(tmp_path), max_size=len(table) + len(other) - 1)
+    blob = cache.get(_url(server, "/table.txt"))
+    # recently used blobs are kept, although the cache is too large
+    other_blob = cache.get(_url(server, "/other.txt"))
+    assert os.path.exists(blob) and os.path.exists(other_blob)
+    # the least recently used one is removed, the one just returned is kept
+    old = time.time() - download.EVICT_MIN_AGE - 1
+    os.utime(blob, (old, old))
+    os.utime(other_blob, (old - 1, old - 1))
+    cache.get(_url(server, "/table.txt"))
+    cache.evict()
+    assert os.path.exists(blob)
+    assert not os.path.exists(other_blob)
+    # downloaded again, while the recently used blob is kept
+    assert _read(cache.get(_url(server, "/other.txt"))) == other
+    assert os.path.exists(blob)
+
+
+def test_evict_derived(server, tmp_path):
+    table, other = CONTENT["/table.txt"], CONTENT["/other.txt"]
+    cache = DownloadCache(str(tmp_path), max_size=len(table) + len(other) + 2)
+    blob = cache.get(_url(server, "/table.txt"))
+    assert cache.derived(blob, "lines") is None
+
+    def count_lines(blob, path):
+        with open(path, "w") as f:
+            f.write(str(len(_read(blob).splitlines())))
+    derived = cache.derived(blob, "lines", build=count_lines)
+    assert _read(derived) == b"5000"
+    assert cache.derived(blob, "lines", build=None) == derived
+    # derived files count towards the size of their blob
+    other_blob = cache.get(_url(server, "/other.txt"))
+    old = time.time() - download.EVICT_MIN_AGE - 1
+    os.utime(blob, (old - 1, old - 1))
+    os.utime(other_blob, (old, old))
+    cache.evict()
+    assert not os.path.exists(blob) and not os.path.exists(derived)
+    assert os.path.exists(other_blob)
+    assert not os.listdir(os.path.join(str(tmp_path), "derived"))
@@ -0,0 +1,134 @@
+"""
+Tests for the streaming read QC and the preview of FASTQ files.
+"""
+
+import gzip
+import time
+
+import pytest
+
+from mageck_vispr.qc import head_fastq, qc, report_name
+
+
+def _write_fastq(path, reads):
+    with open(str(path), "w") as f:
+        for i, (seq, qual) in enumerate(reads):
+            f.write("@read{}\n{}\n+\n{}\n".format(i, seq, qual))
+    return str(path)
+
+
+def _read(path):
+    with open(str(path), "rb") as f:
+        return f.read()
+
+
+def test_head_fastq(tmp_path, monkeypatch):
+    fastq = _write_fastq(tmp_path / "A.fastq",
+                         [("ACGT" * 5, "I" * 20) for _ in range(10)])
+    head_fastq(fastq, str(tmp_path / "A_0.fastq.gz"), 3)
+    with gzip.open(str(tmp_path / "A_0.fastq.gz"), "rt") as f:
+        assert f.read() == "".join(
+            "@read{}\n{}\n+\n{}\n".format(i, "ACGT" * 5, "I" * 20)
+            for i in range(3))
+    # the preview of the same reads is identical at another time and under
+    # another name
+    monkeypatch.setattr(time, "time", lambda: 1e9)
+    head_fastq(fastq, str(tmp_path / "B_1.fastq.gz"), 3)
+    assert _read(tmp_path / "A_0.fastq.gz") == _read(tmp_path / "B_1.fastq.gz")
+
+
+def _modules(report):
+    """
+    Parse fastqc_data.txt into a dict of module name to status, header and
+    rows.
+    """
+    modules = {}
+    with open(report) as f:
+        assert f.readline().startswith("##FastQC\t")
+        for line in f:
+            name, status = line.rstrip("\n")[2:].split("\t")
+            header = f.readline().rstrip("\n")[1:].split("\t")
+            rows = []
+            for line in iter(f.readline, ">>END_MODULE\n"):
+                rows.append(line.rstrip("\n").split("\t"))
+            modules[name] = (status, header, rows)
+    return modules
+
+
+READS = [("GATC", "IIII"), ("GGNN", "!!#5"), ("AT", "II")]
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 100])
+def test_qc(tmp_path, batch_size):
+    fastq = _write_fastq(tmp_path / "A.fastq", READS)
+    with open(fastq, "rb") as f, gzip.open(fastq + ".gz", "wb") as out:
+        out.write(f.read())
+    report = qc(fastq + ".gz", str(tmp_path / "qc"), batch_size=batch_size)
+    assert report == str(tmp_path / "qc" / "A_fastqc" / "fastqc_data.txt")
+    modules = _modules(report)
+    assert list(modules) == [
+        "Basic Statistics", "Per base sequence quality",
+        "Per sequence quality scores", "Per base sequence content",
+        "Per sequence GC content", "Sequence Length Distribution"]
+    assert dict(modules["Basic Statistics"][2]) == {
+        "Filename": "A.fastq.gz", "File type": "Conventional base calls",
+        "Encoding": "Sanger / Illumina 1.9", "Total Sequences": "3",
+        "Sequences flagged as poor quality": "0", "Sequence length": "2-4",
+        "%GC": "50"}
+
+    status, header, rows = modules["Per base sequence quality"]
+    assert status == "fail"
+    assert header[:2] == ["Base", "Mean"]
+    assert [int(row[0]) for row in rows] == [1, 2, 3, 4]
+    assert [float(row[1]) for row in rows] == pytest.approx(
+        [80 / 3, 80 / 3, 21, 30])
+    # median and percentiles of the last position (qualities 40 and 20)
+    assert rows[3][2:] == ["20", "20", "40", "20", "40"]
+
+    # the mean quality of a read is truncated
+    rows = modules["Per sequence quality scores"][2]
+    assert rows[0] == ["5", "1.0"] and rows[-1] == ["40", "2.0"]
+    assert sum(float(row[1]) for row in rows) == 3
+
+    status, header, rows = modules["Per base sequence content"]
+    assert header == ["Base", "G", "A", "T", "C"]
+    assert [float(v) for v in rows[0][1:]] == pytest.approx([200 / 3, 100 / 3, 0, 0])
+    # N is not part of the base content
+    assert [float(v) for v in rows[3][1:]] == pytest.approx([0, 0, 0, 100])
+    assert status == "fail"
+
+    rows = modules["Per sequence GC content"][2]
+    assert len(rows) == 101
+    assert {int(row[0]): float(row[1]) for row in rows if row[1] != "0.0"} == {
+        0: 1, 50: 2}
+
+    assert modules["Sequence Length Distribution"][2] == [
+        ["2", "1.0"], ["3", "0.0"], ["4", "2.0"]]
+
+
+def test_qc_illumina15(tmp_path):
+    fastq = _write_fastq(tmp_path / "A.fq", [("ACGT", "hhhh"), ("ACGT", "@@hh")])
+    modules = _modules(qc(fastq, str(tmp_path)))
+    assert dict(modules["Basic Statistics"][2])["Encoding"] == "Illumina 1.5"
+    rows = modules["Per base sequence quality"][2]
+    assert [float(row[1]) for row in rows] == [20, 20, 40, 40]
+
+
+@pytest.mark.parametrize("content", [
+    "@read\nACGT\n+\nIIII\n@read2\nACGT\n",
+    "read\nACGT\n+\nIIII\n",
+    "@read\nACGT\n+\nIII\n",
+    "@read\nACGT\n+\n    \n",
+])
+def test_qc_invalid(tmp_path, content):
+    fastq = str(tmp_path / "A.fastq")
+    with open(fastq, "w") as f:
+        f.write(content)
+    with pytest.raises(SyntaxError):
+        qc(fastq, str(tmp_path))
+
+
+def test_report_name():
+    assert report_name("/data/A_R1.fastq.gz") == "A_R1"
+    assert report_name("A.fq.bz2") == "A"
+    assert report_name("A.txt") == "A"
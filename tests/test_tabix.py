@@ -0,0 +1,223 @@
+"""
+Round trips of BGZF files and tabix indexed BED files, compared with
+htslib (tabix or pysam) where available.
+"""
+
+import io
+import gzip
+import random
+import shutil
+import subprocess
+
+import pytest
+
+from mageck_vispr.bgzf import (BgzfWriter, BgzfReader, EOF_BLOCK,
+                               BLOCK_DATA_SIZE, MAX_BLOCK_SIZE)
+from mageck_vispr.tabix import (write_indexed_bed, fetch, index_bed, reg2bin,
+                                reg2bins, bed_sort_key, TabixIndex)
+
+
+def _lines(rng, n):
+    return ["{}\t{}\n".format(i, "x" * rng.randrange(200)) for i in range(n)]
+
+
+def _blocks(path):
+    # compressed sizes of the blocks of a BGZF file
+    with open(path, "rb") as f:
+        data = f.read()
+    sizes = []
+    pos = 0
+    while pos < len(data):
+        size = int.from_bytes(data[pos + 16:pos + 18], "little") + 1
+        sizes.append(size)
+        pos += size
+    return sizes
+
+
+def test_bgzf(tmp_path):
+    rng = random.Random(1)
+    lines = _lines(rng, 5000)
+    path = str(tmp_path / "lines.gz")
+    writer = BgzfWriter(path)
+    offsets = []
+    for line in lines:
+        offsets.append(writer.virtual_offset())
+        writer.write(line.encode())
+    writer.close()
+    # readable by gzip, ending with the EOF block
+    with gzip.open(path, "rt") as f:
+        assert f.read() == "".join(lines)
+    with open(path, "rb") as f:
+        assert f.read().endswith(EOF_BLOCK)
+    sizes = _blocks(path)
+    assert len(sizes) > 5 and max(sizes) <= MAX_BLOCK_SIZE
+    # lines crossing block boundaries
+    assert any(offset & 0xffff > BLOCK_DATA_SIZE - 200 for offset in offsets)
+    with BgzfReader(path) as reader:
+        assert reader.tell() == 0
+        for line, offset in zip(lines, offsets):
+            assert reader.tell() == offset or (
+                offset & 0xffff == BLOCK_DATA_SIZE and reader.tell() & 0xffff == 0)
+            assert reader.readline().decode() == line
+        assert reader.readline() == b""
+        for i in rng.sample(range(len(lines)), 200):
+            reader.seek(offsets[i])
+            assert reader.readline().decode() == lines[i]
+
+
+def test_bgzf_incompressible(tmp_path):
+    data = random.Random(2).getrandbits(8 * 300000).to_bytes(300000, "little")
+    path = str(tmp_path / "random.gz")
+    with io.BufferedWriter(BgzfWriter(path, level=1), 1 << 20) as out:
+        out.write(data)
+    with gzip.open(path, "rb") as f:
+        assert f.read() == data
+    assert max(_blocks(path)) <= MAX_BLOCK_SIZE
+
+
+def _hts_reg2bin(beg, end, min_shift=14, n_lvls=5):
+    # hts_reg2bin of htslib
+    end -= 1
+    level, shift = n_lvls, min_shift
+    t = ((1 << ((n_lvls << 1) + n_lvls)) - 1) // 7
+    while level > 0:
+        if beg >> shift == end >> shift:
+            return t + (beg >> shift)
+        level -= 1
+        shift += 3
+        t -= 1 << ((level << 1) + level)
+    return 0
+
+
+BOUNDARIES = [0, 1, 1 << 14, 1 << 17, 1 << 20, 1 << 23, 1 << 26, 3 << 26]
+
+
+def test_reg2bin():
+    rng = random.Random(3)
+    intervals = [(b + d, b + d + length) for b in BOUNDARIES
+                 for d in (-2, -1, 0, 1) if b + d >= 0
+                 for length in (1, 2, 1 << 14, 1 << 17, 1 << 20)]
+    intervals += [(start, start + rng.randrange(1, 1 << 22))
+                  for start in (rng.randrange(1 << 28) for _ in range(1000))]
+    for start, end in intervals:
+        b = reg2bin(start, end)
+        assert b == _hts_reg2bin(start, end)
+        assert b in reg2bins(start, end)
+        # the bins of any overlapping region hold the record
+        assert b in reg2bins(end - 1, end + 5)
+        assert b in reg2bins(max(start - 5, 0), start + 1)
+
+
+def _records(rng):
+    records = []
+    for chrom in ("chr1", "chr2", "chr10", "chrX"):
+        for _ in range(6000):
+            start = rng.choice(BOUNDARIES[:6]) + rng.randrange(-300, 300)
+            start = max(start, 0) if rng.random() < 0.3 else rng.randrange(1 << 24)
+            length = rng.choice([0, 1, 20, 20, 20, 5000, 20000, 200000, 2000000])
+            records.append("{}\t{}\t{}\tsg{}\t0.5\t+\n".format(
+                chrom, start, start + length, len(records)))
+    return records
+
+
+def _overlapping(records, chrom, start, end):
+    # records are sorted
+    return [line.rstrip("\n") for line in records.get(chrom, ())
+            if line.start < end and line.end > start]
+
+
+class _Record(str):
+    # a BED line with its interval, as tabix reads it
+    def __new__(cls, line):
+        record = super().__new__(cls, line)
+        fields = line.split("\t")
+        record.start = int(fields[1])
+        record.end = max(int(fields[2]), record.start + 1)
+        return record
+
+
+def _by_chrom(records):
+    chroms = {}
+    for line in records:
+        chroms.setdefault(line.split("\t", 1)[0], []).append(_Record(line))
+    return chroms
+
+
+def _regions(rng):
+    regions = [("chr1", b + d, b + d + length) for b in BOUNDARIES[:6]
+               for d in (-1, 0, 1) if b + d >= 0 for length in (1, 100, 1 << 14)]
+    regions += [(rng.choice(["chr1", "chr2", "chr10", "chrX"]), start,
+                 start + rng.choice([1, 10, 1000, 1 << 15, 1 << 21]))
+                for start in (rng.randrange(1 << 24) for _ in range(200))]
+    regions += [("chrY", 0, 1 << 24), ("chr2", 0, 1 << 29)]
+    return regions
+
+
+@pytest.fixture(scope="module")
+def indexed_bed(tmp_path_factory):
+    rng = random.Random(4)
+    records = _records(rng)
+    path = str(tmp_path_factory.mktemp("tabix") / "sgrnas.bed.gz")
+    unsorted = list(records)
+    rng.shuffle(unsorted)
+    write_indexed_bed(["#chrom\tstart\tend\tname\tscore\tstrand\n"] + unsorted,
+                      path)
+    return path, sorted(unsorted, key=bed_sort_key), _regions(rng)
+
+
+def test_fetch(indexed_bed):
+    path, records, regions = indexed_bed
+    # regions cross bins, linear index windows and BGZF blocks
+    assert len(_blocks(path)) > 10
+    index = TabixIndex(path + ".tbi")
+    by_chrom = _by_chrom(records)
+    assert list(index.refs) == ["chr1", "chr10", "chr2", "chrX"]
+    for chrom, start, end in regions:
+        assert list(fetch(path, chrom, start, end, index)) == _overlapping(
+            by_chrom, chrom, start, end)
+    with gzip.open(path, "rt") as f:
+        lines = f.readlines()
+    assert lines[0].startswith("#")
+    assert lines[1:] == records
+
+
+def test_index_bed(indexed_bed, tmp_path):
+    path, records, regions = indexed_bed
+    bed = str(tmp_path / "unsorted.bed.gz")
+    with gzip.open(bed, "wt") as f:
+        f.write("".join(records) + "\n")
+    output = index_bed(bed, str(tmp_path / "sorted.bed.gz"))
+    with open(output, "rb") as f, open(path, "rb") as other:
+        # the header is the only difference
+        assert gzip.decompress(f.read()) == b"".join(
+            gzip.decompress(other.read()).splitlines(True)[1:])
+    by_chrom = _by_chrom(records)
+    for chrom, start, end in regions[:20]:
+        assert list(fetch(output, chrom, start, end)) == _overlapping(
+            by_chrom, chrom, start, end)
+
+
+@pytest.mark.skipif(shutil.which("tabix") is None, reason="tabix not installed")
+def test_htslib_tabix(indexed_bed):
+    path, records, regions = indexed_bed
+    chroms = subprocess.run(["tabix", "-l", path], check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    assert chroms.stdout.split() == ["chr1", "chr10", "chr2", "chrX"]
+    for chrom, start, end in regions:
+        # tabix regions are 1-based and closed
+        found = subprocess.run(
+            ["tabix", path, "{}:{}-{}".format(chrom, start + 1, end)],
+            check=True, stdout=subprocess.PIPE, universal_newlines=True)
+        assert found.stdout.splitlines() == list(fetch(path, chrom, start, end))
+
+
+def test_pysam(indexed_bed):
+    pysam = pytest.importorskip("pysam")
+    path, records, regions = indexed_bed
+    with pysam.TabixFile(path) as tbx:
+        assert sorted(tbx.contigs) == ["chr1", "chr10", "chr2", "chrX"]
+        for chrom, start, end in regions:
+            if chrom not in tbx.contigs:
+                continue
+            assert list(tbx.fetch(chrom, start, end)) == list(
+                fetch(path, chrom, start, end))
@@ -0,0 +1,217 @@
+"""
+Tests for the helpers of the workflow in mageck_vispr/__init__.py.
+"""
+
+import pytest
+
+from mageck_vispr import (merge_count_tables, merge_countsummaries,
+                          postprocess_config, benchmarked_targets,
+                          experiment_samples, WorkflowPlan, ConfigError)
+from mageck_vispr.count_cache import subset_count_table
+
+
+def _write(path, lines):
+    with open(str(path), "w") as f:
+        f.writelines(line + "\n" for line in lines)
+    return str(path)
+
+
+def _read(path):
+    with open(str(path)) as f:
+        return f.read().splitlines()
+
+
+def test_merge_count_tables(tmp_path):
+    a = _write(tmp_path / "A.count.txt", [
+        "sgRNA\tGene\tA",
+        "sg1\tG1\t10",
+        "sg2\tG1\t0",
+        "sg3\tG2\t5",
+    ])
+    # a sample with replicate columns, sgRNAs missing and in another order
+    b = _write(tmp_path / "B.count.txt", [
+        "sgRNA\tGene\tB_0\tB_1",
+        "sg3\tG2\t1\t2",
+        "sg4\tG3\t7\t8",
+        "sg1\tG1\t3\t4",
+    ])
+    output = str(tmp_path / "all.count.txt")
+    merge_count_tables([a, b], output)
+    assert _read(output) == [
+        "sgRNA\tGene\tA\tB_0\tB_1",
+        "sg1\tG1\t10\t3\t4",
+        "sg2\tG1\t0\t0\t0",
+        "sg3\tG2\t5\t1\t2",
+        "sg4\tG3\t0\t7\t8",
+    ]
+
+
+def test_merge_single_count_table(tmp_path):
+    lines = ["sgRNA\tGene\tA", "sg1\tG1\t10", "sg2\tG1\t0"]
+    a = _write(tmp_path / "A.count.txt", lines)
+    output = str(tmp_path / "all.count.txt")
+    merge_count_tables([a], output)
+    assert _read(output) == lines
+
+
+def test_merge_countsummaries(tmp_path):
+    header = "File\tLabel\tReads\tMapped\tPercentage"
+    a = _write(tmp_path / "A.countsummary.txt", [
+        header, "a.fastq\tA\t100\t90\t0.9"])
+    b = _write(tmp_path / "B.countsummary.txt", [
+        header, "b1.fastq\tB\t50\t40\t0.8", "b2.fastq\tB\t60\t30\t0.5"])
+    output = str(tmp_path / "all.countsummary.txt")
+    merge_countsummaries([a, b], output)
+    assert _read(output) == [
+        header,
+        "a.fastq\tA\t100\t90\t0.9",
+        "b1.fastq\tB\t50\t40\t0.8",
+        "b2.fastq\tB\t60\t30\t0.5",
+    ]
+
+
+def _touch(path):
+    path.write_text("")
+    return str(path)
+
+
+def _config(tmp_path, **options):
+    """
+    A minimal configuration with three samples, one of them with two
+    replicates.
+    """
+    config = {
+        "library": _touch(tmp_path / "library.csv"),
+        "species": "homo_sapiens",
+        "assembly": "hg38",
+        "targets": {"genes": True},
+        "sgrnas": {"trim-5": "AUTO", "len": "AUTO"},
+        "samples": {
+            "A": _touch(tmp_path / "A.fastq"),
+            "B": [_touch(tmp_path / "B1.fastq"), _touch(tmp_path / "B2.fastq")],
+            "plasmid": _touch(tmp_path / "plasmid.fastq"),
+        },
+        "correct_cnv": False,
+        "experiments": {
+            "rra": {"treatment": ["A", "B"], "control": ["plasmid"]},
+        },
+    }
+    config.update(options)
+    return config
+
+
+def test_build_plan(tmp_path):
+    config = _config(tmp_path)
+    plan = postprocess_config(config)
+    assert isinstance(plan, WorkflowPlan)
+    assert plan.results_dir == "results" and not plan.preview
+    assert plan.raw_fastqs == {
+        "A_0": str(tmp_path / "A.fastq"), "B_0": str(tmp_path / "B1.fastq"),
+        "B_1": str(tmp_path / "B2.fastq"),
+        "plasmid_0": str(tmp_path / "plasmid.fastq")}
+    assert plan.fastqs == plan.raw_fastqs
+    assert not plan.paired_fastqs
+    assert plan.counts == "results/count/all.count.txt"
+    assert plan.normalized_counts == "results/count/all.count_normalized.txt"
+    assert plan.norm_method == "median"
+    assert plan.rra_treatment == {"rra": "--treatment-id A,B"}
+    assert plan.rra_control == {"rra": "--control-id plasmid"}
+    assert not plan.design_available and not plan.annotation_available
+    assert plan.sample_names == ()
+    assert plan.lfc_targets == (("results/test/rra.sgrna_summary.txt",
+                                 "annotation/rra.sgrnas.bed"),)
+    assert plan.benchmarked_targets == tuple(benchmarked_targets(config))
+    assert "results/test/rra.gene_summary.txt" in plan.benchmarked_targets
+    # the plan is read-only
+    with pytest.raises(TypeError):
+        plan.fastqs["A_0"] = "other.fastq"
+    with pytest.raises(AttributeError):
+        plan.counts = "other.txt"
+
+
+def test_build_plan_day0(tmp_path):
+    # with a day0 label, the design matrix is empty and MLE runs with RRA
+    config = _config(tmp_path, day0label="plasmid", experiments={
+        "mle": {"designmatrix": "/dev/null"}},
+        sgrnas={"trim-5": "AUTO", "len": "AUTO", "adapter": "ACGT"},
+        preview_reads=1000)
+    plan = postprocess_config(config)
+    assert plan.preview and plan.results_dir == "results_preview"
+    assert plan.sample_names == ("A", "B")
+    assert plan.rra_in_mle == {"mle"}
+    assert plan.rra_treatment == {"mle": ""}
+    assert not plan.design_available
+    assert plan.lfc_targets == tuple(
+        ("results_preview/test/mle.rra.{}_vs_plasmid.sgrna_summary.txt".format(s),
+         "results_preview/annotation/mle.rra.{}_vs_plasmid.sgrnas.bed".format(s))
+        for s in "AB")
+    # reads are taken from the preview and trimmed
+    assert plan.raw_fastqs["B_1"] == "results_preview/reads/R1/B_1.fastq.gz"
+    assert plan.fastqs["B_1"] == "results_preview/trimmed_reads/B_1.fastq.gz"
+
+
+def test_build_plan_missing_files(tmp_path):
+    config = _config(tmp_path)
+    config["samples"]["C"] = [str(tmp_path / "C1.fastq"),
+                              str(tmp_path / "C2.fastq")]
+    with pytest.raises(ConfigError, match="2 files do not exist"):
+        postprocess_config(config)
+
+
+def test_normalize_once(tmp_path):
+    plan = postprocess_config(_config(tmp_path))
+    assert plan.test_counts == plan.counts
+    assert plan.test_norm_method == "median"
+    plan = postprocess_config(_config(tmp_path, normalize_once=True))
+    assert plan.test_counts == "results/count/all.count_normalized.txt"
+    assert plan.test_norm_method == "none"
+    # all samples are tested unless subset_samples is set
+    assert not plan.experiment_samples and not plan.experiment_counts
+
+
+def test_normalize_once_batchcorrected(tmp_path):
+    plan = postprocess_config(_config(
+        tmp_path, normalize_once=True, batchmatrix=_touch(tmp_path / "batch.txt")))
+    # the batch corrected counts are already normalized
+    assert plan.test_counts == "results/count/all.count.batchcorrected.txt"
+    assert plan.test_norm_method == "none"
+
+
+def test_subset_samples(tmp_path):
+    design = tmp_path / "design.txt"
+    design.write_text("Samples\tbaseline\tB\nplasmid\t1\t0\nB\t1\t1\n\n")
+    plan = postprocess_config(_config(
+        tmp_path, normalize_once=True, subset_samples=True, experiments={
+            "rra": {"treatment": ["A", "B"], "control": ["plasmid", "A"]},
+            "mle": {"designmatrix": str(design)}}))
+    assert plan.experiment_samples == {"rra": ("A", "B", "plasmid"),
+                                       "mle": ("plasmid", "B")}
+    assert plan.experiment_counts == {
+        "rra": "results/count/experiments/rra.count.txt",
+        "mle": "results/count/experiments/mle.count.txt"}
+
+
+def test_subset_samples_day0(tmp_path):
+    config = _config(tmp_path, normalize_once=True, subset_samples=True,
+                     day0label="plasmid")
+    plan = postprocess_config(config)
+    # tests against the day0 label need all samples
+    assert experiment_samples(config, "rra") is None
+    assert not plan.experiment_samples
+
+
+def test_subset_count_table(tmp_path):
+    counts = _write(tmp_path / "all.count.txt", [
+        "sgRNA\tGene\tA\tB\tplasmid",
+        "sg1\tG1\t1.5\t2\t3",
+        "sg2\tG2\t4\t5\t6",
+    ])
+    output = str(tmp_path / "rra.count.txt")
+    subset_count_table(counts, ["plasmid", "A"], output)
+    assert _read(output) == [
+        "sgRNA\tGene\tplasmid\tA",
+        "sg1\tG1\t3\t1.5",
+        "sg2\tG2\t6\t4",
+    ]
+    with pytest.raises(ValueError, match="Samples not found"):
+        subset_count_table(counts, ["C"], output)